@@ -1,6 +1,7 @@
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+from contextlib import contextmanager
 import traceback
 
 from colcon_core.logging import colcon_logger
@@ -13,15 +14,34 @@ logger = colcon_logger.getChild(__name__)
 class BundleInstallerContext:
     """The context provided to installers."""
 
-    def __init__(self, *, args, cache_path, prefix_path):
+    def __init__(self, *, args, cache_path, prefix_path,
+                 locked_packages=None, shared_cache=None,
+                 prefix_writes=None):
         """
         Construct the BundleInstallerContext.
 
         :param args: The parsed command line arguments
+        :param locked_packages: Installer specific pinned names of exactly
+        the packages to install instead of resolving the install list, None
+        to resolve it
+        :param shared_cache: SharedCache for downloaded packages shared
+        with other bundles, None to only use cache_path
+        :param prefix_writes: function returning the context manager which
+        has to be held while writing to the prefix path in one of the
+        PREFIX_WRITE_PHASES of the installer, None if the writes do not
+        need to be ordered
         """
         self.args = args
         self.cache_path = cache_path
         self.prefix_path = prefix_path
+        self.locked_packages = locked_packages
+        self.shared_cache = shared_cache
+        self.prefix_writes = prefix_writes or _unordered_prefix_writes
+
+
+@contextmanager
+def _unordered_prefix_writes(phase):
+    yield
 
 
 class BundleInstallerExtensionPoint:
@@ -37,11 +57,42 @@ class BundleInstallerExtensionPoint:
     """
 
     """The version of the bundle installer extension interface."""
-    EXTENSION_POINT_VERSION = '1.0'
+    EXTENSION_POINT_VERSION = '1.5'
 
     """The default priority of bundle installer extensions."""
     PRIORITY = 100
 
+    """
+    The names of the installers whose install() has to finish first.
+
+    Installers which do not depend on each other are run concurrently.
+    Installers which are not loaded are ignored. None depends on all
+    installers ordered before this one.
+    """
+    DEPENDS_ON = None
+
+    """
+    The destinations of the arguments which change the packages resolved.
+
+    Only these arguments are part of the key of bundle.lock, changing other
+    arguments like the number of workers keeps the lock valid. None for all
+    arguments of the installer.
+    """
+    LOCK_ARGUMENTS = None
+
+    """
+    The phases in which install() writes to the prefix path.
+
+    Installers declaring phases may run concurrently even if they write the
+    same files. Each phase is entered with context.prefix_writes(phase) in
+    the declared order. A phase starts once all installers ordered before
+    this one finished it, and all installers ordered after it finished the
+    previous phase. Files written by several installers in the same phase
+    are left by the last installer like when the installers run serially.
+    None if the writes of install() are not ordered.
+    """
+    PREFIX_WRITE_PHASES = None
+
     def should_load(self):
         """
         Check whether the extension should load on the system.
@@ -119,6 +170,35 @@ class BundleInstallerExtensionPoint:
         """
         raise RuntimeError('This should be implemented in a subclass')
 
+    def get_locked_packages(self):
+        """
+        Get the resolved packages of the last install() as pinned names.
+
+        The names are passed back as `locked_packages` of the context to
+        install exactly the same packages without resolving them again.
+
+        Default: None
+
+        :return: list of installer specific pinned names or None if the
+        installer does not support locking
+        :rtype: list
+        """
+        return None
+
+    def finalize(self):
+        """
+        Finish the install after the bundle rewrote the installed files.
+
+        This is called once all installers finished install() and the
+        symlinks and shebangs in the prefix path were updated, e.g. to
+        record the final state of the installed files.
+
+        Default: None
+
+        :return: None
+        """
+        return None
+
 
 def get_bundle_installer_extensions():
     """
@@ -140,16 +220,29 @@ def add_installer_arguments(parser):
     """
     Add the command line arguments for the task extensions.
 
-    :param parser: The argument parser
+    :param parser: The argument parser, the destinations of the arguments
+    of installers without LOCK_ARGUMENTS are only known if it has the
+    get_destinations() of colcon_core.command.DestinationCollectorDecorator
+    :return: the destinations of the arguments which change the packages
+    the installers resolve, see LOCK_ARGUMENTS
+    :rtype: list
     """
+    lock_arguments = []
     extensions = get_bundle_installer_extensions()
     for extension_name, extension in extensions.items():
         group = parser.add_argument_group(
             title="Arguments for '{extension_name}' installer"
             .format_map(locals()))
+        destinations = _get_destinations(parser)
         try:
             retval = extension.add_arguments(parser=group)
             assert retval is None, 'add_arguments() should return None'
+            if extension.LOCK_ARGUMENTS is not None:
+                lock_arguments += extension.LOCK_ARGUMENTS
+            else:
+                lock_arguments += [
+                    dest for key, dest in _get_destinations(parser).items()
+                    if key not in destinations]
         except Exception as e:
             # catch exceptions raised in task extension
             exc = traceback.format_exc()
@@ -162,6 +255,13 @@ def add_installer_arguments(parser):
                     e=e,
                     exc=exc))
             # skip failing extension, continue with next one
+    return lock_arguments
+
+
+def _get_destinations(parser):
+    if not hasattr(parser, 'get_destinations'):
+        return {}
+    return parser.get_destinations()
 
 
 class InstallerNotFound(Exception):
@@ -0,0 +1,711 @@
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from functools import cmp_to_key
+import gzip
+import lzma
+import os
+import re
+import sqlite3
+import subprocess
+
+from colcon_bundle.installer import logger
+
+_SCHEMA_VERSION = '2'
+
+_DIGITS = '0123456789'
+
+_RELATION_REGEX = re.compile(
+    r'^\s*(?P<name>[^\s(:]+)(:\S+)?\s*'
+    r'(\(\s*(?P<op><<|<=|=|>=|>>|<|>)\s*(?P<version>[^\s)]+)\s*\))?')
+
+_SOURCE_REGEX = re.compile(r'^(?P<name>\S+)(\s*\((?P<version>[^)]+)\))?')
+
+# Fields of the Packages indices stored in the index
+_FIELDS = ('Package', 'Version', 'Architecture', 'Filename', 'Size',
+           'SHA256', 'Source', 'Depends', 'Pre-Depends', 'Provides')
+
+
+def _order(c):
+    if c == '~':
+        return -1
+    if c in _DIGITS:
+        return 0
+    if 'a' <= c.lower() <= 'z':
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_fragment(a, b):
+    # The verrevcmp algorithm of dpkg
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and a[i] not in _DIGITS) or \
+                (j < len(b) and b[j] not in _DIGITS):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        while i < len(a) and a[i] in _DIGITS and \
+                j < len(b) and b[j] in _DIGITS:
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i] in _DIGITS:
+            return 1
+        if j < len(b) and b[j] in _DIGITS:
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _split_version(version):
+    epoch = 0
+    if ':' in version:
+        epoch_string, version = version.split(':', 1)
+        epoch = int(epoch_string)
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+
+def compare_versions(a, b):
+    """
+    Compare two Debian package versions.
+
+    :param a: first version
+    :param b: second version
+    :return: a negative number if a is older than b, 0 if they are equal
+    and a positive number if a is newer
+    """
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    result = _compare_fragment(a_upstream, b_upstream)
+    if result:
+        return result
+    return _compare_fragment(a_revision, b_revision)
+
+
+def version_satisfies(version, op, required):
+    """
+    Check a version against the version constraint of a relationship.
+
+    :param version: the available version
+    :param op: one of <<, <=, =, >=, >> or None for no constraint
+    :param required: the version of the constraint
+    :return: True if version satisfies the constraint
+    """
+    if op is None:
+        return True
+    result = compare_versions(version, required)
+    if op == '<<':
+        return result < 0
+    if op in ('<=', '<'):
+        return result <= 0
+    if op == '=':
+        return result == 0
+    if op in ('>=', '>'):
+        return result >= 0
+    return result > 0
+
+
+def parse_relationships(field):
+    """
+    Parse a relationship field like Depends.
+
+    Architecture qualifiers like `:any` are ignored.
+
+    :param field: the value of the field or None
+    :return: list of groups of alternatives, each alternative a tuple of
+    name, operator and version where operator and version may be None
+    """
+    groups = []
+    if not field:
+        return groups
+    for group in field.split(','):
+        alternatives = []
+        for alternative in group.split('|'):
+            match = _RELATION_REGEX.match(alternative)
+            if match is None:
+                continue
+            alternatives.append(
+                (match.group('name'), match.group('op'),
+                 match.group('version')))
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+
+def _read_paragraphs(path):
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    elif path.endswith('.xz'):
+        f = lzma.open(path, 'rt', encoding='utf-8', errors='replace')
+    else:
+        f = open(path, 'r', encoding='utf-8', errors='replace')
+    with f:
+        paragraph = {}
+        field = None
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                if paragraph:
+                    yield paragraph
+                paragraph = {}
+                field = None
+            elif line[0] in ' \t':
+                if field is not None:
+                    paragraph[field] += '\n' + line.strip()
+            else:
+                field, _, value = line.partition(':')
+                if field in _FIELDS:
+                    paragraph[field] = value.strip()
+                else:
+                    field = None
+        if paragraph:
+            yield paragraph
+
+
+class AptIndex:
+    """
+    Compact on-disk index of the binary packages in apt Packages indices.
+
+    The index is a sqlite database which is memory-mapped while it is read.
+    It is only rebuilt when the indices it was created from change.
+    """
+
+    def __init__(self, path):
+        """
+        Open or create the index.
+
+        :param path: file path of the database
+        """
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA mmap_size = 268435456')
+
+    def close(self):
+        """Close the database."""
+        self._connection.close()
+
+    def _list_state(self, list_paths):
+        state = []
+        for path in sorted(list_paths):
+            stat_result = os.stat(path)
+            state.append(
+                (path, stat_result.st_size, stat_result.st_mtime_ns))
+        return state
+
+    def _stored_list_state(self):
+        try:
+            version = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'schema'").fetchone()
+            if version is None or version[0] != _SCHEMA_VERSION:
+                return None
+            return [tuple(row) for row in self._connection.execute(
+                'SELECT path, size, mtime_ns FROM lists ORDER BY path')]
+        except sqlite3.OperationalError:
+            return None
+
+    def update(self, list_paths, architectures):
+        """
+        Rebuild the index if the Packages indices changed.
+
+        :param list_paths: paths of the Packages indices
+        :param architectures: architectures of the packages to include
+        :return: True if the index was rebuilt
+        """
+        state = self._list_state(list_paths)
+        if self._stored_list_state() == state:
+            return False
+        logger.info('Indexing {count} package lists'.format(
+            count=len(state)))
+        with self._connection:
+            for table in ('meta', 'lists', 'packages', 'provides'):
+                self._connection.execute(
+                    'DROP TABLE IF EXISTS {}'.format(table))
+            self._connection.execute(
+                'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._connection.execute(
+                'CREATE TABLE lists '
+                '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)')
+            self._connection.execute(
+                'CREATE TABLE packages (name TEXT, version TEXT, '
+                'architecture TEXT, filename TEXT, size INTEGER, '
+                'sha256 TEXT, source_name TEXT, source_version TEXT, '
+                'depends TEXT, pre_depends TEXT)')
+            self._connection.execute(
+                'CREATE TABLE provides (name TEXT, provider TEXT, '
+                'provider_version TEXT, version TEXT)')
+            for path, _, _ in state:
+                self._add_list(path, architectures)
+            self._connection.execute(
+                'CREATE INDEX packages_name ON packages (name)')
+            self._connection.execute(
+                'CREATE INDEX provides_name ON provides (name)')
+            self._connection.execute(
+                'CREATE INDEX provides_provider ON provides (provider)')
+            self._connection.executemany(
+                'INSERT INTO lists VALUES (?, ?, ?)', state)
+            self._connection.execute(
+                "INSERT INTO meta VALUES ('schema', ?)", (_SCHEMA_VERSION,))
+        return True
+
+    def _add_list(self, path, architectures):
+        packages = []
+        provides = []
+        for paragraph in _read_paragraphs(path):
+            if paragraph.get('Architecture') not in architectures:
+                continue
+            name = paragraph['Package']
+            version = paragraph['Version']
+            source_name, source_version = name, version
+            match = _SOURCE_REGEX.match(paragraph.get('Source', ''))
+            if match is not None:
+                source_name = match.group('name')
+                source_version = match.group('version') or version
+            packages.append((
+                name, version, paragraph['Architecture'],
+                paragraph.get('Filename'), int(paragraph.get('Size', 0)),
+                paragraph.get('SHA256'), source_name, source_version,
+                paragraph.get('Depends'), paragraph.get('Pre-Depends')))
+            for group in parse_relationships(paragraph.get('Provides')):
+                provided_name, _, provided_version = group[0]
+                provides.append(
+                    (provided_name, name, version, provided_version))
+        self._connection.executemany(
+            'INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            packages)
+        self._connection.executemany(
+            'INSERT INTO provides VALUES (?, ?, ?, ?)', provides)
+
+    def versions(self, name):
+        """
+        Get the available versions of a package.
+
+        :param name: name of the package
+        :return: list of IndexVersion ordered from newest to oldest
+        """
+        versions = OrderedDict()
+        for row in self._connection.execute(
+                'SELECT name, version, architecture, filename, size, sha256, '
+                'source_name, source_version, depends, pre_depends '
+                'FROM packages WHERE name = ?', (name,)):
+            # The same version can be listed by several repositories
+            versions.setdefault(row[1], IndexVersion(*row))
+        result = list(versions.values())
+        for i in range(1, len(result)):
+            # Insertion sort, there are only a few versions per package
+            j = i
+            while j > 0 and compare_versions(
+                    result[j].version, result[j - 1].version) > 0:
+                result[j], result[j - 1] = result[j - 1], result[j]
+                j -= 1
+        return result
+
+    def providers(self, name):
+        """
+        Get the packages providing a virtual package.
+
+        :param name: name of the virtual package
+        :return: list of tuples of the provider name, the version of the
+        provider and the provided version, which may be None, ordered by
+        the provider name and from the newest to the oldest provider version
+        """
+        providers = [tuple(row) for row in self._connection.execute(
+            'SELECT DISTINCT provider, provider_version, version '
+            'FROM provides WHERE name = ?', (name,))]
+        providers.sort(key=cmp_to_key(
+            lambda a, b: compare_versions(b[1], a[1])))
+        providers.sort(key=lambda row: row[0])
+        return providers
+
+    def provided_by(self, provider, provider_version):
+        """
+        Get the virtual packages a version of a package provides.
+
+        :param provider: name of the package
+        :param provider_version: version of the package
+        :return: list of tuples of the virtual package name and the provided
+        version, which may be None
+        """
+        return [tuple(row) for row in self._connection.execute(
+            'SELECT DISTINCT name, version FROM provides '
+            'WHERE provider = ? AND provider_version = ? ORDER BY name',
+            (provider, provider_version))]
+
+
+class IndexVersion:
+    """A version of a binary package in the index."""
+
+    def __init__(self, package_name, version, architecture, filename, size,
+                 sha256, source_name, source_version, depends,
+                 pre_depends):
+        """
+        Create a version from a row of the index.
+
+        :param package_name: name of the package
+        :param version: the Debian version string
+        """
+        self.package_name = package_name
+        self.version = version
+        self.architecture = architecture
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.source_name = source_name
+        self.source_version = source_version
+        self.depends = depends
+        self.pre_depends = pre_depends
+        self._cache = None
+
+    def __repr__(self):  # noqa: D105
+        return '<Version: package:{!r} version:{!r}>'.format(
+            self.package_name, self.version)
+
+    def dependencies(self):
+        """:return: the groups of alternatives of Pre-Depends and Depends."""
+        return parse_relationships(self.pre_depends) + \
+            parse_relationships(self.depends)
+
+    def fetch_source(self, destdir, unpack=True):
+        """
+        Download the source package with apt-get.
+
+        :param destdir: directory the source files are downloaded to
+        :param unpack: unsupported, the source is never unpacked
+        :raises ValueError: if the source can not be downloaded
+        """
+        try:
+            subprocess.check_call(
+                self._cache.apt_get_args + [
+                    'source', '--download-only',
+                    '{}={}'.format(self.source_name, self.source_version)],
+                cwd=destdir)
+        except subprocess.CalledProcessError:
+            raise ValueError(
+                'No source for {self.package_name} {self.version}'.format(
+                    self=self))
+
+
+class _IndexVersions:
+    """The versions of an IndexPackage."""
+
+    def __init__(self, versions):
+        self._versions = OrderedDict(
+            (version.version, version) for version in versions)
+
+    def __iter__(self):
+        return iter(self._versions.values())
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __getitem__(self, index):
+        return list(self._versions.values())[index]
+
+    def __repr__(self):
+        return repr(list(self._versions.values()))
+
+    def get(self, version, default=None):
+        return self._versions.get(version, default)
+
+
+class IndexPackage:
+    """
+    A binary package of the index.
+
+    This implements the subset of apt.Package used by the apt installer.
+    """
+
+    def __init__(self, cache, name, versions):
+        """
+        Create a package.
+
+        :param cache: the IndexCache the package belongs to
+        :param name: name of the package
+        :param versions: list of IndexVersion ordered from newest to oldest
+        """
+        self._cache = cache
+        self.name = name
+        self.shortname = name
+        self.versions = _IndexVersions(versions)
+        self.candidate = versions[0]
+        for version in versions:
+            version._cache = cache
+
+    def __repr__(self):  # noqa: D105
+        return '<Package: name:{!r}>'.format(self.name)
+
+    @property
+    def marked_install(self):  # noqa: D102
+        return self._cache.is_marked(self.name)
+
+    def mark_install(self, auto_fix=True, auto_inst=True, from_user=True):
+        """
+        Mark the candidate version for installation.
+
+        :param auto_inst: also install the dependencies of the package
+        """
+        self._cache.mark(self, auto_inst=auto_inst)
+
+    def mark_delete(self, auto_fix=True, purge=False):
+        """Remove the package from the packages to install."""
+        self._cache.unmark(self.name)
+
+
+class IndexCache:
+    """
+    Package cache backed by an AptIndex instead of python3-apt.
+
+    This implements the subset of apt.Cache used by the apt installer. The
+    install closure of all marked packages is computed when the outermost
+    action group ends. Only Depends and Pre-Depends are followed,
+    Recommends, Conflicts and Breaks are not considered. The version
+    selected for a package is never replaced, a later dependency it does
+    not satisfy is an error.
+    """
+
+    def __init__(self, rootdir, apt_get_args, architectures):
+        """
+        Create the cache.
+
+        :param rootdir: directory of the apt configuration, package lists
+        and archives
+        :param apt_get_args: apt-get command line using rootdir
+        :param architectures: architectures of the packages to install
+        """
+        self.rootdir = rootdir
+        self.apt_get_args = apt_get_args
+        self.architectures = architectures
+        self._index = None
+        self._packages = {}
+        self._requests = OrderedDict()
+        self._excluded = set()
+        self._marked = OrderedDict()
+        self._action_depth = 0
+
+    @property
+    def lists_path(self):  # noqa: D102
+        return os.path.join(self.rootdir, 'var', 'lib', 'apt', 'lists')
+
+    @property
+    def archives_path(self):  # noqa: D102
+        return os.path.join(self.rootdir, 'var', 'cache', 'apt', 'archives')
+
+    def update(self):
+        """Download the package lists with apt-get update."""
+        try:
+            subprocess.check_call(self.apt_get_args + ['update'])
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(
+                'Failed to fetch from repositories: {}'.format(e))
+
+    def open(self):  # noqa: A003
+        """Index the downloaded package lists and reset all marks."""
+        list_paths = []
+        if os.path.isdir(self.lists_path):
+            list_paths = [
+                os.path.join(self.lists_path, name)
+                for name in os.listdir(self.lists_path)
+                if re.search(r'_Packages(\.gz|\.xz)?$', name)]
+        if self._index is None:
+            self._index = AptIndex(os.path.join(
+                self.rootdir, 'var', 'cache', 'apt', 'index.sqlite'))
+        self._index.update(list_paths, self.architectures)
+        self._packages = {}
+        self._requests.clear()
+        self._excluded.clear()
+        self._marked.clear()
+
+    def close(self):
+        """Close the index."""
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def __getitem__(self, name):  # noqa: D105
+        if name not in self._packages:
+            versions = self._index.versions(name)
+            if not versions:
+                raise KeyError(
+                    'The cache has no package named {!r}'.format(name))
+            self._packages[name] = IndexPackage(self, name, versions)
+        return self._packages[name]
+
+    def __contains__(self, name):  # noqa: D105
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        """Iterate the packages marked for installation."""
+        return iter([self[name] for name in self._marked])
+
+    @property
+    def broken_count(self):  # noqa: D102
+        # Unsatisfiable dependencies raise an error while resolving
+        return 0
+
+    @contextmanager
+    def actiongroup(self):
+        """Resolve the closure once for all marks inside the group."""
+        self._action_depth += 1
+        try:
+            yield
+        finally:
+            self._action_depth -= 1
+        if self._action_depth == 0:
+            self._resolve()
+
+    def exclude(self, names):
+        """
+        Never install the given packages, not even as dependencies.
+
+        Dependencies on excluded packages are considered satisfied.
+
+        :param names: names of the packages
+        """
+        self._excluded.update(names)
+        for name in names:
+            self._marked.pop(name, None)
+
+    def is_marked(self, name):
+        """:return: True if the package is marked for installation."""
+        return name in self._marked
+
+    def mark(self, package, *, auto_inst=True):
+        """
+        Request the installation of the candidate of a package.
+
+        :param package: the IndexPackage
+        :param auto_inst: also install the dependencies of the package
+        """
+        self._requests[package.name] = (package, auto_inst)
+        if self._action_depth == 0:
+            self._resolve()
+
+    def unmark(self, name):
+        """
+        Remove a package from the packages to install.
+
+        :param name: name of the package
+        """
+        self._requests.pop(name, None)
+        self._marked.pop(name, None)
+
+    def _resolve(self):
+        marked = OrderedDict()
+        queue = deque()
+        for name, (package, auto_inst) in self._requests.items():
+            if name in self._excluded:
+                continue
+            marked[name] = package.candidate
+            if auto_inst:
+                queue.append(package.candidate)
+        provided = {}
+        for version in marked.values():
+            self._add_provided(version, provided)
+
+        while queue:
+            version = queue.popleft()
+            for group in version.dependencies():
+                if self._satisfied(group, marked, provided):
+                    continue
+                choice = self._choose(group, marked)
+                if choice is None:
+                    group_string = ' | '.join(
+                        name + (' ({} {})'.format(op, required)
+                                if op else '')
+                        for name, op, required in group)
+                    conflicts = [
+                        '{} {}'.format(name, marked[name].version)
+                        for name, _, _ in group if name in marked]
+                    if conflicts:
+                        # The versions selected for earlier dependents are
+                        # not replaced
+                        raise RuntimeError(
+                            'The dependency {group} of '
+                            '{version.package_name} {version.version} '
+                            'conflicts with the selected {conflicts}'.format(
+                                group=group_string, version=version,
+                                conflicts=', '.join(conflicts)))
+                    raise RuntimeError(
+                        'Unable to satisfy the dependency {group} of '
+                        '{version.package_name} {version.version}'.format(
+                            group=group_string, version=version))
+                package = self[choice.package_name]
+                package.candidate = choice
+                marked[choice.package_name] = choice
+                self._add_provided(choice, provided)
+                queue.append(choice)
+        self._marked = marked
+
+    def _add_provided(self, version, provided):
+        for name, provided_version in self._index.provided_by(
+                version.package_name, version.version):
+            provided.setdefault(name, []).append(provided_version)
+
+    def _satisfied(self, group, marked, provided):
+        for name, op, required in group:
+            if name in self._excluded:
+                return True
+            version = marked.get(name)
+            if version is not None and \
+                    version_satisfies(version.version, op, required):
+                return True
+            for provided_version in provided.get(name, []):
+                if op is None or (provided_version is not None and
+                                  version_satisfies(
+                                      provided_version, op, required)):
+                    return True
+        return False
+
+    def _choose(self, group, marked):
+        for name, op, required in group:
+            if name in marked:
+                # The selected version does not satisfy the dependency
+                continue
+            for version in self._index.versions(name):
+                if version_satisfies(version.version, op, required):
+                    return version
+            for provider, provider_version, provided_version in \
+                    self._index.providers(name):
+                if provider in self._excluded or provider in marked:
+                    continue
+                if op is None or (provided_version is not None and
+                                  version_satisfies(
+                                      provided_version, op, required)):
+                    return self[provider].versions.get(provider_version)
+        return None
+
+    def fetch_archives(self):
+        """Download the archives of the marked packages with apt-get."""
+        os.makedirs(self.archives_path, exist_ok=True)
+        missing = [
+            '{}={}'.format(name, version.version)
+            for name, version in self._marked.items()
+            if not os.path.isfile(os.path.join(
+                self.archives_path, '{}_{}_{}.deb'.format(
+                    name, version.version.replace(':', '%3a'),
+                    version.architecture)))]
+        if not missing:
+            return
+        try:
+            subprocess.check_call(
+                self.apt_get_args + ['download'] + missing,
+                cwd=self.archives_path)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError('Failed to fetch packages: {}'.format(e))
@@ -0,0 +1,151 @@
+import io
+import os
+import tarfile
+
+_AR_MAGIC = b'!<arch>\n'
+_AR_HEADER_SIZE = 60
+_AR_FILE_MAGIC = b'`\n'
+
+# tarfile stream modes for the compressions of data.tar in a .deb
+_DATA_TAR_MODES = {
+    '': 'r|',
+    '.gz': 'r|gz',
+    '.xz': 'r|xz',
+    '.bz2': 'r|bz2',
+}
+
+
+class _LimitedReader(io.RawIOBase):
+    """Read-only file object returning the next size bytes of a file."""
+
+    def __init__(self, fileobj, size):
+        super().__init__()
+        self._fileobj = fileobj
+        self._remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        count = min(len(b), self._remaining)
+        if count <= 0:
+            return 0
+        data = self._fileobj.read(count)
+        b[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+def _iter_ar_members(fileobj):
+    """
+    Iterate the members of an ar archive.
+
+    :param fileobj: binary file object positioned at the start of the archive
+    :return: generator of tuples with the name and size of each member, the
+    file object is positioned at the start of the member data
+    :raises RuntimeError: if the file is not an ar archive
+    """
+    if fileobj.read(len(_AR_MAGIC)) != _AR_MAGIC:
+        raise RuntimeError('Not a debian package')
+    while True:
+        header = fileobj.read(_AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != _AR_HEADER_SIZE or header[58:] != _AR_FILE_MAGIC:
+            raise RuntimeError('Malformed ar header in debian package')
+        name = header[:16].decode().strip()
+        # GNU ar terminates names with a slash
+        if name.endswith('/'):
+            name = name[:-1]
+        size = int(header[48:58].decode().strip())
+        start = fileobj.tell()
+        yield name, size
+        # Member data is padded to an even size
+        fileobj.seek(start + size + size % 2)
+
+
+def _open_data_tar(name, reader):
+    extension = name[len('data.tar'):]
+    if extension == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                'Please install zstandard in order to extract zstd '
+                'compressed debian packages')
+        return tarfile.open(
+            fileobj=zstandard.ZstdDecompressor().stream_reader(reader),
+            mode='r|')
+    if extension not in _DATA_TAR_MODES:
+        raise RuntimeError(
+            'Unsupported compression of debian package: {}'.format(name))
+    return tarfile.open(fileobj=reader, mode=_DATA_TAR_MODES[extension])
+
+
+def _check_member(member, destination):
+    """
+    Refuse members which would be written outside of destination.
+
+    Unlike the filters of tarfile the mode of the member is kept, packages
+    rely on setuid executables and group writable directories.
+
+    :param member: tarfile.TarInfo of the member
+    :param destination: real path of the directory the files are extracted to
+    :raises RuntimeError: if the member or the target of a hard link is
+    outside of destination
+    """
+    paths = [member.name]
+    if member.islnk():
+        # Hard link targets are members of the same archive
+        paths.append(member.linkname)
+    for path in paths:
+        if os.path.isabs(path):
+            raise RuntimeError(
+                'Refusing to extract absolute path: {}'.format(path))
+        # Resolve symlinks which were already extracted
+        target = os.path.realpath(os.path.join(destination, path))
+        if os.path.commonpath([destination, target]) != destination:
+            raise RuntimeError(
+                'Refusing to extract path outside of the destination: '
+                '{}'.format(path))
+
+
+def extract_deb(deb_path, destination):
+    """
+    Extract the files of a .deb package like `dpkg-deb --extract`.
+
+    The data.tar member of the package is decompressed and extracted while
+    it is read, without running dpkg-deb.
+
+    :param deb_path: path of the .deb file
+    :param destination: directory the files are extracted to
+    :return: list of the paths of all members which are not directories,
+    relative to destination
+    :raises RuntimeError: if the package can not be read
+    """
+    kwargs = {}
+    # The members are checked by _check_member, the filters of tarfile
+    # would strip the setuid, setgid and group / other writable bits
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        kwargs['filter'] = 'fully_trusted'
+    os.makedirs(destination, exist_ok=True)
+    real_destination = os.path.realpath(destination)
+    files = []
+    with open(deb_path, 'rb') as f:
+        for name, size in _iter_ar_members(f):
+            if not name.startswith('data.tar'):
+                continue
+            reader = io.BufferedReader(_LimitedReader(f, size))
+            with _open_data_tar(name, reader) as tar:
+
+                def members():
+                    for member in tar:
+                        _check_member(member, real_destination)
+                        if not member.isdir():
+                            files.append(os.path.normpath(member.name))
+                        yield member
+                # Directories are created writable and get their
+                # permissions once all members are extracted
+                tar.extractall(destination, members=members(), **kwargs)
+            return files
+    raise RuntimeError('{} does not contain data.tar'.format(deb_path))
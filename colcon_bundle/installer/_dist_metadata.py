@@ -0,0 +1,132 @@
+import csv
+import os
+
+# Distributions pip freeze leaves out by default
+EXCLUDED_DISTRIBUTIONS = ('distribute', 'pip', 'setuptools', 'wheel')
+
+
+def site_packages_paths(prefix, python_version):
+    """
+    Get the directories the bundled interpreter loads distributions from.
+
+    :param prefix: the staging directory of the bundle
+    :param python_version: name of the interpreter binary, e.g. python3.6
+    :return: list of the existing directories, earlier ones take precedence
+    """
+    major_version = python_version.split('.')[0]
+    # In the order of sys.path of the Debian interpreters
+    paths = [
+        os.path.join(prefix, 'usr', 'lib', python_version),
+        os.path.join(
+            prefix, 'usr', 'local', 'lib', python_version, 'dist-packages'),
+        os.path.join(
+            prefix, 'usr', 'local', 'lib', python_version, 'site-packages'),
+        os.path.join(prefix, 'usr', 'lib', major_version, 'dist-packages'),
+        os.path.join(prefix, 'usr', 'lib', python_version, 'dist-packages'),
+        os.path.join(prefix, 'usr', 'lib', python_version, 'site-packages'),
+    ]
+    # The major version can be the same as the full version
+    return [path for i, path in enumerate(paths)
+            if path not in paths[:i] and os.path.isdir(path)]
+
+
+def collect_distributions(paths, *, stats=False, exclude=()):
+    """
+    Read the installed distributions from their metadata directories.
+
+    This finds the same distributions as pip freeze without running the
+    interpreter. Editable distributions have no version.
+
+    :param paths: the site-packages directories to scan
+    :param stats: include the number of files and their total size in
+    bytes as far as the metadata records them
+    :param exclude: names of distributions to leave out
+    :return: list of dictionaries with the name, version and installer of
+    each distribution, ordered by name
+    """
+    excluded = {name.lower() for name in exclude}
+    distributions = {}
+    for path in paths:
+        for entry in sorted(os.listdir(path)):
+            entry_path = os.path.join(path, entry)
+            if entry.endswith('.dist-info'):
+                distribution = _read_dist_info(entry_path, stats=stats)
+            elif entry.endswith('.egg-info'):
+                distribution = _read_egg_info(entry_path, stats=stats)
+            elif entry.endswith('.egg-link'):
+                distribution = {'name': entry[:-len('.egg-link')]}
+            else:
+                continue
+            if distribution is None or \
+                    distribution['name'].lower() in excluded:
+                continue
+            # The first directory on the path takes precedence
+            distributions.setdefault(
+                distribution['name'].lower(), distribution)
+    return [distributions[key] for key in sorted(distributions)]
+
+
+def _read_headers(path):
+    headers = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                break
+            key, sep, value = line.partition(':')
+            if sep and not line[0].isspace():
+                headers.setdefault(key.strip().lower(), value.strip())
+    return headers
+
+
+def _distribution(path, headers):
+    distribution = {
+        'name': headers.get('name', os.path.basename(path).split('-')[0])}
+    if 'version' in headers:
+        distribution['version'] = headers['version']
+    return distribution
+
+
+def _read_dist_info(path, *, stats):
+    metadata_path = os.path.join(path, 'METADATA')
+    if not os.path.isfile(metadata_path):
+        return None
+    headers = _read_headers(metadata_path)
+    distribution = _distribution(path, headers)
+    installer_path = os.path.join(path, 'INSTALLER')
+    if os.path.isfile(installer_path):
+        with open(installer_path, 'r') as f:
+            distribution['installer'] = f.read().strip()
+    if stats:
+        files = 0
+        size = 0
+        record_path = os.path.join(path, 'RECORD')
+        if os.path.isfile(record_path):
+            with open(record_path, 'r', newline='') as f:
+                for row in csv.reader(f):
+                    if not row:
+                        continue
+                    files += 1
+                    if len(row) > 2 and row[2].isdigit():
+                        size += int(row[2])
+        distribution['files'] = files
+        distribution['size'] = size
+    return distribution
+
+
+def _read_egg_info(path, *, stats):
+    # The metadata of an egg-info is either a directory or a single file
+    metadata_path = path
+    if os.path.isdir(path):
+        metadata_path = os.path.join(path, 'PKG-INFO')
+        if not os.path.isfile(metadata_path):
+            return None
+    headers = _read_headers(metadata_path)
+    distribution = _distribution(path, headers)
+    if stats:
+        files = 0
+        installed_files_path = os.path.join(path, 'installed-files.txt')
+        if os.path.isfile(installed_files_path):
+            with open(installed_files_path, 'r') as f:
+                files = sum(1 for line in f if line.strip())
+        distribution['files'] = files
+    return distribution
@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+import errno
+import os
+import shutil
+import tempfile
+
+from colcon_bundle.installer import logger
+from colcon_bundle.verb.utilities import filechecksum
+
+
+class SharedCache:
+    """
+    Content addressed store of downloaded packages shared by bundles.
+
+    Objects are stored under their sha256 and hardlinked into the caches of
+    the individual bundles, so a package downloaded by one workspace is
+    reused by all others. Caches on another filesystem get copies. The
+    modification time of an object records its last use for the garbage
+    collection. Files looked up by their name, like wheels, are additionally
+    recorded under their name in a namespace.
+
+    A shared lock is held while objects are added or linked, collect_garbage
+    holds an exclusive lock, so concurrent bundles can use the same store on
+    platforms supporting flock.
+    """
+
+    def __init__(self, path, *, max_size=None):
+        """
+        Open the store, creating it if needed.
+
+        :param path: directory of the store
+        :param max_size: size in bytes the store is reduced to by
+        collect_garbage, None to never remove objects
+        """
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self._objects_path = os.path.join(self.path, 'objects')
+        os.makedirs(self._objects_path, exist_ok=True)
+
+    def _object_path(self, sha256):
+        return os.path.join(self._objects_path, sha256[:2], sha256)
+
+    def _names_path(self, namespace):
+        return os.path.join(self.path, 'names', namespace)
+
+    @contextmanager
+    def _lock(self, *, exclusive=False):
+        try:
+            import fcntl
+        except ImportError:
+            # Without flock the store must not be used concurrently
+            yield
+            return
+        with open(os.path.join(self.path, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def link(self, sha256, destination):
+        """
+        Hardlink an object of the store to destination.
+
+        :param sha256: hex digest of the content
+        :param destination: path the object is linked to
+        :return: True if the object is in the store and was linked
+        """
+        with self._lock():
+            object_path = self._object_path(sha256)
+            if not os.path.isfile(object_path):
+                return False
+            _replace_with_link(object_path, destination)
+            # Mark the object as recently used
+            os.utime(object_path)
+        return True
+
+    def add(self, path, *, sha256=None):
+        """
+        Add a file to the store and replace it with a link to the object.
+
+        :param path: file to add
+        :param sha256: hex digest of the file, computed if None
+        :return: the hex digest
+        """
+        if sha256 is None:
+            sha256 = filechecksum(path)
+        with self._lock():
+            object_path = self._object_path(sha256)
+            if not os.path.isfile(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                # Link under a temporary name first, so other bundles never
+                # see a partially added object
+                temp_path = _temp_path(object_path)
+                try:
+                    _link_or_copy(path, temp_path)
+                    os.replace(temp_path, object_path)
+                except OSError:
+                    if os.path.lexists(temp_path):
+                        os.remove(temp_path)
+                    raise
+            elif os.stat(path).st_dev == os.stat(object_path).st_dev and \
+                    not os.path.samefile(path, object_path):
+                # Keep a single copy of the content
+                _replace_with_link(object_path, path)
+            os.utime(object_path)
+        return sha256
+
+    def add_named(self, namespace, path):
+        """
+        Add a file to the store and record it under its file name.
+
+        Files which can only be found by their name, e.g. wheels, are
+        recorded this way so they can be linked by link_named.
+
+        :param namespace: name of the collection the file is recorded in
+        :param path: file to add
+        :return: the hex digest
+        """
+        sha256 = self.add(path)
+        names_path = self._names_path(namespace)
+        os.makedirs(names_path, exist_ok=True)
+        name_path = os.path.join(names_path, os.path.basename(path))
+        with self._lock():
+            temp_path = _temp_path(name_path)
+            try:
+                with open(temp_path, 'w') as f:
+                    f.write(sha256)
+                os.replace(temp_path, name_path)
+            except OSError:
+                if os.path.lexists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return sha256
+
+    def link_named(self, namespace, destination):
+        """
+        Hardlink the files recorded under a namespace into a directory.
+
+        Files which already exist in destination are kept.
+
+        :param namespace: name of the collection as passed to add_named
+        :param destination: directory the files are linked into
+        :return: list of the names of the linked files
+        """
+        names_path = self._names_path(namespace)
+        if not os.path.isdir(names_path):
+            return []
+        linked = []
+        for name in sorted(os.listdir(names_path)):
+            if name.startswith('.') or \
+                    os.path.lexists(os.path.join(destination, name)):
+                continue
+            try:
+                with open(os.path.join(names_path, name)) as f:
+                    sha256 = f.read().strip()
+            except FileNotFoundError:
+                continue
+            if self.link(sha256, os.path.join(destination, name)):
+                linked.append(name)
+        return linked
+
+    def collect_garbage(self):
+        """
+        Remove the least recently used objects until max_size is reached.
+
+        Objects still linked from the cache of a bundle are removed as well,
+        the bundle keeps its link but has to add the object again to share
+        it with other bundles.
+
+        :return: number of removed objects
+        """
+        if self.max_size is None:
+            return 0
+        with self._lock(exclusive=True):
+            objects = []
+            total_size = 0
+            for root, _, files in os.walk(self._objects_path):
+                for name in files:
+                    object_path = os.path.join(root, name)
+                    stat_result = os.stat(object_path)
+                    total_size += stat_result.st_size
+                    objects.append((stat_result.st_mtime, object_path,
+                                    stat_result.st_size))
+            removed = 0
+            for _, object_path, size in sorted(objects):
+                if total_size <= self.max_size:
+                    break
+                os.remove(object_path)
+                total_size -= size
+                removed += 1
+            if removed:
+                self._remove_dangling_names()
+        if removed:
+            logger.info('Removed {removed} objects from the shared cache '
+                        '{path}'.format(removed=removed, path=self.path))
+        return removed
+
+    def _remove_dangling_names(self):
+        for root, _, files in os.walk(os.path.join(self.path, 'names')):
+            for name in files:
+                name_path = os.path.join(root, name)
+                with open(name_path) as f:
+                    sha256 = f.read().strip()
+                if not os.path.isfile(self._object_path(sha256)):
+                    os.remove(name_path)
+
+
+def _temp_path(path):
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.' + os.path.basename(path), dir=os.path.dirname(path))
+    os.close(fd)
+    os.remove(temp_path)
+    return temp_path
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        # The store is on another filesystem
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(source, destination)
+
+
+def _replace_with_link(source, destination):
+    temp_path = _temp_path(destination)
+    try:
+        _link_or_copy(source, temp_path)
+        os.replace(temp_path, destination)
+    except OSError:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,331 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import configparser
+import csv
+import hashlib
+import io
+import os
+import re
+import shutil
+import zipfile
+
+from colcon_bundle.installer import logger
+from colcon_bundle.verb.utilities import remove_empty_parents
+
+INSTALLER_NAME = 'colcon-bundle'
+
+_SCRIPT_TEMPLATE = """\
+#!/usr/bin/env {interpreter}
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {import_name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit({function}())
+"""
+
+
+def get_install_scheme(prefix, python_version):
+    """
+    Get the directories pip of the bundled interpreter installs to.
+
+    The Debian interpreters install packages into /usr/local.
+
+    :param prefix: the staging directory of the bundle
+    :param python_version: name of the interpreter binary, e.g. python3.6
+    :return: dictionary mapping the wheel scheme keys purelib, platlib,
+    scripts, data and headers to directories
+    """
+    local = os.path.join(prefix, 'usr', 'local')
+    site_packages = os.path.join(
+        local, 'lib', python_version, 'dist-packages')
+    return {
+        'purelib': site_packages,
+        'platlib': site_packages,
+        'scripts': os.path.join(local, 'bin'),
+        'data': local,
+        'headers': os.path.join(local, 'include', python_version),
+    }
+
+
+def canonicalize_name(name):
+    """:return: the normalized form of a distribution name (PEP 503)."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def install_wheels(wheel_paths, scheme, *, interpreter, workers=None):
+    """
+    Install wheels into the directories of an install scheme.
+
+    Installed distributions with the same names are removed first, then
+    the wheels are unpacked concurrently. Wheels containing the same files
+    are installed one after another afterwards in the order of
+    wheel_paths, so the last of them provides the files like with pip.
+
+    :param wheel_paths: paths of the .whl files
+    :param scheme: directories to install to, see get_install_scheme
+    :param interpreter: name of the interpreter used in the shebang of the
+    generated scripts, e.g. python3
+    :param workers: number of wheels unpacked at the same time, None to
+    use one per processor
+    :return: dictionary mapping each wheel path to the paths of the
+    installed files
+    """
+    names = {canonicalize_name(_parse_wheel_name(path)[0])
+             for path in wheel_paths}
+    for dist_info in _installed_dist_infos(scheme['purelib'], names):
+        remove_distribution(scheme['purelib'], dist_info)
+
+    owners = {}
+    for path in wheel_paths:
+        for destination in wheel_destinations(path, scheme):
+            owners.setdefault(destination, []).append(path)
+    overlapping = set()
+    for destination, paths in sorted(owners.items()):
+        if len(paths) > 1:
+            logger.warning(
+                '{destination} is contained in {wheels}, installing it '
+                'from {last}'.format(
+                    destination=destination,
+                    wheels=', '.join(os.path.basename(p) for p in paths),
+                    last=os.path.basename(paths[-1])))
+            overlapping.update(paths)
+
+    installed = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # zlib releases the GIL while decompressing
+        futures = [
+            (path, executor.submit(
+                install_wheel, path, scheme, interpreter=interpreter))
+            for path in wheel_paths if path not in overlapping]
+        for path, future in futures:
+            installed[path] = future.result()
+    for path in wheel_paths:
+        if path in overlapping:
+            installed[path] = install_wheel(
+                path, scheme, interpreter=interpreter)
+    return {path: installed[path] for path in wheel_paths}
+
+
+def wheel_destinations(wheel_path, scheme):
+    """
+    Get the paths a wheel installs files to.
+
+    :param wheel_path: path of the .whl file
+    :param scheme: directories to install to, see get_install_scheme
+    :return: list of the paths of the installed files
+    """
+    with zipfile.ZipFile(wheel_path) as wheel:
+        lib_dir, dist_info, members = _plan_wheel(wheel, wheel_path, scheme)
+        destinations = [destination for _, destination, _ in members]
+        entry_points = dist_info + '/entry_points.txt'
+        if entry_points in wheel.namelist():
+            destinations += [
+                path for path, _ in _entry_point_scripts(
+                    wheel.read(entry_points).decode(), scheme['scripts'],
+                    interpreter='')]
+    dist_info_path = os.path.join(lib_dir, dist_info)
+    return destinations + [
+        os.path.join(dist_info_path, 'INSTALLER'),
+        os.path.join(dist_info_path, 'RECORD')]
+
+
+def install_wheel(wheel_path, scheme, *, interpreter):
+    """
+    Install a single wheel (PEP 427).
+
+    :param wheel_path: path of the .whl file
+    :param scheme: directories to install to, see get_install_scheme
+    :param interpreter: name of the interpreter used in script shebangs
+    :return: list of the installed files
+    """
+    logger.info('Installing {}'.format(os.path.basename(wheel_path)))
+    with zipfile.ZipFile(wheel_path) as wheel:
+        lib_dir, dist_info, members = _plan_wheel(wheel, wheel_path, scheme)
+        records = []
+        for info, destination, is_script in members:
+            records.append(_extract_member(
+                wheel, info, destination, interpreter=interpreter,
+                is_script=is_script))
+
+        entry_points = dist_info + '/entry_points.txt'
+        if entry_points in wheel.namelist():
+            for path, script in _entry_point_scripts(
+                    wheel.read(entry_points).decode(), scheme['scripts'],
+                    interpreter=interpreter):
+                records.append(_write_file(path, script.encode()))
+                os.chmod(path, 0o755)
+
+    dist_info_path = os.path.join(lib_dir, dist_info)
+    records.append(_write_file(
+        os.path.join(dist_info_path, 'INSTALLER'),
+        (INSTALLER_NAME + '\n').encode()))
+    _write_record(os.path.join(dist_info_path, 'RECORD'), records, lib_dir)
+    return [path for path, _, _ in records] + [
+        os.path.join(dist_info_path, 'RECORD')]
+
+
+def _plan_wheel(wheel, wheel_path, scheme):
+    """
+    Map the members of a wheel to the paths they are installed to.
+
+    :return: tuple of the lib directory, the name of the .dist-info
+    directory and a list of tuples of the zipfile.ZipInfo, the destination
+    and whether the member is a script
+    """
+    name, version = _parse_wheel_name(wheel_path)
+    dist_info = _find_dist_info(wheel, name, version)
+    data_dir = dist_info[:-len('.dist-info')] + '.data'
+    wheel_metadata = _parse_metadata(
+        wheel.read(dist_info + '/WHEEL').decode())
+    if wheel_metadata.get('root-is-purelib', 'true').lower() == 'true':
+        lib_dir = scheme['purelib']
+    else:
+        lib_dir = scheme['platlib']
+
+    members = []
+    for info in wheel.infolist():
+        if info.filename.endswith('/'):
+            continue
+        parts = info.filename.split('/')
+        if info.filename.startswith('/') or '..' in parts:
+            raise RuntimeError(
+                'Invalid path {} in wheel {}'.format(
+                    info.filename, wheel_path))
+        if parts[0] == data_dir:
+            if len(parts) < 3 or parts[1] not in scheme:
+                raise RuntimeError(
+                    'Unknown data directory {} in wheel {}'.format(
+                        info.filename, wheel_path))
+            base = scheme[parts[1]]
+            if parts[1] == 'headers':
+                base = os.path.join(base, name)
+            destination = os.path.join(base, *parts[2:])
+        elif info.filename == dist_info + '/RECORD' or \
+                info.filename.startswith(dist_info + '/RECORD.'):
+            # The RECORD is generated for the installed files
+            continue
+        else:
+            destination = os.path.join(lib_dir, *parts)
+        is_script = parts[0] == data_dir and parts[1] == 'scripts'
+        members.append((info, destination, is_script))
+    return lib_dir, dist_info, members
+
+
+def remove_distribution(lib_dir, dist_info):
+    """
+    Remove the files of an installed distribution listed in its RECORD.
+
+    :param lib_dir: the site-packages directory
+    :param dist_info: name of the .dist-info directory of the distribution
+    """
+    logger.info('Removing {}'.format(dist_info))
+    dist_info_path = os.path.join(lib_dir, dist_info)
+    record_path = os.path.join(dist_info_path, 'RECORD')
+    if os.path.exists(record_path):
+        with open(record_path, 'r', newline='') as f:
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                path = os.path.normpath(os.path.join(lib_dir, row[0]))
+                if os.path.isfile(path) or os.path.islink(path):
+                    os.remove(path)
+                    remove_empty_parents(lib_dir, os.path.dirname(path))
+    shutil.rmtree(dist_info_path, ignore_errors=True)
+
+
+def _installed_dist_infos(lib_dir, names):
+    if not os.path.isdir(lib_dir):
+        return []
+    return [
+        entry for entry in sorted(os.listdir(lib_dir))
+        if entry.endswith('.dist-info') and
+        canonicalize_name(entry[:-len('.dist-info')].rsplit('-', 1)[0]) in
+        names]
+
+
+def _parse_wheel_name(wheel_path):
+    # {distribution}-{version}(-{build tag})?-{python}-{abi}-{platform}.whl
+    parts = os.path.basename(wheel_path)[:-len('.whl')].split('-')
+    if len(parts) not in (5, 6):
+        raise RuntimeError('Invalid wheel file name {}'.format(wheel_path))
+    return parts[0], parts[1]
+
+
+def _find_dist_info(wheel, name, version):
+    dist_infos = {
+        path.split('/', 1)[0] for path in wheel.namelist()
+        if path.split('/', 1)[0].endswith('.dist-info')}
+    expected = canonicalize_name('{}-{}'.format(name, version))
+    for dist_info in dist_infos:
+        if canonicalize_name(dist_info[:-len('.dist-info')]) == expected:
+            return dist_info
+    raise RuntimeError('{} contains no {}-{}.dist-info directory'.format(
+        wheel.filename, name, version))
+
+
+def _parse_metadata(content):
+    metadata = {}
+    for line in content.splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            metadata[key.strip().lower()] = value.strip()
+    return metadata
+
+
+def _extract_member(wheel, info, destination, *, interpreter, is_script):
+    with wheel.open(info) as source:
+        content = source.read()
+    if is_script and re.match(rb'#!pythonw?(\s|$)', content):
+        # Scripts with a placeholder shebang use the bundled interpreter
+        content = '#!/usr/bin/env {}\n'.format(interpreter).encode() + \
+            content.partition(b'\n')[2]
+    record = _write_file(destination, content)
+    mode = (info.external_attr >> 16) & 0o777
+    if is_script or mode & 0o111:
+        os.chmod(destination, 0o755)
+    return record
+
+
+def _entry_point_scripts(content, scripts_dir, *, interpreter):
+    parser = configparser.ConfigParser(delimiters=('=',))
+    parser.optionxform = str
+    parser.read_string(content)
+    scripts = []
+    for section in ('console_scripts', 'gui_scripts'):
+        if not parser.has_section(section):
+            continue
+        for name, value in parser.items(section):
+            # Extras like [security] do not change the script
+            value = value.split('[', 1)[0].strip()
+            module, _, function = value.partition(':')
+            function = function.strip() or 'main'
+            script = _SCRIPT_TEMPLATE.format(
+                interpreter=interpreter, module=module.strip(),
+                import_name=function.split('.')[0], function=function)
+            scripts.append((os.path.join(scripts_dir, name), script))
+    return scripts
+
+
+def _write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.islink(path):
+        os.remove(path)
+    with open(path, 'wb') as f:
+        f.write(content)
+    digest = base64.urlsafe_b64encode(
+        hashlib.sha256(content).digest()).rstrip(b'=').decode()
+    return path, 'sha256=' + digest, len(content)
+
+
+def _write_record(record_path, records, lib_dir):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for path, digest, size in records:
+        writer.writerow([os.path.relpath(path, lib_dir), digest, size])
+    writer.writerow([os.path.relpath(record_path, lib_dir), '', ''])
+    with open(record_path, 'w') as f:
+        f.write(buffer.getvalue())
@@ -1,16 +1,45 @@
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import importlib.util
 import json
 import os
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
 
 from colcon_bundle.installer import BundleInstallerExtensionPoint
+from colcon_bundle.installer._apt_index import IndexCache
+from colcon_bundle.installer._deb import extract_deb
 from colcon_bundle.verb import logger
-from colcon_bundle.verb.utilities import get_ubuntu_distribution_version
+from colcon_bundle.verb.utilities import filechecksum, \
+    get_ubuntu_distribution_version, remove_empty_parents
 from colcon_core.plugin_system import satisfies_version
 
+DEB_EXTRACTOR_NATIVE = 'native'
+DEB_EXTRACTOR_DPKG = 'dpkg-deb'
+
+APT_RESOLVER_PYTHON_APT = 'python-apt'
+APT_RESOLVER_INDEX = 'index'
+
+_PYTHON3_APT_MISSING = """
+            Please install python3-apt in order to bundle your application
+
+            You can do this by executing `apt-get install python3-apt`.
+
+            If you are using a venv you will need to re-create it with the
+            '--system-site-packages' option in order to have access to the
+            library.
+
+            Alternatively pass `--apt-resolver index` to resolve the packages
+            without python3-apt.
+            """
+
 
 class PackageNotInCacheException(Exception):
     """The requested package was not found in the cache."""
@@ -22,6 +51,12 @@ class PackageNotInCacheException(Exception):
 class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
     """Extension to support apt package manager."""
 
+    DEPENDS_ON = ()
+
+    LOCK_ARGUMENTS = (
+        'apt_package_blacklist', 'apt_sources_list', 'apt_allow_insecure',
+        'apt_resolver')
+
     def __init__(self):  # noqa: D107
         self._cache = None
         self._cache_dir = None
@@ -30,6 +65,11 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
         self.allow_insecure = False
         self.sources_path = None
         self.metadata = {}
+        # Requested package names mapped to the requested version, they
+        # are marked together before installing
+        self._requested = OrderedDict()
+        # Names of the packages extracted by the last install()
+        self._extracted = []
         satisfies_version(
             BundleInstallerExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
 
@@ -67,6 +107,33 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
                  'Acquire::AllowDowngradeToInsecureRepositories to True. See '
                  'apt-secure(8) manpage for more information.'
         )
+        parser.add_argument(
+            '--apt-extract-workers', default=1, type=int,
+            help='Number of packages which are extracted concurrently '
+                 '(default: 1)')
+        parser.add_argument(
+            '--apt-deb-extractor', default=DEB_EXTRACTOR_NATIVE,
+            choices=[DEB_EXTRACTOR_NATIVE, DEB_EXTRACTOR_DPKG],
+            help='Extract packages in-process or by running dpkg-deb '
+                 '(default: {})'.format(DEB_EXTRACTOR_NATIVE))
+        parser.add_argument(
+            '--apt-source-workers', default=4, type=int,
+            help='Number of source packages fetched concurrently with '
+                 '--include-sources, while the binary packages are fetched '
+                 '(default: 4)')
+        parser.add_argument(
+            '--apt-update-ttl', default=0, type=int,
+            help='Number of seconds the package lists fetched for the same '
+                 'sources list are reused without running apt update, '
+                 '--upgrade always updates them (default: 0)')
+        parser.add_argument(
+            '--apt-resolver', default=APT_RESOLVER_PYTHON_APT,
+            choices=[APT_RESOLVER_PYTHON_APT, APT_RESOLVER_INDEX],
+            help='Resolve the packages to install with a python3-apt cache or '
+                 'with an index of the package lists which is reused across '
+                 'runs and does not require python3-apt, the index only '
+                 'follows Depends and Pre-Depends (default: {})'.format(
+                     APT_RESOLVER_PYTHON_APT))
 
     def should_load(self):  # noqa: D102
         """Determine if this plugin should load."""
@@ -76,18 +143,12 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
             # Not on ubuntu, shouldn't load
             return False
 
-        try:
-            import apt  # noqa: F401
-        except ImportError:
-            raise RuntimeError("""
-            Please install python3-apt in order to bundle your application
-
-            You can do this by executing `apt-get install python3-apt`.
-
-            If you are using a venv you will need to re-create it with the
-            '--system-site-packages' option in order to have access to the
-            library.
-            """)
+        # Only look for python3-apt, importing it is slow and not needed
+        # when the installers are not run
+        if sys.modules.get('apt') is None and \
+                importlib.util.find_spec('apt') is None and \
+                shutil.which('apt-get') is None:
+            raise RuntimeError(_PYTHON3_APT_MISSING)
         return True
 
     def initialize(self, context):  # noqa: D102
@@ -99,9 +160,50 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
         self.setup()
 
     def setup(self):  # noqa: D102
+        sources_list_file = os.path.join(self._cache_dir, 'etc', 'apt',
+                                         'sources.list')
+        os.makedirs(os.path.dirname(sources_list_file), exist_ok=True)
+
+        with open(self.context.args.apt_sources_list, 'r') as sources:
+            sources_content = sources.read()
+        with open(sources_list_file, 'w') as f:
+            f.write(sources_content)
+
+        if self.include_sources:
+            os.makedirs(self.sources_path, exist_ok=True)
+
+        if self.context.args.apt_resolver == APT_RESOLVER_INDEX:
+            self._cache = self._create_index_cache()
+        else:
+            self._cache = self._create_apt_cache()
+
+        update_stamp_path = os.path.join(self._cache_dir, 'update_stamp.json')
+        update_key = hashlib.sha256(json.dumps(
+            [sources_content, self.allow_insecure]).encode()).hexdigest()
+        if not self.context.args.upgrade and _package_lists_fresh(
+                update_stamp_path, update_key,
+                self.context.args.apt_update_ttl):
+            logger.info('Reusing package lists, skipping apt update')
+        else:
+            self._update_package_lists()
+            with open(update_stamp_path, 'w') as f:
+                f.write(json.dumps({'key': update_key, 'time': time.time()}))
+        self._cache.open()
+
+        # Workaround for pip-requirements not installing python-pip
+        self.add_to_install_list('python3-pip')
+
+        # Currently not available in Focal
+        if get_ubuntu_distribution_version() != 'focal':
+            self.add_to_install_list('python-pip')
+
+    def _create_apt_cache(self):
         # Importing apt here allows us to run
         # unit tests on OSX
-        import apt
+        try:
+            import apt
+        except ImportError:
+            raise RuntimeError(_PYTHON3_APT_MISSING)
 
         # Get config values before creating cache, as the cache changes
         # the global config values when initialized.
@@ -110,8 +212,8 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
 
         # Create cache after getting config values, the cache changes
         # global config values.
-        self._cache = apt.Cache(rootdir=self._cache_dir,
-                                progress=apt.progress.text.OpProgress())
+        cache = apt.Cache(rootdir=self._cache_dir,
+                          progress=apt.progress.text.OpProgress())
 
         # Always get config values before creating the cache.
         apt.apt_pkg.config.set('APT::Install-Recommends', 'False')
@@ -129,41 +231,74 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
                 'Acquire::AllowDowngradeToInsecureRepositories', 'True')
 
         apt.apt_pkg.config.clear('APT::Update::Post-Invoke-Success')
-
-        sources_list_file = os.path.join(self._cache_dir, 'etc', 'apt',
-                                         'sources.list')
-        os.makedirs(os.path.dirname(sources_list_file), exist_ok=True)
-
-        with open(sources_list_file, 'w') as f:
-            with open(self.context.args.apt_sources_list, 'r') as sources:
-                f.write(sources.read())
-
-        if self.include_sources:
-            os.makedirs(self.sources_path, exist_ok=True)
-
-        # We need to open and close the cache before calling update because
-        # of a bug
-        # if we don't do this then the update fails to pull anything from the
-        # remote repos
+        return cache
+
+    def _create_index_cache(self):
+        # apt-get only fetches the package lists and archives, the packages
+        # are resolved from an index of the lists
+        for path in (('var', 'lib', 'apt', 'lists', 'partial'),
+                     ('var', 'cache', 'apt', 'archives', 'partial'),
+                     ('var', 'lib', 'dpkg')):
+            os.makedirs(os.path.join(self._cache_dir, *path), exist_ok=True)
+        status_path = os.path.join(self._cache_dir, 'var', 'lib', 'dpkg',
+                                   'status')
+        if not os.path.exists(status_path):
+            open(status_path, 'w').close()
+        architecture = subprocess.check_output(
+            ['dpkg', '--print-architecture'],
+            universal_newlines=True).strip()
+        return IndexCache(
+            self._cache_dir, self._apt_get_args(), [architecture, 'all'])
+
+    def _apt_get_args(self):
+        """
+        Get the apt-get command line using the cache directory as its root.
+
+        :return: list of the command line arguments
+        """
+        status_path = os.path.join(self._cache_dir, 'var', 'lib', 'dpkg',
+                                   'status')
+        options = [
+            'Dir=' + self._cache_dir,
+            'Dir::State::status=' + status_path,
+            'Dir::Etc::Trusted=/etc/apt/trusted.gpg',
+            'Dir::Etc::TrustedParts=/etc/apt/trusted.gpg.d',
+            'Debug::NoLocking=1',
+            'APT::Sandbox::User=root',
+            'Acquire::BrokenProxy=true',
+            'Acquire::http::Pipeline-Depth=0',
+            'Acquire::http::No-Cache=true',
+            'Acquire::http::Retries=3',
+        ]
+        if self.allow_insecure:
+            options += [
+                'Acquire::AllowInsecureRepositories=True',
+                'Acquire::AllowDowngradeToInsecureRepositories=True',
+            ]
+        apt_get_args = ['apt-get', '-q']
+        for option in options:
+            apt_get_args += ['-o', option]
+        return apt_get_args
+
+    def _update_package_lists(self):
+        if isinstance(self._cache, IndexCache):
+            self._cache.update()
+            return
+        import apt
+        # We need to open and close the cache before calling update
+        # because of a bug
+        # if we don't do this then the update fails to pull anything
+        # from the remote repos
         self._cache.open()
         self._cache.close()
 
-        # Update the cache to the latest, we might not want to do this if the
-        # cache already exists?
         try:
             self._cache.update()
         except apt.cache.FetchFailedException as e:
-            logger.error('Could not fetch from repositories: {}'.format(e))
+            logger.error(
+                'Could not fetch from repositories: {}'.format(e))
             raise RuntimeError('Failed to fetch from repositories. Did '
                                'you set your keys correctly?')
-        self._cache.open()
-
-        # Workaround for pip-requirements not installing python-pip
-        self.add_to_install_list('python3-pip')
-
-        # Currently not available in Focal
-        if get_ubuntu_distribution_version() != 'focal':
-            self.add_to_install_list('python-pip')
 
     def _separate_version_information(self, package_name):
         if '=' not in package_name:
@@ -175,61 +310,127 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
         return self._cache[package_key] is not None
 
     def add_to_install_list(self, name, metadata=None):  # noqa: D102
-        logger.info('Adding {name} to install list'.format(name=name))
+        if self.context.locked_packages is not None:
+            # The locked packages already contain all dependencies
+            logger.debug('Using locked packages instead of {name}'.format(
+                name=name))
+            return
         package_key, version = self._separate_version_information(name)
+        if package_key in self._requested:
+            # Keep the first requested version unless only a later request
+            # specifies one
+            if version and not self._requested[package_key]:
+                self._requested[package_key] = version
+            elif version and version != self._requested[package_key]:
+                logger.warning(
+                    'Ignoring {name}, version {version} of {package_key} '
+                    'was requested before'.format(
+                        name=name, version=self._requested[package_key],
+                        package_key=package_key))
+            return
         if not self.is_package_available(package_key):
             logger.error('Package {package_key} is not in the package'
                          'cache.'.format(package_key=package_key))
             raise PackageNotInCacheException(name)
-
-        logger.info('Found these versions of {package_key}'
-                    .format(package_key=package_key))
-        logger.info(self._cache[package_key].versions)
-
-        package = self._cache[package_key]
-        # This will fallback to the latest version available
-        # if the specified version does not exist.
-        candidate = package.versions.get(version, package.candidate)
-        package.candidate = candidate
-        package.mark_install(auto_fix=False, from_user=False)
+        logger.info('Adding {name} to install list'.format(name=name))
+        self._requested[package_key] = version
+
+    def _mark_requested_packages(self):
+        """Mark all requested packages for installation in one pass."""
+        if not self._requested:
+            return
+        logger.info('Marking {count} requested packages for '
+                    'installation'.format(count=len(self._requested)))
+        packages = []
+        with self._cache.actiongroup():
+            for package_key, version in self._requested.items():
+                package = self._cache[package_key]
+                logger.debug('Found these versions of {package_key}: '
+                             '{versions}'.format(package_key=package_key,
+                                                 versions=package.versions))
+                # This will fallback to the latest version available
+                # if the specified version does not exist.
+                candidate = package.versions.get(version, package.candidate)
+                package.candidate = candidate
+                package.mark_install(auto_fix=False, from_user=False)
+                packages.append(package)
+            if self._cache.broken_count:
+                import apt
+                # Resolve the conflicts between the dependencies of all
+                # requested packages at once
+                resolver = apt.cache.ProblemResolver(self._cache)
+                for package in packages:
+                    resolver.protect(package)
+                resolver.resolve()
+        self._requested.clear()
+
+    def _mark_locked_packages(self):
+        with self._cache.actiongroup():
+            for name in self.context.locked_packages:
+                package_key, version = \
+                    self._separate_version_information(name)
+                if not self.is_package_available(package_key):
+                    raise PackageNotInCacheException(name)
+                package = self._cache[package_key]
+                candidate = package.versions.get(version)
+                if candidate is None:
+                    raise RuntimeError(
+                        'The locked version of {name} is not available, run '
+                        'without --locked to update bundle.lock'.format(
+                            name=name))
+                package.candidate = candidate
+                # Dependencies are not resolved, they are locked as well
+                package.mark_install(
+                    auto_fix=False, auto_inst=False, from_user=False)
 
     def remove_from_install_list(self, name, metadata=None):  # noqa: D102
         name, _ = self._separate_version_information(name)
+        self._requested.pop(name, None)
         package = self._cache[name]
         package.mark_delete(auto_fix=False)
 
     def _fetch_packages(self):  # noqa: D102
-        from apt.cache import FetchFailedException
-        from apt.package import FetchError
-        packages = []
+        packages = [package for package in self._cache
+                    if package.marked_install]
+        logger.info('Fetching packages: {packages}'.format(
+            packages=[package.name for package in packages]))
+        if not self.include_sources:
+            self._cache.fetch_archives()
+            return
+
+        # Binary packages built from the same source share it
+        sources = OrderedDict()
+        for package in packages:
+            version = package.candidate
+            key = '{}_{}'.format(version.source_name, version.source_version)
+            sources.setdefault(key, []).append(package)
+
+        source_cache_path = os.path.join(self._cache_dir, 'source_cache')
         source_fetch_failures = []
-        for package in self._cache:
-            if package.marked_install:
-                if self.include_sources:
-                    package_version = package.versions[0]
-                    try:
-                        package_version.fetch_source(
-                            destdir=self.sources_path, unpack=False)
-                    except ValueError:
-                        source_fetch_failures.append(package.name)
-                        logger.error('No sources available for {}'.format(
-                            package.name
-                        ))
-                    except FetchFailedException as e:
-                        source_fetch_failures.append(package.name)
-                        logger.error('Failed to fetch sources for {}'.format(
-                            package.name))
-                        logger.error(e)
-                    except FetchError as e:
-                        source_fetch_failures.append(package.name)
-                        logger.error('Failed to fetch sources for {}'.format(
-                            package.name
-                        ))
-                        logger.error(e)
-                packages.append(package.name)
-        logger.info('Fetching packages: {packages}'.format_map(locals()))
-        self._cache.fetch_archives()
-
+        # python-apt is not thread safe, the sources are fetched by apt-get
+        # processes while this thread fetches the binary packages
+        apt_get_args = self._apt_get_args()
+        with ThreadPoolExecutor(
+                max_workers=self.context.args.apt_source_workers) as executor:
+            futures = OrderedDict()
+            for key, source_packages in sources.items():
+                version = source_packages[0].candidate
+                futures[key] = executor.submit(
+                    _fetch_source, apt_get_args,
+                    '{}={}'.format(
+                        version.source_name, version.source_version),
+                    os.path.join(source_cache_path, key))
+            # The binary packages are fetched while the sources download
+            self._cache.fetch_archives()
+            for key, future in futures.items():
+                if not future.result():
+                    source_fetch_failures.extend(
+                        package.name for package in sources[key])
+
+        _link_sources(
+            source_cache_path,
+            [key for key, future in futures.items() if future.result()],
+            self.sources_path)
         if len(source_fetch_failures) > 0:
             self.metadata['missing_sources'] = source_fetch_failures
 
@@ -240,6 +441,15 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
         # here.
         with open(self.context.args.apt_package_blacklist, 'rt') as blacklist:
             blacklisted_packages = [line.rstrip('\n') for line in blacklist]
+        if isinstance(self._cache, IndexCache):
+            # The index also leaves out the dependencies which are only
+            # needed by blacklisted packages
+            self._cache.exclude(blacklisted_packages)
+
+        if self.context.locked_packages is not None:
+            self._mark_locked_packages()
+        else:
+            self._mark_requested_packages()
 
         for package_name in blacklisted_packages:
             try:
@@ -247,42 +457,76 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
             except KeyError:
                 pass
 
-        # Check for differences
-        installed_cache_path = os.path.join(self._cache_dir, 'installed.json')
-        if os.path.isfile(installed_cache_path):
-            with open(installed_cache_path, 'r') as f:
-                installed = set(json.loads(f.read()))
-        else:
-            installed = set()
-
-        to_install = {package for package in self._cache
+        # Check for differences with the packages extracted by earlier runs
+        manifests_path = os.path.join(self._cache_dir, 'package_manifests')
+        manifests = _load_package_manifests(manifests_path)
+        to_install = {package.name: package for package in self._cache
                       if package.marked_install}
-        intersection = installed.intersection(to_install)
-        if len(intersection) == len(to_install) and len(intersection) == len(
-                installed):
+        removed = [
+            manifest for name, manifest in sorted(manifests.items())
+            if name not in to_install or
+            manifest['version'] != to_install[name].candidate.version]
+        removed_names = {manifest['name'] for manifest in removed}
+        added = [
+            package for name, package in sorted(to_install.items())
+            if name not in manifests or name in removed_names]
+        if not removed and not added:
             return False
         else:
             logger.info('The install list of the bundle has changed...')
 
-        self._fetch_packages()
-
         deb_cache = os.path.join(
             self._cache_dir, 'var', 'cache', 'apt', 'archives')
-        pkgs_abs_path = glob.glob(os.path.join(deb_cache, '*.deb'))
+        new_pkgs = {
+            os.path.join(deb_cache, _deb_file_name(package)): package
+            for package in added}
+        shared_cache = self.context.shared_cache
+        if shared_cache is not None:
+            # Archives in the shared cache are not downloaded again
+            os.makedirs(deb_cache, exist_ok=True)
+            for pkg, package in new_pkgs.items():
+                if not os.path.isfile(pkg) and package.candidate.sha256:
+                    shared_cache.link(package.candidate.sha256, pkg)
+
+        self._fetch_packages()
+
+        kept = [manifest for name, manifest in manifests.items()
+                if name not in removed_names]
+        _remove_package_files(self.context.prefix_path, removed, kept)
+        for manifest in removed:
+            os.remove(_package_manifest_path(manifests_path, manifest['name']))
+
         print('Extracting apt packages...')
-        for pkg in pkgs_abs_path:
-            if os.path.basename(pkg) not in installed:
-                try:
-                    logger.info('Installing {package}'.format(package=pkg))
-                    subprocess.check_call(
-                        ['dpkg-deb', '--extract', pkg,
-                         self.context.prefix_path])
-                    installed.add(os.path.basename(pkg))
-                except subprocess.CalledProcessError:
-                    raise RuntimeError()
-
-        with open(installed_cache_path, 'w') as f:
-            f.write(json.dumps(list(installed)))
+        for pkg, package in new_pkgs.items():
+            if not os.path.isfile(pkg):
+                raise RuntimeError(
+                    'Package archive {} was not fetched'.format(pkg))
+            if shared_cache is not None:
+                shared_cache.add(pkg, sha256=package.candidate.sha256 or None)
+        workers = self.context.args.apt_extract_workers
+        extractor = self.context.args.apt_deb_extractor
+        if workers > 1:
+            contributed = _extract_debs_concurrently(
+                sorted(new_pkgs), self.context.prefix_path, workers,
+                extractor=extractor)
+        else:
+            contributed = {
+                pkg: _extract_deb(
+                    pkg, self.context.prefix_path, extractor=extractor)
+                for pkg in sorted(new_pkgs)}
+
+        os.makedirs(manifests_path, exist_ok=True)
+        for pkg, package in new_pkgs.items():
+            # The hashes are updated by finalize() once the files were
+            # rewritten for the bundle
+            _write_package_manifest(manifests_path, {
+                'name': package.name,
+                'version': package.candidate.version,
+                'deb': os.path.basename(pkg),
+                'files': _hash_files(
+                    self.context.prefix_path, contributed[pkg]),
+            })
+        self._extracted = sorted(package.name for package in added)
 
         installed_packages_metadata = []
         for package in self._cache:
@@ -296,3 +540,302 @@ class AptBundleInstallerExtension(BundleInstallerExtensionPoint):
         self.metadata['installed_packages'] = installed_packages_metadata
 
         return self.metadata
+
+    def get_locked_packages(self):  # noqa: D102
+        return sorted(
+            '{}={}'.format(package.name, package.candidate.version)
+            for package in self._cache if package.marked_install)
+
+    def finalize(self):  # noqa: D102
+        # Hash the files of the extracted packages again after their
+        # shebangs were rewritten, otherwise the rewritten files would count
+        # as modified and were never removed
+        manifests_path = os.path.join(self._cache_dir, 'package_manifests')
+        manifests = _load_package_manifests(manifests_path)
+        for name in self._extracted:
+            manifest = manifests[name]
+            manifest['files'] = _hash_files(
+                self.context.prefix_path, manifest['files'])
+            _write_package_manifest(manifests_path, manifest)
+        self._extracted = []
+
+
+def _package_lists_fresh(update_stamp_path, update_key, ttl):
+    """
+    Check if the package lists of an earlier apt update can be reused.
+
+    :param update_stamp_path: path of the file recording the last update
+    :param update_key: hash of the sources the lists have to be fetched from
+    :param ttl: number of seconds the lists are reused
+    :return: True if the lists were fetched for the same sources less than
+    ttl seconds ago
+    """
+    if ttl <= 0 or not os.path.isfile(update_stamp_path):
+        return False
+    with open(update_stamp_path, 'r') as f:
+        stamp = json.loads(f.read())
+    if stamp.get('key') != update_key:
+        return False
+    return 0 <= time.time() - stamp.get('time', 0) < ttl
+
+
+def _fetch_source(apt_get_args, source, destination):
+    """
+    Fetch a source package once.
+
+    :param apt_get_args: apt-get command line using the cache directory
+    :param source: name and version of the source package as name=version
+    :param destination: directory the source files are stored in, it is
+    only created once all files were fetched
+    :return: True if the source is available in destination
+    """
+    if os.path.isdir(destination):
+        return True
+    partial_path = destination + '.partial'
+    if os.path.exists(partial_path):
+        shutil.rmtree(partial_path)
+    os.makedirs(partial_path)
+    try:
+        subprocess.check_call(
+            apt_get_args + ['source', '--download-only', source],
+            cwd=partial_path)
+    except subprocess.CalledProcessError as e:
+        logger.error('Failed to fetch sources for {}'.format(source))
+        logger.error(e)
+        return False
+    os.replace(partial_path, destination)
+    return True
+
+
+def _link_sources(source_cache_path, keys, sources_path):
+    """
+    Fill the sources directory with the sources of the installed packages.
+
+    :param source_cache_path: directory with one directory of source files
+    per source package and version
+    :param keys: names of the directories of the installed packages
+    :param sources_path: directory which is recreated with links to the
+    source files
+    """
+    if os.path.exists(sources_path):
+        shutil.rmtree(sources_path)
+    os.makedirs(sources_path)
+    for key in keys:
+        source_path = os.path.join(source_cache_path, key)
+        for file_name in os.listdir(source_path):
+            destination = os.path.join(sources_path, file_name)
+            if not os.path.exists(destination):
+                os.link(os.path.join(source_path, file_name), destination)
+
+
+def _deb_file_name(package):
+    """
+    Get the name apt gives to the downloaded archive of a package.
+
+    :param package: the apt.Package to install
+    :return: the file name of the .deb in the archives directory
+    """
+    candidate = package.candidate
+    # apt escapes the colon of an epoch in the file name
+    return '{}_{}_{}.deb'.format(
+        package.shortname, candidate.version.replace(':', '%3a'),
+        candidate.architecture)
+
+
+def _package_manifest_path(manifests_path, name):
+    return os.path.join(manifests_path, name + '.json')
+
+
+def _write_package_manifest(manifests_path, manifest):
+    with open(_package_manifest_path(manifests_path, manifest['name']),
+              'w') as f:
+        f.write(json.dumps(manifest, sort_keys=True))
+
+
+def _load_package_manifests(manifests_path):
+    """
+    Load the manifests of the packages extracted by earlier runs.
+
+    :param manifests_path: directory containing one json file per package
+    :return: dictionary mapping package names to their manifest
+    """
+    manifests = {}
+    if not os.path.isdir(manifests_path):
+        return manifests
+    for file_name in os.listdir(manifests_path):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(manifests_path, file_name), 'r') as f:
+            manifest = json.loads(f.read())
+        manifests[manifest['name']] = manifest
+    return manifests
+
+
+def _hash_files(prefix, files):
+    """
+    Hash the files a package contributed.
+
+    :param prefix: directory the package was extracted to
+    :param files: paths of the files relative to prefix
+    :return: dictionary mapping each path to the sha256 of the file, or
+    None for symlinks
+    """
+    hashes = {}
+    for rel_path in files:
+        path = os.path.join(prefix, rel_path)
+        if os.path.islink(path) or not os.path.isfile(path):
+            hashes[rel_path] = None
+        else:
+            hashes[rel_path] = filechecksum(path)
+    return hashes
+
+
+def _remove_package_files(prefix, removed, kept):
+    """
+    Delete the files of removed packages which no other package contains.
+
+    Files whose content changed since they were extracted are left in place.
+    Directories which become empty are removed as well.
+
+    :param prefix: directory the packages were extracted to
+    :param removed: manifests of the packages to remove
+    :param kept: manifests of the packages which stay installed
+    """
+    kept_files = set()
+    for manifest in kept:
+        kept_files.update(manifest['files'])
+    for manifest in removed:
+        logger.info('Removing {name} {version}'.format_map(manifest))
+        for rel_path, sha256 in sorted(manifest['files'].items()):
+            if rel_path in kept_files:
+                continue
+            path = os.path.join(prefix, rel_path)
+            if not os.path.lexists(path):
+                continue
+            if sha256 is not None and (
+                    os.path.islink(path) or filechecksum(path) != sha256):
+                logger.warning(
+                    'Not removing {path} of {name}, it was modified'.format(
+                        path=path, name=manifest['name']))
+                continue
+            os.remove(path)
+            remove_empty_parents(prefix, os.path.dirname(path))
+
+
+def _extract_deb(deb_path, destination, *, extractor=DEB_EXTRACTOR_NATIVE):
+    """
+    Extract the files of a .deb package.
+
+    :param deb_path: path of the .deb file
+    :param destination: directory the files are extracted to
+    :param extractor: DEB_EXTRACTOR_NATIVE to extract the package in this
+    process, DEB_EXTRACTOR_DPKG to run dpkg-deb
+    :return: list of the paths of the extracted files, relative to
+    destination
+    """
+    logger.info('Installing {package}'.format(package=deb_path))
+    if extractor == DEB_EXTRACTOR_NATIVE:
+        return extract_deb(deb_path, destination)
+    try:
+        output = subprocess.check_output(
+            ['dpkg-deb', '--vextract', deb_path, destination])
+    except subprocess.CalledProcessError:
+        raise RuntimeError()
+    # Directories are listed with a trailing slash
+    return [os.path.normpath(line)
+            for line in output.decode().splitlines()
+            if line and not line.endswith('/')]
+
+
+def _extract_debs_concurrently(deb_paths, destination, workers, *,
+                               extractor=DEB_EXTRACTOR_NATIVE):
+    """
+    Extract .deb packages in parallel with the result of a serial extraction.
+
+    Each package is extracted into its own temporary directory by a pool of
+    workers. The directories are then merged into destination in the order
+    of deb_paths, so a file contained in multiple packages is taken from the
+    last one, like when extracting them one after another.
+
+    :param deb_paths: paths of the .deb files in the order to apply them
+    :param destination: directory the files are extracted to
+    :param workers: number of packages extracted at the same time
+    :param extractor: how to extract each package, see _extract_deb
+    :return: dictionary mapping each .deb path to the paths of the files it
+    contributed, relative to destination
+    """
+    os.makedirs(destination, exist_ok=True)
+    # The temporary directories are on the same filesystem as destination
+    # so their files can be moved instead of copied
+    extract_base = tempfile.mkdtemp(
+        prefix='.apt_extract_', dir=os.path.dirname(
+            os.path.abspath(destination)))
+    try:
+        extract_paths = [
+            os.path.join(extract_base, str(number))
+            for number in range(len(deb_paths))]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # dpkg-deb runs in its own process and the native extractor
+            # releases the GIL while decompressing, so threads are sufficient
+            for future in [
+                    executor.submit(_extract_deb, deb_path, extract_path,
+                                    extractor=extractor)
+                    for deb_path, extract_path
+                    in zip(deb_paths, extract_paths)]:
+                future.result()
+
+        owners = {}
+        contributed = {}
+        for deb_path, extract_path in zip(deb_paths, extract_paths):
+            contributed[deb_path] = _merge_extracted_files(
+                extract_path, destination, deb_path, owners)
+        return contributed
+    finally:
+        shutil.rmtree(extract_base, ignore_errors=True)
+
+
+def _merge_extracted_files(source, destination, deb_path, owners):
+    """
+    Move the files extracted from a package into destination.
+
+    :param source: directory the package was extracted to
+    :param destination: directory to move the files to
+    :param deb_path: path of the .deb file, used to report conflicts
+    :param owners: dictionary mapping the relative paths of files which were
+    already merged to the .deb they came from, updated with the new files
+    :return: list of the relative paths of the merged files
+    """
+    merged = []
+    directories = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        rel_root = os.path.relpath(root, source)
+        for name in dirs:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(destination, rel_root, name)
+            if os.path.islink(src_path):
+                files.append(name)
+                continue
+            if os.path.islink(dst_path) or (
+                    os.path.lexists(dst_path) and
+                    not os.path.isdir(dst_path)):
+                os.remove(dst_path)
+            os.makedirs(dst_path, exist_ok=True)
+            directories.append((src_path, dst_path))
+        for name in sorted(files):
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            dst_path = os.path.join(destination, rel_path)
+            if rel_path in owners:
+                logger.warning(
+                    '{rel_path} of {deb_path} overwrites the file extracted '
+                    'from {owner}'.format(
+                        owner=owners[rel_path], **locals()))
+            if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                shutil.rmtree(dst_path)
+            os.replace(os.path.join(root, name), dst_path)
+            owners[rel_path] = deb_path
+            merged.append(rel_path)
+    # Apply the permissions of the directories after their content
+    for src_path, dst_path in reversed(directories):
+        shutil.copystat(src_path, dst_path)
+    return merged
@@ -1,12 +1,29 @@
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+from concurrent.futures import ThreadPoolExecutor
+import glob
 import json
 import os
+import shutil
 import subprocess
 
 from colcon_bundle.installer import BundleInstallerExtensionPoint
+from colcon_bundle.installer._dist_metadata import collect_distributions, \
+    EXCLUDED_DISTRIBUTIONS, site_packages_paths
+from colcon_bundle.installer._wheel_installer import get_install_scheme, \
+    install_wheels
 from colcon_bundle.verb import logger
+from colcon_bundle.verb.utilities import filechecksum
+
+INSTALL_BACKEND_PIP = 'pip'
+INSTALL_BACKEND_WHEEL = 'wheel'
+
+# Commands run with the pip of the bundled interpreter before installing
+BOOTSTRAP_COMMANDS = (
+    ('-U', 'pip==20.*', 'setuptools==44.0.0'),
+    ('-U', 'pip'),
+)
 
 
 class BasePipInstallerExtensionPoint(BundleInstallerExtensionPoint):
@@ -17,17 +34,28 @@ class BasePipInstallerExtensionPoint(BundleInstallerExtensionPoint):
         '_packages',
         '_cache_path',
         '_python_path',
-        '_pip_args'
+        '_pip_args',
+        '_install_backend',
+        '_metadata'
     )
 
     PRIORITY = 10
 
+    # The interpreters are installed by apt
+    DEPENDS_ON = ('apt',)
+
+    # The pip installers run concurrently, but both write scripts to
+    # /usr/local/bin
+    PREFIX_WRITE_PHASES = ('bootstrap', 'install')
+
     def __init__(self):  # noqa: D107
         self.context = None
         self._packages = []
         self._cache_path = None
         self._python_path = None
         self._pip_args = None
+        self._install_backend = INSTALL_BACKEND_PIP
+        self._metadata = None
         self.additional_requirements = None
 
     def initialize(self, context):  # noqa: D102
@@ -51,18 +79,24 @@ class BasePipInstallerExtensionPoint(BundleInstallerExtensionPoint):
         return self.additional_requirements is not None
 
     def install(self):  # noqa: D102
-        if len(self._packages) == 0 and self.additional_requirements is None:
+        locked = self.context.locked_packages is not None
+        if locked:
+            # Exactly the locked packages are installed
+            self._packages = list(self.context.locked_packages)
+        if len(self._packages) == 0 and (
+                locked or self.additional_requirements is None):
             logger.info('No dependencies to install for {}'.format(
                 os.path.basename(self._python_path)
             ))
-            return {'installed_packages': []}
+            self._metadata = {'installed_packages': []}
+            return self._metadata
 
         logger.info('Installing pip dependencies...')
 
         requirements_file = os.path.join(self._cache_path, 'requirements')
         metadata_file = os.path.join(self._cache_path, 'metadata')
 
-        if self.additional_requirements is not None:
+        if not locked and self.additional_requirements is not None:
             logger.info('Installing additional Python requirements from'
                         '{req} into {path}'
                         .format(req=self.additional_requirements,
@@ -78,61 +112,235 @@ class BasePipInstallerExtensionPoint(BundleInstallerExtensionPoint):
                     logger.info(
                         'No changes detected for {}'.format(self._python_path))
                     with open(metadata_file, 'r') as f:
-                        metadata = json.load(f)
-                        return metadata
+                        self._metadata = json.load(f)
+                        return self._metadata
 
         python_pip_args = [self._python_path, '-m', 'pip']
-        pip_install_args = python_pip_args + ['install']
-        subprocess.check_call(
-            pip_install_args + ['-U', 'pip==20.*', 'setuptools==44.0.0'])
-        subprocess.check_call(
-            pip_install_args + ['-U', 'pip'])
+        with self.context.prefix_writes('bootstrap'):
+            self._bootstrap(python_pip_args)
 
         with open(requirements_file, 'w') as req:
             for name in self._packages:
                 req.write(name.strip() + '\n')
 
         pip_args = []
-        pip_args += pip_install_args
         pip_args += (self._pip_args or [])
         pip_args += ['--default-timeout=100']
-        pip_args += ['--ignore-installed', '-r', requirements_file]
-        subprocess.check_call(pip_args)
-
-        # https://pip.pypa.io/en/stable/reference/pip_download/
-        if self.context.args.include_sources:
-            sources_path = os.path.join(self._cache_path, 'sources')
-            download_args = python_pip_args + [
-                'download', '--no-binary', ':all',
-                '-d', sources_path, '-r', requirements_file]
-            subprocess.check_call(download_args)
-
-        metadata = self._generate_metadata(python_pip_args)
+        if locked:
+            # The locked packages include all dependencies, packages which
+            # are already installed in the same version are kept
+            pip_args += ['--no-deps']
+        pip_args += ['-r', requirements_file]
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            download = None
+            # https://pip.pypa.io/en/stable/reference/pip_download/
+            if self.context.args.include_sources:
+                # The sources are downloaded while the packages are
+                # installed, sdists which are already in sources_path are
+                # not downloaded again
+                sources_path = os.path.join(self._cache_path, 'sources')
+                download_args = python_pip_args + [
+                    'download', '--no-binary', ':all:',
+                    '-d', sources_path, '-r', requirements_file]
+                download = executor.submit(
+                    subprocess.check_call, download_args)
+            self._install_from_wheelhouse(
+                python_pip_args, pip_args, locked=locked)
+            if download is not None:
+                download.result()
+
+        self._metadata = self._generate_metadata()
         with open(metadata_file, 'w') as f:
-            json.dump(metadata, f)
-        return metadata
+            json.dump(self._metadata, f)
+        return self._metadata
 
-    def _generate_metadata(self, python_pip_args):
-        pip_freeze_args = python_pip_args + ['freeze']
+    def _bootstrap(self, python_pip_args):
+        """
+        Install the pip and setuptools versions used by the installer.
 
-        freeze_output = subprocess.check_output(
-            pip_freeze_args, universal_newlines=True)
+        The bootstrap is skipped if it ran before and the installed
+        distributions of pip and setuptools did not change since, e.g. by
+        apt extracting python3-pip again.
 
-        installed = list(map(
-            self.split_package_version,
-            filter(lambda s: s != '', freeze_output.split('\n'))))
-        return {'installed_packages': installed}
+        :param python_pip_args: command line invoking pip
+        """
+        stamp_path = os.path.join(self._cache_path, 'bootstrap.json')
+        commands = [list(command) for command in BOOTSTRAP_COMMANDS]
+        if os.path.exists(stamp_path):
+            with open(stamp_path, 'r') as f:
+                stamp = json.load(f)
+            if stamp.get('commands') == commands and \
+                    stamp.get('distributions') == \
+                    self._bootstrap_distributions():
+                logger.info('pip and setuptools are up to date for {}'.format(
+                    self._python_path))
+                return
+        for command in commands:
+            subprocess.check_call(python_pip_args + ['install'] + command)
+        with open(stamp_path, 'w') as f:
+            json.dump({
+                'commands': commands,
+                'distributions': self._bootstrap_distributions(),
+            }, f)
+
+    def _bootstrap_distributions(self):
+        """
+        Get the installed pip and setuptools distributions.
+
+        :return: dictionary mapping the metadata directories of the
+        distributions relative to the prefix to their modification time
+        """
+        python_version = os.path.basename(
+            os.path.realpath(self._python_path))
+        distributions = {}
+        for site_packages_path in site_packages_paths(
+                self.context.prefix_path, python_version):
+            for name in ('pip', 'setuptools'):
+                pattern = os.path.join(site_packages_path, name + '-*-info')
+                for path in glob.glob(pattern):
+                    distributions[os.path.relpath(
+                        path, self.context.prefix_path)] = \
+                        os.stat(path).st_mtime_ns
+        return distributions
+
+    def _wheelhouse_path(self):
+        # Wheels built for one Python version are not mixed with wheels
+        # for another one, e.g. after changing the distribution
+        return os.path.join(
+            self._cache_path, 'wheelhouse',
+            os.path.basename(os.path.realpath(self._python_path)))
+
+    def _wheel_namespace(self):
+        # Wheels built against the prefix of one interpreter build are not
+        # shared with bundles using another one
+        python_path = os.path.realpath(self._python_path)
+        return 'wheels-{version}-{checksum}'.format(
+            version=os.path.basename(python_path),
+            checksum=filechecksum(python_path)[:16])
 
-    @staticmethod
-    def split_package_version(package_version):
-        """Split package==3.2.3 pip freeze output."""
-        split_string = package_version.split('==')
-        # TODO: This shouldn't be necessary if we fix #40 since we
-        # should never install packages as editable
-        if len(split_string) < 2 and '-e' in package_version:
-            # Package is installed with --editable flag, and formatted
-            # differently. Does not have a version number.
-            # format: -e git+https://<repo>@<commit_hash>#egg=<package_name>.
-            split_string = package_version.split('=')
-            return {'name': split_string[1]}
-        return {'name': split_string[0], 'version': split_string[1]}
+    def _install_from_wheelhouse(self, python_pip_args, pip_args, *, locked):
+        """
+        Install the requirements from the wheels of earlier runs.
+
+        Only wheels which are missing in the wheelhouse are built or
+        downloaded, so unchanged requirements are installed without
+        accessing the network or building any sdist again. With --upgrade
+        the newest versions are resolved from the package index instead.
+        The wheels are resolved and built before writing to the prefix.
+        With the wheel backend they are unpacked concurrently instead of
+        being installed by pip. With a shared cache the wheels of other
+        bundles are linked into the wheelhouse first.
+
+        :param python_pip_args: command line invoking pip
+        :param pip_args: pip arguments selecting the requirements
+        :param locked: True if the requirements are locked packages
+        """
+        wheelhouse_path = self._wheelhouse_path()
+        os.makedirs(wheelhouse_path, exist_ok=True)
+        if self.context.shared_cache is not None:
+            self.context.shared_cache.link_named(
+                self._wheel_namespace(), wheelhouse_path)
+        install_args = python_pip_args + ['install']
+        if not locked:
+            install_args += ['--ignore-installed']
+        # The requirements are resolved without writing to the prefix, so
+        # other installers can write to it meanwhile
+        resolved_path = os.path.join(self._cache_path, 'resolved_wheels')
+        resolve_args = python_pip_args + [
+            'wheel', '--wheel-dir', resolved_path,
+            '--no-index', '--find-links', wheelhouse_path] + pip_args
+
+        def resolve():
+            if os.path.exists(resolved_path):
+                shutil.rmtree(resolved_path)
+            subprocess.check_call(resolve_args)
+
+        # pip overwrites existing wheels in place, which would modify the
+        # objects of the shared cache linked into the wheelhouse
+        built_path = os.path.join(self._cache_path, 'built_wheels')
+        wheel_args = python_pip_args + ['wheel', '--wheel-dir', built_path]
+        if self.context.args.upgrade:
+            # The wheels of earlier runs would satisfy the requirements
+            # without looking for newer versions
+            logger.info('Building the newest wheels in {}'.format(
+                wheelhouse_path))
+            missing_wheels = True
+        else:
+            wheel_args += ['--find-links', wheelhouse_path]
+            try:
+                resolve()
+                missing_wheels = False
+            except subprocess.CalledProcessError:
+                logger.info('Building missing wheels in {}'.format(
+                    wheelhouse_path))
+                missing_wheels = True
+        if missing_wheels:
+            if os.path.exists(built_path):
+                shutil.rmtree(built_path)
+            try:
+                subprocess.check_call(wheel_args + pip_args)
+            except subprocess.CalledProcessError:
+                # Some legacy sdists can only be installed but not be built
+                logger.warning(
+                    'Failed to build wheels, installing from the package '
+                    'index')
+                with self.context.prefix_writes('install'):
+                    subprocess.check_call(install_args + pip_args)
+                return
+            self._add_to_wheelhouse(built_path, wheelhouse_path)
+            resolve()
+
+        with self.context.prefix_writes('install'):
+            if self._install_backend == INSTALL_BACKEND_WHEEL:
+                python_version = os.path.basename(
+                    os.path.realpath(self._python_path))
+                install_wheels(
+                    sorted(glob.glob(os.path.join(resolved_path, '*.whl'))),
+                    get_install_scheme(
+                        self.context.prefix_path, python_version),
+                    interpreter=os.path.basename(self._python_path))
+            else:
+                subprocess.check_call(
+                    install_args + [
+                        '--no-index', '--find-links', wheelhouse_path] +
+                    pip_args)
+        shutil.rmtree(resolved_path, ignore_errors=True)
+
+    def _add_to_wheelhouse(self, built_path, wheelhouse_path):
+        """
+        Move the wheels built or downloaded by pip into the wheelhouse.
+
+        Wheels already in the wheelhouse are kept, new wheels are added to
+        the shared cache if one is used.
+
+        :param built_path: directory pip wrote the wheels to
+        :param wheelhouse_path: directory of the wheelhouse
+        """
+        for path in sorted(glob.glob(os.path.join(built_path, '*.whl'))):
+            destination = os.path.join(
+                wheelhouse_path, os.path.basename(path))
+            if os.path.exists(destination):
+                continue
+            if self.context.shared_cache is not None:
+                self.context.shared_cache.add_named(
+                    self._wheel_namespace(), path)
+            os.replace(path, destination)
+        shutil.rmtree(built_path, ignore_errors=True)
+
+    def get_locked_packages(self):  # noqa: D102
+        if self._metadata is None:
+            return []
+        # Editable packages have no version and can not be pinned
+        return sorted(
+            '{name}=={version}'.format_map(package)
+            for package in self._metadata['installed_packages']
+            if 'version' in package)
+
+    def _generate_metadata(self):
+        python_version = os.path.basename(
+            os.path.realpath(self._python_path))
+        installed = collect_distributions(
+            site_packages_paths(self.context.prefix_path, python_version),
+            stats=True, exclude=EXCLUDED_DISTRIBUTIONS)
+        return {'installed_packages': installed}
@@ -4,12 +4,14 @@
 import os
 
 from colcon_bundle.installer.base_pip_installer import \
-    BasePipInstallerExtensionPoint
+    BasePipInstallerExtensionPoint, INSTALL_BACKEND_PIP, INSTALL_BACKEND_WHEEL
 
 
 class PipBundleInstallerExtensionPoint(BasePipInstallerExtensionPoint):
     """Python 2 pip installer."""
 
+    LOCK_ARGUMENTS = ('pip_args', 'pip_requirements')
+
     def add_arguments(self, *, parser):  # noqa: D102
         parser.add_argument(
             '--pip-args',
@@ -21,6 +23,12 @@ class PipBundleInstallerExtensionPoint(BasePipInstallerExtensionPoint):
             '--pip-requirements', type=str, default=None,
             help='Path to a requirements.txt. All packages in the file'
                  'will be installed into Python2 in the bundle')
+        parser.add_argument(
+            '--pip-install-backend', default=INSTALL_BACKEND_PIP,
+            choices=[INSTALL_BACKEND_PIP, INSTALL_BACKEND_WHEEL],
+            help='Install the resolved wheels with pip or unpack them '
+                 'concurrently without running pip '
+                 '(default: {})'.format(INSTALL_BACKEND_PIP))
 
     def initialize(self, context):  # noqa: D102
         super().initialize(context)
@@ -28,3 +36,4 @@ class PipBundleInstallerExtensionPoint(BasePipInstallerExtensionPoint):
             self.context.prefix_path, 'usr', 'bin', 'python2')
         self._pip_args = self.context.args.pip_args
         self.additional_requirements = self.context.args.pip_requirements
+        self._install_backend = self.context.args.pip_install_backend
@@ -4,12 +4,14 @@
 import os
 
 from colcon_bundle.installer.base_pip_installer import \
-    BasePipInstallerExtensionPoint
+    BasePipInstallerExtensionPoint, INSTALL_BACKEND_PIP, INSTALL_BACKEND_WHEEL
 
 
 class Pip3BundleInstallerExtensionPoint(BasePipInstallerExtensionPoint):
     """Python 3 pip installer."""
 
+    LOCK_ARGUMENTS = ('pip3_args', 'pip3_requirements')
+
     def add_arguments(self, *, parser):  # noqa: D102
         parser.add_argument(
             '--pip3-args',
@@ -21,6 +23,12 @@ class Pip3BundleInstallerExtensionPoint(BasePipInstallerExtensionPoint):
             '--pip3-requirements', type=str, default=None,
             help='Path to a requirements.txt. All packages in the file'
                  'will be installed into Python3 in the bundle')
+        parser.add_argument(
+            '--pip3-install-backend', default=INSTALL_BACKEND_PIP,
+            choices=[INSTALL_BACKEND_PIP, INSTALL_BACKEND_WHEEL],
+            help='Install the resolved wheels with pip or unpack them '
+                 'concurrently without running pip '
+                 '(default: {})'.format(INSTALL_BACKEND_PIP))
 
     def initialize(self, context):  # noqa: D102
         super().initialize(context)
@@ -28,3 +36,4 @@ class Pip3BundleInstallerExtensionPoint(BasePipInstallerExtensionPoint):
             self.context.prefix_path, 'usr', 'bin', 'python3')
         self._pip_args = self.context.args.pip3_args
         self.additional_requirements = self.context.args.pip3_requirements
+        self._install_backend = self.context.args.pip3_install_backend
@@ -23,6 +23,7 @@ class PythonBundleTask(TaskExtensionPoint):
             'Bundling python package in "{self.context.pkg.path}" with build '
             'type "python"'.format_map(locals()))
 
+        has_pip_dependencies = False
         for dependency in self.context.pkg.dependencies['run']:
             if not isinstance(dependency, DependencyDescriptor):
                 continue
@@ -59,7 +60,9 @@ class PythonBundleTask(TaskExtensionPoint):
                 pip.add_to_install_list(
                     dependency.name
                 )
+            has_pip_dependencies = True
 
+        if has_pip_dependencies:
             # TODO: The Pip managers should be doing this
             apt = args.installers['apt']
             apt.add_to_install_list('libpython3-dev')
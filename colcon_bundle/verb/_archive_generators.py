@@ -1,3 +1,4 @@
+import gzip
 import os
 import shutil
 import tarfile
@@ -5,13 +6,18 @@ from typing import List
 
 from colcon_bundle.verb import logger
 from colcon_bundle.verb._dependency_utilities import update_dependencies_cache
+from colcon_bundle.verb._overlay_codecs import DEFAULT_OVERLAY_CODEC
 from colcon_bundle.verb._overlay_utilities import \
-    create_dependencies_overlay, create_workspace_overlay
+    create_dependencies_overlay, create_package_overlay, \
+    create_workspace_overlay, get_source_date_epoch, overlay_options, \
+    read_overlay_info, reproducible_filter, write_overlay_info
 from colcon_bundle.verb._path_context import PathContext
 from colcon_bundle.verb.bundlefile import Bundle
+from colcon_bundle.verb.utilities import directory_fingerprint
 
 
-def generate_archive_v1(path_context):
+def generate_archive_v1(path_context, *, reproducible=False,
+                        stream_workspace=False):
     """
     Generate bundle archive.
 
@@ -21,6 +27,10 @@ def generate_archive_v1(path_context):
     |- bundle.tar
 
     :param path_context: PathContext object including path configurations
+    :param reproducible: Whether to normalize the archives so the same
+    inputs always give the same bundle
+    :param stream_workspace: Whether to add the install directory to the
+    bundle directly instead of copying it into the staging directory first
     """
     # install_base: Directory with built artifacts from the workspace
     install_base = path_context.install_base()
@@ -37,7 +47,11 @@ def generate_archive_v1(path_context):
         staging_path, 'opt', 'install')
     if os.path.exists(bundle_workspace_install_path):
         shutil.rmtree(bundle_workspace_install_path)
-    shutil.copytree(install_base, bundle_workspace_install_path)
+    additional_paths = []
+    if stream_workspace:
+        additional_paths.append((install_base, 'opt/install'))
+    else:
+        shutil.copytree(install_base, bundle_workspace_install_path)
 
     logger.info('Archiving the bundle output')
     print('Creating bundle archive...')
@@ -46,27 +60,40 @@ def generate_archive_v1(path_context):
     metadata_tar_path = path_context.metadata_tar_path()
     archive_tar_gz_path = path_context.bundle_v1_output_path()
 
+    tarinfo_filter = None
+    if reproducible:
+        tarinfo_filter = reproducible_filter(get_source_date_epoch())
+
     with tarfile.open(metadata_tar_path, 'w') as archive:
         archive.add(path_context.installer_metadata_path(),
-                    arcname='installers.json')
+                    arcname='installers.json', filter=tarinfo_filter)
 
     if os.path.exists(bundle_tar_path):
         os.remove(bundle_tar_path)
 
-    recursive_tar_in_path(bundle_tar_path, staging_path)
+    recursive_tar_in_path(bundle_tar_path, staging_path,
+                          reproducible=reproducible,
+                          additional_paths=additional_paths)
 
     version_file_path = path_context.version_file_path()
     with open(version_file_path, 'w') as v:
         v.write('1')
 
-    with tarfile.open(
-            archive_tar_gz_path, 'w:gz', compresslevel=5) as archive:
+    # The gzip header records the name and modification time of the archive
+    # unless they are given explicitly
+    with open(archive_tar_gz_path, 'wb') as f, \
+            gzip.GzipFile(filename='' if reproducible else None,
+                          fileobj=f, mode='wb', compresslevel=5,
+                          mtime=0 if reproducible else None) as gz, \
+            tarfile.open(fileobj=gz, mode='w') as archive:
         archive.add(
-            version_file_path, arcname='version')
+            version_file_path, arcname='version', filter=tarinfo_filter)
         archive.add(
-            metadata_tar_path, arcname=os.path.basename(metadata_tar_path))
+            metadata_tar_path, arcname=os.path.basename(metadata_tar_path),
+            filter=tarinfo_filter)
         archive.add(
-            bundle_tar_path, arcname=os.path.basename(bundle_tar_path))
+            bundle_tar_path, arcname=os.path.basename(bundle_tar_path),
+            filter=tarinfo_filter)
 
     os.remove(metadata_tar_path)
     os.remove(bundle_tar_path)
@@ -76,7 +103,13 @@ def generate_archive_v1(path_context):
 
 def generate_archive_v2(path_context: PathContext,
                         metadata_paths: List[str],
-                        dependencies_changed: bool):
+                        dependencies_changed: bool,
+                        *, compression_workers: int = 1,
+                        compression: str = DEFAULT_OVERLAY_CODEC,
+                        file_index: bool = False,
+                        reproducible: bool = False,
+                        package_names: List[str] = None,
+                        stream_workspace: bool = False):
     """
     Generate bundle archive v2.
 
@@ -89,35 +122,93 @@ def generate_archive_v2(path_context: PathContext,
     |- dependencies.tar.gz
     |- workspace.tar.gz
 
+    The overlays use the extension of the selected compression, e.g.
+    .tar.zst for zstd.
+
+    If package_names is given, workspace.tar.gz only contains the top level
+    files of the isolated install directory and is followed by a
+    workspace-<package>.tar.gz overlay for each package. Package overlays
+    are cached and only recreated if the install prefix of the package
+    changed.
+
     :param path_context: PathContext object including all path configurations
     :param metadata_paths: [str] paths to files which should be included
     in the metadata archive
     :param dependencies_changed: Boolean representing whether the staging path
     needs to be re-archvied
+    :param compression_workers: Number of threads used to compress each
+    overlay
+    :param compression: Name of the overlay codec to compress overlays with
+    :param file_index: Whether to add an index of the files in the overlays
+    to the metadata, allowing single files to be read from the bundle
+    :param reproducible: Whether to normalize the overlays so the same
+    workspace and dependencies always give byte identical overlays
+    :param package_names: Names of the packages of an isolated install
+    directory in topological order, each of them is put in its own overlay
+    :param stream_workspace: Whether to add the files of the install
+    directory to the workspace overlays directly instead of copying them to
+    a staging directory first
     """
     logger.info('Archiving the bundle output')
     print('Creating bundle archive V2...')
-    logger.debug('Start: workspace.tar.gz')
+    logger.debug('Start: workspace overlay')
+    install_base = path_context.install_base()
+    if package_names is not None:
+        package_names = [
+            name for name in package_names
+            if os.path.isdir(os.path.join(install_base, name))]
     workspace_tar_gz_path = path_context.workspace_overlay_path()
-    create_workspace_overlay(path_context.install_base(),
-                             path_context.workspace_staging_path(),
-                             workspace_tar_gz_path)
-    logger.debug('End: workspace.tar.gz')
+    workspace_overlay_info = create_workspace_overlay(
+        install_base,
+        path_context.workspace_staging_path(),
+        workspace_tar_gz_path,
+        compression_workers=compression_workers,
+        compression=compression,
+        file_index=file_index,
+        reproducible=reproducible,
+        exclude_packages=package_names,
+        stream=stream_workspace)
+    workspace_overlays = [(workspace_tar_gz_path, workspace_overlay_info)]
+    if package_names is not None:
+        workspace_overlays += _create_package_overlays(
+            path_context, package_names,
+            compression_workers=compression_workers,
+            compression=compression,
+            file_index=file_index,
+            reproducible=reproducible,
+            stream=stream_workspace)
+    logger.debug('End: workspace overlay')
 
-    logger.debug('Start: dependencies.tar.gz')
+    logger.debug('Start: dependencies overlay')
     dependencies_overlay_path = path_context.dependencies_overlay_path()
-    if dependencies_changed:
-        create_dependencies_overlay(path_context.dependencies_staging_path(),
-                                    dependencies_overlay_path)
+    dependencies_overlay_info = read_overlay_info(
+        dependencies_overlay_path,
+        options=overlay_options(
+            file_index=file_index, reproducible=reproducible))
+    # The overlay is also rebuilt if it is missing because the compression
+    # has changed since the last bundle, or was created with other options
+    if dependencies_changed or dependencies_overlay_info is None:
+        dependencies_overlay_info = create_dependencies_overlay(
+            path_context.dependencies_staging_path(),
+            dependencies_overlay_path,
+            compression_workers=compression_workers,
+            compression=compression,
+            file_index=file_index,
+            reproducible=reproducible)
         update_dependencies_cache(path_context)
-    logger.debug('End: dependencies.tar.gz')
+    logger.debug('End: dependencies overlay')
 
     logger.debug('Start: bundle.tar')
     with Bundle(name=path_context.bundle_v2_output_path()) as bundle:
         for path in metadata_paths:
             bundle.add_metadata(path)
-        bundle.add_overlay_archive(dependencies_overlay_path)
-        bundle.add_overlay_archive(workspace_tar_gz_path)
+        bundle.add_overlay_archive(dependencies_overlay_path,
+                                   compression=compression,
+                                   **dependencies_overlay_info)
+        for overlay_path, overlay_info in workspace_overlays:
+            bundle.add_overlay_archive(overlay_path,
+                                       compression=compression,
+                                       **overlay_info)
     logger.debug('End: bundle.tar')
 
     logger.info('Archiving complete')
@@ -125,13 +216,64 @@ def generate_archive_v2(path_context: PathContext,
     _mark_cache_valid(path_context)
 
 
+def _create_package_overlays(path_context, package_names, *,
+                             compression_workers, compression, file_index,
+                             reproducible, stream):
+    """
+    Create or reuse the overlay of each workspace package.
+
+    :return: list of tuples with the path and info of each overlay
+    """
+    overlays_path = path_context.workspace_package_overlays_path()
+    os.makedirs(overlays_path, exist_ok=True)
+    package_overlays = []
+    for package_name in package_names:
+        package_install_path = os.path.join(
+            path_context.install_base(), package_name)
+        overlay_path = path_context.workspace_package_overlay_path(
+            package_name)
+        # The fingerprint follows symlinks like the staging copy, so edits
+        # of the sources of a package built with --symlink-install are seen
+        options = overlay_options(
+            file_index=file_index, reproducible=reproducible,
+            fingerprint=directory_fingerprint(package_install_path))
+        overlay_info = read_overlay_info(overlay_path, options=options)
+        if overlay_info is None:
+            overlay_info = create_package_overlay(
+                package_name,
+                package_install_path,
+                path_context.workspace_package_staging_path(package_name),
+                overlay_path,
+                compression_workers=compression_workers,
+                compression=compression,
+                file_index=file_index,
+                reproducible=reproducible,
+                stream=stream)
+            write_overlay_info(overlay_path, overlay_info, options=options)
+        else:
+            logger.info('Package {} not changed, reusing {}'.format(
+                package_name, overlay_path))
+        package_overlays.append((overlay_path, overlay_info))
+
+    # Remove the overlays of packages which are no longer in the workspace
+    current_files = set()
+    for overlay_path, _ in package_overlays:
+        current_files.add(os.path.basename(overlay_path))
+        current_files.add(os.path.basename(overlay_path) + '.info.json')
+    for name in os.listdir(overlays_path):
+        if name not in current_files:
+            os.remove(os.path.join(overlays_path, name))
+    return package_overlays
+
+
 def _mark_cache_valid(path_context):
     cache_valid_file = path_context.cache_valid_path()
     with open(cache_valid_file, 'a'):
         os.utime(cache_valid_file)
 
 
-def recursive_tar_in_path(tar_path, path):
+def recursive_tar_in_path(tar_path, path, *, reproducible=False,
+                          additional_paths=None):
     """
     Tar all files inside a directory.
 
@@ -142,10 +284,24 @@ def recursive_tar_in_path(tar_path, path):
     :param path: path to recursively collect all files and include in
     tar
     mode type
+    :param reproducible: Whether to add the files in sorted order with
+    normalized metadata, see reproducible_filter
+    :param additional_paths: list of tuples of a path outside of path and
+    its name in the tar, added recursively after the content of path with
+    symlinks replaced by their targets like shutil.copytree does
     """
+    tarinfo_filter = None
+    names = os.listdir(path)
+    if reproducible:
+        tarinfo_filter = reproducible_filter(get_source_date_epoch())
+        names = sorted(names)
     with tarfile.open(tar_path, mode='w') as tar:
         logger.info(
             'Creating tar of {path}'.format(path=path))
-        for name in os.listdir(path):
+        for name in names:
             some_path = os.path.join(path, name)
-            tar.add(some_path, arcname=os.path.basename(some_path))
+            tar.add(some_path, arcname=os.path.basename(some_path),
+                    filter=tarinfo_filter)
+        tar.dereference = True
+        for some_path, arcname in additional_paths or []:
+            tar.add(some_path, arcname=arcname, filter=tarinfo_filter)
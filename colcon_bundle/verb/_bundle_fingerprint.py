@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from typing import List
+
+from colcon_bundle.verb._path_context import PathContext
+from colcon_bundle.verb.utilities import directory_fingerprint, \
+    filechecksum
+from colcon_core.package_decorator import PackageDecorator
+
+_ARGUMENT_TYPES = (str, int, float, bool, type(None))
+
+
+def bundle_fingerprint(args, decorators: List[PackageDecorator],
+                       install_base, *, files=()):
+    """
+    Hash all inputs of a bundle which are known before installing anything.
+
+    The fingerprint covers the command line arguments, the content of files
+    they refer to (like sources lists or requirements files), the
+    dependencies of the workspace packages and the state of the install
+    directory.
+
+    :param args: The parsed command line arguments
+    :param decorators: decorators of the packages in the bundle
+    :param install_base: Directory with built artifacts from the workspace
+    :param files: paths of additional input files
+    :return: the hex digest
+    :rtype: str
+    """
+    fingerprint = {
+        'arguments': arguments_state(args),
+        'packages': packages_state(decorators),
+        'install_base': directory_fingerprint(install_base),
+        'files': {
+            path: filechecksum(path) if os.path.isfile(path) else None
+            for path in files},
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def arguments_state(args, names=None):
+    """
+    Get the values of command line arguments and the files they refer to.
+
+    Arguments which are not plain values, like callbacks, are skipped.
+
+    :param args: The parsed command line arguments
+    :param names: destinations of the arguments to include, None for all
+    :return: json serializable dictionary, arguments naming a file are
+    followed by an entry with the sha256 of the file
+    """
+    arguments = {}
+    for name, value in sorted(vars(args).items()):
+        if names is not None and name not in names:
+            continue
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if not all(isinstance(v, _ARGUMENT_TYPES) for v in values):
+            continue
+        arguments[name] = value
+        for v in values:
+            if isinstance(v, str) and os.path.isfile(v):
+                arguments[name + ':' + v] = filechecksum(v)
+    return arguments
+
+
+def packages_state(decorators: List[PackageDecorator]):
+    """
+    Get the run dependencies of the workspace packages.
+
+    :param decorators: decorators of the packages in the bundle
+    :return: json serializable dictionary keyed by package name
+    """
+    packages = {}
+    for decorator in decorators:
+        pkg = decorator.descriptor
+        packages[pkg.name] = {
+            'selected': bool(decorator.selected),
+            'type': pkg.type,
+            'run': sorted(
+                str(dependency) for dependency in pkg.dependencies['run']),
+        }
+    return packages
+
+
+def _output_state(output_path):
+    if not os.path.isfile(output_path):
+        return None
+    stat_result = os.stat(output_path)
+    return [stat_result.st_size, stat_result.st_mtime_ns]
+
+
+def bundle_up_to_date(path_context: PathContext, fingerprint, output_path):
+    """
+    Check if the output of the last bundle was created from the same inputs.
+
+    :param path_context: paths to use
+    :param fingerprint: the result of bundle_fingerprint for this run
+    :param output_path: File path for the final output of the bundle
+    :return: True if the output exists unchanged and was created from inputs
+    with the same fingerprint
+    """
+    fingerprint_path = path_context.bundle_fingerprint_path()
+    if not os.path.isfile(fingerprint_path):
+        return False
+    with open(fingerprint_path, 'r') as f:
+        previous = json.loads(f.read())
+    output_state = _output_state(output_path)
+    return output_state is not None and previous == {
+        'fingerprint': fingerprint, 'output': output_state}
+
+
+def record_bundle_fingerprint(path_context: PathContext, fingerprint,
+                              output_path):
+    """
+    Record the fingerprint of the inputs of a successfully created bundle.
+
+    :param path_context: paths to use
+    :param fingerprint: the result of bundle_fingerprint for this run
+    :param output_path: File path for the final output of the bundle
+    """
+    with open(path_context.bundle_fingerprint_path(), 'w') as f:
+        f.write(json.dumps({
+            'fingerprint': fingerprint,
+            'output': _output_state(output_path)}))
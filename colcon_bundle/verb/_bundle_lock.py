@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+from typing import List
+
+from colcon_bundle.verb._bundle_fingerprint import arguments_state, \
+    packages_state
+from colcon_bundle.verb._path_context import PathContext
+from colcon_core.package_decorator import PackageDecorator
+
+BUNDLE_LOCK_VERSION = 1
+
+
+def bundle_lock_key(args, installer_arguments,
+                    decorators: List[PackageDecorator]):
+    """
+    Hash the inputs which determine the packages the installers resolve.
+
+    :param args: The parsed command line arguments
+    :param installer_arguments: destinations of the installer arguments
+    which change the resolved packages, see add_installer_arguments
+    :param decorators: decorators of the packages in the bundle
+    :return: the hex digest
+    :rtype: str
+    """
+    key = {
+        'arguments': arguments_state(args, installer_arguments),
+        'packages': packages_state(decorators),
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def read_bundle_lock(path_context: PathContext, key):
+    """
+    Read the packages pinned in bundle.lock.
+
+    :param path_context: paths to use
+    :param key: the result of bundle_lock_key for this run
+    :return: dictionary mapping installer names to their pinned packages
+    :raises RuntimeError: if there is no lock or it was created for other
+    dependencies or installer arguments
+    """
+    lock_path = path_context.bundle_lock_path()
+    if not os.path.isfile(lock_path):
+        raise RuntimeError(
+            '{} does not exist, bundle once without --locked to create '
+            'it'.format(lock_path))
+    with open(lock_path, 'r') as f:
+        lock = json.load(f)
+    if lock.get('version') != BUNDLE_LOCK_VERSION or lock.get('key') != key:
+        raise RuntimeError(
+            '{} is out of date, the dependencies or installer arguments '
+            'changed. Bundle without --locked to update it'.format(lock_path))
+    return lock['installers']
+
+
+def write_bundle_lock(path_context: PathContext, key, installers):
+    """
+    Write the packages resolved by the installers to bundle.lock.
+
+    :param path_context: paths to use
+    :param key: the result of bundle_lock_key for this run
+    :param installers: dictionary mapping installer names to their pinned
+    packages
+    """
+    lock = {
+        'version': BUNDLE_LOCK_VERSION,
+        'key': key,
+        'installers': installers,
+    }
+    with open(path_context.bundle_lock_path(), 'w') as f:
+        json.dump(lock, f, indent=2, sort_keys=True)
+        f.write('\n')
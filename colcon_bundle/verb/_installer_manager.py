@@ -1,9 +1,14 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
 import json
 import os
 import tarfile
+import threading
 
 from colcon_bundle.installer import BundleInstallerContext, \
     get_bundle_installer_extensions
+from colcon_bundle.installer._shared_cache import SharedCache
 from colcon_bundle.verb import logger
 from colcon_bundle.verb._path_context import PathContext
 from colcon_bundle.verb.utilities import rewrite_catkin_package_path, \
@@ -20,8 +25,10 @@ class InstallerManager:
             self._path_context.dependencies_staging_path())
         self.installer_cache_dirs = {}
         self.installers = None
+        self._shared_cache = None
+        self._prefix_writes = None
 
-    def setup_installers(self, context: CommandContext):
+    def setup_installers(self, context: CommandContext, *, lock=None):
         """
         Initialize all of the installer extension points.
 
@@ -30,20 +37,36 @@ class InstallerManager:
         'colcon_bundle.installer'
 
         :param context: Context from the calling verb
+        :param lock: dictionary mapping installer names to the pinned
+        packages they install instead of resolving their install list, None
+        to resolve the install lists of all installers
         """
         cache_path = self._path_context.installer_cache_path()
 
+        if context.args.bundle_shared_cache is not None:
+            self._shared_cache = SharedCache(
+                context.args.bundle_shared_cache,
+                max_size=context.args.bundle_shared_cache_size * 1024 * 1024)
+
         self.installers = get_bundle_installer_extensions()
+        self._prefix_writes = _PrefixWrites(
+            self.installers, get_installer_dependencies(self.installers))
 
         for name, installer in self.installers.items():
             installer_cache_dir = os.path.join(cache_path, name)
             self.installer_cache_dirs[name] = installer_cache_dir
             os.makedirs(installer_cache_dir, exist_ok=True)
-            context = BundleInstallerContext(
+            locked_packages = None
+            if lock is not None:
+                locked_packages = lock.get(name, [])
+            installer_context = BundleInstallerContext(
                 args=context.args,
                 cache_path=installer_cache_dir,
-                prefix_path=self.prefix_path)
-            installer.initialize(context)
+                prefix_path=self.prefix_path,
+                locked_packages=locked_packages,
+                shared_cache=self._shared_cache,
+                prefix_writes=partial(self._prefix_writes.write, name))
+            installer.initialize(installer_context)
 
     def cache_invalid(self):
         """
@@ -58,6 +81,20 @@ class InstallerManager:
             changed = changed or installer.cache_invalid()
         return changed
 
+    def get_lock(self):
+        """
+        Get the packages resolved by the installers in their last run.
+
+        :return: dictionary mapping installer names to their pinned packages,
+        installers which do not support locking are omitted
+        """
+        lock = {}
+        for name, installer in self.installers.items():
+            locked_packages = installer.get_locked_packages()
+            if locked_packages is not None:
+                lock[name] = locked_packages
+        return lock
+
     def run_installers(self, *, include_sources=False):
         """
         Invoke all installers to install packages into the bundle.
@@ -73,9 +110,9 @@ class InstallerManager:
 
         print('Fetching and installing dependencies...')
         logger.info('Fetching and installing dependencies...')
-        installer_metadata = {}
-        for name, installer in self.installers.items():
-            installer_metadata[name] = installer.install()
+        installer_metadata = _run_installer_graph(
+            self.installers, get_installer_dependencies(self.installers),
+            prefix_writes=self._prefix_writes)
 
         installer_metadata_string = json.dumps(installer_metadata,
                                                sort_keys=True)
@@ -91,6 +128,9 @@ class InstallerManager:
         with open(installer_metadata_path, 'w') as f:
             f.write(installer_metadata_string)
 
+        if self._shared_cache is not None:
+            self._shared_cache.collect_garbage()
+
         if include_sources:
             sources_tar_gz_path = self._path_context.sources_tar_gz_path()
             with tarfile.open(
@@ -112,4 +152,200 @@ class InstallerManager:
         # TODO: Move this to colcon-ros-bundle
         rewrite_catkin_package_path(self.prefix_path)
 
+        for installer in self.installers.values():
+            installer.finalize()
+
         return dependency_match
+
+
+def get_installer_dependencies(installers):
+    """
+    Get the installers each installer has to wait for.
+
+    :param installers: ordered dictionary of the installers by name
+    :return: dictionary mapping each installer name to the set of names of
+    the installers it depends on
+    :raises RuntimeError: if the dependencies contain a cycle
+    """
+    dependencies = {}
+    names = list(installers.keys())
+    for index, (name, installer) in enumerate(installers.items()):
+        depends_on = getattr(installer, 'DEPENDS_ON', None)
+        if depends_on is None:
+            # Installers without declared dependencies keep the serial order
+            dependencies[name] = set(names[:index])
+        else:
+            # Dependencies on installers which are not loaded are ignored
+            dependencies[name] = {
+                dependency for dependency in depends_on
+                if dependency in installers}
+
+    visited = set()
+    for name in names:
+        _check_cycle(name, dependencies, [], visited)
+    return dependencies
+
+
+def _check_cycle(name, dependencies, path, visited):
+    if name in path:
+        raise RuntimeError('The installers have a dependency cycle: ' +
+                           ' -> '.join(path[path.index(name):] + [name]))
+    if name in visited:
+        return
+    for dependency in sorted(dependencies[name]):
+        _check_cycle(dependency, dependencies, path + [name], visited)
+    visited.add(name)
+
+
+def _ancestors(name, dependencies):
+    ancestors = set()
+    queue = list(dependencies[name])
+    while queue:
+        dependency = queue.pop()
+        if dependency not in ancestors:
+            ancestors.add(dependency)
+            queue += dependencies[dependency]
+    return ancestors
+
+
+class _PrefixWrites:
+    """
+    Orders the writes of concurrently running installers to the prefix.
+
+    The phases of the installers declaring PREFIX_WRITE_PHASES are matched
+    by their position. Each phase is run in the order of the installers and
+    after the previous phase of all installers, so files written by several
+    installers in the same phase are left by the last one. Installers which
+    depend on each other are already ordered by the installer graph.
+    """
+
+    def __init__(self, installers, dependencies):
+        """
+        Create the order of the phases.
+
+        :param installers: ordered dictionary of the installers by name
+        :param dependencies: dictionary mapping each installer name to the
+        names of the installers it depends on
+        """
+        self._condition = threading.Condition()
+        self._phases = {}
+        for name, installer in installers.items():
+            phases = getattr(installer, 'PREFIX_WRITE_PHASES', None)
+            if phases is not None:
+                self._phases[name] = list(phases)
+        self._order = {name: index for index, name in enumerate(installers)}
+        ancestors = {
+            name: _ancestors(name, dependencies) for name in installers}
+        self._peers = {
+            name: [
+                other for other in self._phases
+                if other != name and other not in ancestors[name] and
+                name not in ancestors[other]]
+            for name in self._phases}
+        self._finished = None
+        self.reset()
+
+    def reset(self):
+        """Mark the phases of all installers as not started."""
+        with self._condition:
+            # The position of the last phase each installer finished
+            self._finished = {name: -1 for name in self._phases}
+
+    @contextmanager
+    def write(self, name, phase):
+        """
+        Wait for the turn of an installer to write in a phase.
+
+        :param name: name of the installer
+        :param phase: one of the PREFIX_WRITE_PHASES of the installer
+        """
+        if name not in self._phases:
+            yield
+            return
+        index = self._phases[name].index(phase)
+
+        def ready():
+            return all(
+                self._finished[other] >=
+                (index if self._order[other] < self._order[name]
+                 else index - 1)
+                for other in self._peers[name])
+        with self._condition:
+            # Phases which were skipped are finished
+            self._set_finished(name, index - 1)
+            self._condition.wait_for(ready)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._set_finished(name, index)
+
+    def finish(self, name):
+        """
+        Mark all phases of an installer as finished.
+
+        :param name: name of the installer
+        """
+        if name in self._phases:
+            with self._condition:
+                self._set_finished(name, len(self._phases[name]))
+
+    def _set_finished(self, name, index):
+        if index > self._finished[name]:
+            self._finished[name] = index
+            self._condition.notify_all()
+
+
+def _install(name, installer, prefix_writes):
+    try:
+        return installer.install()
+    finally:
+        if prefix_writes is not None:
+            prefix_writes.finish(name)
+
+
+def _run_installer_graph(installers, dependencies, *, prefix_writes=None):
+    """
+    Run install() of all installers once their dependencies finished.
+
+    :param installers: ordered dictionary of the installers by name
+    :param dependencies: dictionary mapping each installer name to the names
+    of the installers it depends on
+    :param prefix_writes: _PrefixWrites notified when an installer finished
+    :return: dictionary mapping the installer names to the metadata returned
+    by install(), in the order of installers independent of the order the
+    installers finished in
+    """
+    if prefix_writes is not None:
+        prefix_writes.reset()
+    results = {}
+    pending = list(installers.keys())
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(len(installers), 1)) as executor:
+        while pending or running:
+            if error is None:
+                for name in list(pending):
+                    if dependencies[name] <= results.keys():
+                        pending.remove(name)
+                        running[executor.submit(
+                            _install, name, installers[name],
+                            prefix_writes)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:  # noqa: B902
+                    # Wait for the running installers before failing
+                    if error is None:
+                        error = e
+                        if prefix_writes is not None:
+                            # The pending installers never write
+                            for pending_name in pending:
+                                prefix_writes.finish(pending_name)
+    if error is not None:
+        raise error
+    return {name: results[name] for name in installers.keys()}
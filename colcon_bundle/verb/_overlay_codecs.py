@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import gzip
+import tarfile
+
+from colcon_bundle.verb._parallel_gzip import ParallelGzipWriter
+
+# Distance in bytes of the uncompressed stream between two points from which
+# an indexed gzip overlay can be decompressed
+CHECKPOINT_INTERVAL = 4 * 1024 * 1024
+
+
+class OverlayCodec:
+    """
+    Compression applied to the overlay archives of a bundle.
+
+    The `NAME` of the codec is recorded for each overlay in overlays.json
+    so that extractors know how to decompress it.
+    """
+
+    """The name of the codec as recorded in overlays.json."""
+    NAME = None
+
+    """The file extension of overlays written with this codec."""
+    EXTENSION = None
+
+    def check_available(self):
+        """
+        Check that the libraries required by the codec can be imported.
+
+        :raises RuntimeError: if the codec can not be used on this system
+        """
+
+    def open_tar_writer(self, fileobj, *, workers=1, index=None,
+                        reproducible=False):
+        """
+        Open a tarfile writing a compressed overlay to fileobj.
+
+        :param fileobj: binary file object the compressed overlay is
+        written to, it is not closed by the returned tarfile
+        :param workers: number of threads used to compress the archive
+        :param index: OverlayIndex to record decompression checkpoints in,
+        codecs which do not support checkpoints ignore it
+        :param reproducible: omit timestamps and file names from the
+        compressed stream so the same tar always gives the same output
+        :return: context manager yielding a tarfile.TarFile
+        """
+        raise NotImplementedError()
+
+    def open_stream_reader(self, fileobj):
+        """
+        Open a file object decompressing an overlay.
+
+        :param fileobj: binary file object positioned at the start of
+        the compressed overlay
+        :return: a binary file object returning the uncompressed tar
+        """
+        raise NotImplementedError()
+
+    def open_tar_reader(self, fileobj):
+        """
+        Open a tarfile reading a compressed overlay as a stream.
+
+        :param fileobj: binary file object positioned at the start of
+        the compressed overlay
+        :return: a tarfile.TarFile which has to be read sequentially
+        """
+        return tarfile.open(
+            fileobj=self.open_stream_reader(fileobj), mode='r|')
+
+
+class GzipOverlayCodec(OverlayCodec):
+    """Overlays compressed with gzip, supported by every bundle reader."""
+
+    NAME = 'gzip'
+    EXTENSION = '.tar.gz'
+
+    @contextmanager
+    def open_tar_writer(self, fileobj, *, workers=1, index=None,  # noqa: D102
+                        reproducible=False):
+        mtime = 0 if reproducible else None
+        if workers <= 1 and index is None:
+            # Without a filename the name of fileobj is recorded in the
+            # gzip header
+            with gzip.GzipFile(filename='' if reproducible else None,
+                               mode='wb', fileobj=fileobj, compresslevel=5,
+                               mtime=mtime) as gz:
+                with tarfile.open(fileobj=gz, mode='w') as tar:
+                    yield tar
+            return
+
+        # Checkpoints are only available with the block compressor
+        checkpoint_interval = None
+        if index is not None:
+            checkpoint_interval = CHECKPOINT_INTERVAL
+        with ParallelGzipWriter(
+                fileobj, compresslevel=5, workers=workers, mtime=mtime,
+                checkpoint_interval=checkpoint_interval) as gz:
+            with tarfile.open(fileobj=gz, mode='w') as tar:
+                yield tar
+        if index is not None:
+            index.checkpoints = [list(c) for c in gz.checkpoints]
+
+    def open_stream_reader(self, fileobj):  # noqa: D102
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdOverlayCodec(OverlayCodec):
+    """Overlays compressed with Zstandard, faster to decompress than gzip."""
+
+    NAME = 'zstd'
+    EXTENSION = '.tar.zst'
+
+    # Compression level passed to zstd
+    LEVEL = 3
+
+    def check_available(self):  # noqa: D102
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise RuntimeError("""
+            Please install zstandard in order to compress overlays with zstd
+
+            You can do this by executing `pip3 install zstandard`.
+            """)
+
+    @contextmanager
+    def open_tar_writer(self, fileobj, *, workers=1, index=None,  # noqa: D102
+                        reproducible=False):
+        # zstd frames contain neither timestamps nor file names
+        import zstandard
+        compressor = zstandard.ZstdCompressor(
+            level=self.LEVEL, threads=workers if workers > 1 else 0)
+        with compressor.stream_writer(fileobj, closefd=False) as zst:
+            with tarfile.open(fileobj=zst, mode='w|') as tar:
+                yield tar
+
+    def open_stream_reader(self, fileobj):  # noqa: D102
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+class UncompressedOverlayCodec(OverlayCodec):
+    """Overlays stored as plain tar archives."""
+
+    NAME = 'none'
+    EXTENSION = '.tar'
+
+    @contextmanager
+    def open_tar_writer(self, fileobj, *, workers=1, index=None,  # noqa: D102
+                        reproducible=False):
+        with tarfile.open(fileobj=fileobj, mode='w') as tar:
+            yield tar
+
+    def open_stream_reader(self, fileobj):  # noqa: D102
+        return fileobj
+
+
+OVERLAY_CODECS = OrderedDict(
+    (codec.NAME, codec) for codec in (
+        GzipOverlayCodec(), ZstdOverlayCodec(), UncompressedOverlayCodec()))
+
+DEFAULT_OVERLAY_CODEC = GzipOverlayCodec.NAME
+
+
+def get_overlay_codec(name):
+    """
+    Get the overlay codec registered under name.
+
+    :param name: name of the codec as recorded in overlays.json
+    :rtype: OverlayCodec
+    :raises ValueError: if there is no codec with that name
+    """
+    try:
+        return OVERLAY_CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown overlay compression: {}'.format(name))
+
+
+def get_overlay_codec_for_path(path):
+    """
+    Get the overlay codec matching the file extension of path.
+
+    :param path: path of an overlay archive
+    :return: the matching OverlayCodec or None if the extension is unknown
+    """
+    for codec in OVERLAY_CODECS.values():
+        if str(path).endswith(codec.EXTENSION):
+            return codec
+    return None
@@ -0,0 +1,148 @@
+import bisect
+import zlib
+
+from colcon_bundle.verb._overlay_codecs import get_overlay_codec, \
+    GzipOverlayCodec, UncompressedOverlayCodec
+
+_READ_SIZE = 64 * 1024
+
+
+class OverlayIndex:
+    """
+    Location of the regular files inside an overlay archive.
+
+    The offsets are positions in the uncompressed tar stream of the overlay.
+    Checkpoints are pairs of an uncompressed offset and the offset in the
+    compressed overlay from which raw deflate decompression can start.
+    """
+
+    def __init__(self, files=None, checkpoints=None):
+        """
+        Create an index.
+
+        :param files: list of file entries, see add_file
+        :param checkpoints: list of [uncompressed offset, compressed offset]
+        """
+        self.files = files if files is not None else []
+        self.checkpoints = checkpoints if checkpoints is not None else []
+        self._by_path = {entry['path']: entry for entry in self.files}
+
+    def add_file(self, path, offset, size, mode, sha256):
+        """
+        Record a regular file of the overlay.
+
+        :param path: name of the member in the overlay
+        :param offset: offset of the member data in the uncompressed tar
+        :param size: size in bytes of the file
+        :param mode: permission bits of the file
+        :param sha256: hex digest of the file content
+        """
+        entry = {
+            'path': path,
+            'offset': offset,
+            'size': size,
+            'mode': mode,
+            'sha256': sha256,
+        }
+        self.files.append(entry)
+        self._by_path[path] = entry
+
+    def add_link(self, path, target, mode):
+        """
+        Record a hard link to a file already in the index.
+
+        :param path: name of the link member in the overlay
+        :param target: name of the member the link points to
+        :param mode: permission bits of the link
+        """
+        entry = self._by_path.get(target)
+        if entry is None:
+            return
+        self.add_file(
+            path, entry['offset'], entry['size'], mode, entry['sha256'])
+
+    def to_dict(self):
+        """:return: a json serializable representation of the index."""
+        return {'files': self.files, 'checkpoints': self.checkpoints}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create an index from the output of to_dict.
+
+        :param data: dictionary with 'files' and 'checkpoints'
+        :rtype: OverlayIndex
+        """
+        return cls(files=list(data.get('files', [])),
+                   checkpoints=list(data.get('checkpoints', [])))
+
+
+def read_overlay_range(fileobj, compression, checkpoints, offset, size):
+    """
+    Read a range of the uncompressed tar stream of an overlay.
+
+    Uncompressed overlays are read directly. Gzip overlays are decompressed
+    from the last checkpoint before offset, any other overlay is decompressed
+    from its start.
+
+    :param fileobj: seekable binary file object over the compressed overlay
+    :param compression: name of the overlay codec
+    :param checkpoints: list of [uncompressed offset, compressed offset]
+    :param offset: offset in the uncompressed tar stream
+    :param size: number of bytes to read
+    :return: the uncompressed bytes
+    """
+    if compression == UncompressedOverlayCodec.NAME:
+        fileobj.seek(offset)
+        return _read_exactly(fileobj, size)
+
+    if compression == GzipOverlayCodec.NAME and checkpoints:
+        position = bisect.bisect_right(
+            [checkpoint[0] for checkpoint in checkpoints], offset) - 1
+        if position >= 0:
+            uncompressed_offset, compressed_offset = checkpoints[position]
+            fileobj.seek(compressed_offset)
+            return _inflate_range(
+                fileobj, offset - uncompressed_offset, size)
+
+    reader = get_overlay_codec(compression).open_stream_reader(fileobj)
+    _skip(reader, offset)
+    return _read_exactly(reader, size)
+
+
+def _inflate_range(fileobj, skip, size):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = bytearray()
+    while len(data) < skip + size:
+        chunk = fileobj.read(_READ_SIZE)
+        if not chunk:
+            break
+        data += decompressor.decompress(chunk)
+        if decompressor.eof:
+            break
+        # Drop the bytes preceding the range to bound memory usage
+        if len(data) > skip:
+            continue
+        skip -= len(data)
+        data = bytearray()
+    if len(data) < skip + size:
+        raise RuntimeError('Unexpected end of overlay data')
+    return bytes(data[skip:skip + size])
+
+
+def _skip(fileobj, count):
+    while count > 0:
+        chunk = fileobj.read(min(count, _READ_SIZE))
+        if not chunk:
+            raise RuntimeError('Unexpected end of overlay data')
+        count -= len(chunk)
+
+
+def _read_exactly(fileobj, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            raise RuntimeError('Unexpected end of overlay data')
+        data += chunk
+    return bytes(data)
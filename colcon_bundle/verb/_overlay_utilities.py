@@ -1,12 +1,20 @@
+import io
+import json
 import os
 from pathlib import Path
 import shutil
 import stat
 import tarfile
+import time
+from typing import List
 
 from colcon_bundle.verb import logger
+from colcon_bundle.verb._overlay_codecs import DEFAULT_OVERLAY_CODEC, \
+    get_overlay_codec
+from colcon_bundle.verb._overlay_index import OverlayIndex
 from colcon_bundle.verb.utilities import \
-    update_shebang
+    HashingReader, HashingWriter, rewrite_shebang, sync_directory, \
+    update_file_shebang
 from jinja2 import \
     Environment, \
     FileSystemLoader, \
@@ -19,20 +27,53 @@ _CONTEXT_VAR_SH = {'shell': 'sh'}
 
 def create_workspace_overlay(install_base: str,
                              workspace_staging_path: str,
-                             overlay_path: str):
+                             overlay_path: str,
+                             *, compression_workers: int = 1,
+                             compression: str = DEFAULT_OVERLAY_CODEC,
+                             file_index: bool = False,
+                             reproducible: bool = False,
+                             exclude_packages: List[str] = None,
+                             stream: bool = False):
     """
     Create overlay from user's built workspace install directory.
 
     :param str install_base: Path to built workspace install directory
     :param str workspace_staging_path: Path to stage the overlay build at
     :param str overlay_path: Name of the overlay file (.tar.gz)
+    :param int compression_workers: Number of threads used to compress
+    the overlay
+    :param str compression: Name of the overlay codec to compress with
+    :param bool file_index: Whether to index the files of the overlay
+    :param bool reproducible: Whether to normalize the archive so the same
+    workspace always gives the same overlay, see reproducible_filter
+    :param list exclude_packages: Names of packages of an isolated install
+    directory which are not added to the overlay
+    :param bool stream: Whether to add the files from install_base to the
+    overlay directly instead of copying them to the staging path first
+    :return: the sha256 and size of the overlay, see
+    recursive_tar_overlay_in_path
     """
-    ws_install_path = Path(workspace_staging_path) / 'opt' / 'built_workspace'
+    if stream:
+        _remove_staging(workspace_staging_path)
+        return _stream_install_overlay(
+            install_base, Path(overlay_path),
+            Path('v2_workspace_setup.jinja2.sh'), {},
+            exclude=exclude_packages, compression=compression,
+            workers=compression_workers, file_index=file_index,
+            reproducible=reproducible)
 
-    shutil.rmtree(workspace_staging_path, ignore_errors=True)
+    ws_install_path = Path(workspace_staging_path) / 'opt' / 'built_workspace'
 
-    # install_base: Directory with built artifacts from the workspace
-    os.mkdir(workspace_staging_path)
+    # Packages with their own overlay are skipped at the top level of the
+    # install directory
+    def ignore(path, names):
+        if path != install_base or not exclude_packages:
+            return []
+        return [name for name in names if name in exclude_packages]
+    # Only the files which changed since the last bundle are copied
+    copied_files = sync_directory(
+        install_base, str(ws_install_path),
+        _staging_manifest_path(workspace_staging_path), ignore=ignore)
 
     shellscript_dest = Path(workspace_staging_path) / 'setup.sh'
     _render_template(
@@ -50,16 +91,95 @@ def create_workspace_overlay(install_base: str,
     )
     shellscript_dest_bash.chmod(0o755)
 
-    shutil.copytree(install_base, str(ws_install_path))
+    # This is required because python3 shell scripts use a hard
+    # coded shebang
+    for path in copied_files:
+        update_file_shebang(path)
+
+    return recursive_tar_overlay_in_path(Path(overlay_path),
+                                         Path(workspace_staging_path),
+                                         compression=compression,
+                                         workers=compression_workers,
+                                         file_index=file_index,
+                                         reproducible=reproducible)
+
+
+def create_package_overlay(package_name: str,
+                           package_install_path: str,
+                           package_staging_path: str,
+                           overlay_path: str,
+                           *, compression_workers: int = 1,
+                           compression: str = DEFAULT_OVERLAY_CODEC,
+                           file_index: bool = False,
+                           reproducible: bool = False,
+                           stream: bool = False):
+    """
+    Create overlay from the install prefix of a single workspace package.
+
+    The setup.sh of the overlay only sources the package itself, the
+    overlays of its dependencies have to be sourced before.
+
+    :param str package_name: Name of the package
+    :param str package_install_path: Install prefix of the package in an
+    isolated install directory
+    :param str package_staging_path: Path to stage the overlay build at
+    :param str overlay_path: Name of the overlay file
+    :param int compression_workers: Number of threads used to compress
+    the overlay
+    :param str compression: Name of the overlay codec to compress with
+    :param bool file_index: Whether to index the files of the overlay
+    :param bool reproducible: Whether to normalize the archive, see
+    reproducible_filter
+    :param bool stream: Whether to add the files from package_install_path
+    to the overlay directly instead of copying them to the staging path first
+    :return: the sha256 and size of the overlay, see
+    recursive_tar_overlay_in_path
+    """
+    logger.info('Package {} changed, updating {}'.format(
+        package_name, overlay_path))
+    if stream:
+        _remove_staging(package_staging_path)
+        return _stream_install_overlay(
+            package_install_path, Path(overlay_path),
+            Path('v2_package_setup.jinja2.sh'),
+            {'package_name': package_name}, compression=compression,
+            workers=compression_workers, file_index=file_index,
+            reproducible=reproducible)
+
+    staging_path = Path(package_staging_path)
+    # Only the files which changed since the last bundle are copied
+    copied_files = sync_directory(
+        package_install_path, str(staging_path / 'opt' / 'built_workspace'),
+        _staging_manifest_path(package_staging_path))
+
+    for shell, context_vars in (('sh', _CONTEXT_VAR_SH),
+                                ('bash', _CONTEXT_VAR_BASH)):
+        context_vars = dict(context_vars, package_name=package_name)
+        shellscript_dest = staging_path / 'setup.{}'.format(shell)
+        _render_template(
+            Path('v2_package_setup.jinja2.sh'),
+            shellscript_dest,
+            context_vars
+        )
+        shellscript_dest.chmod(0o755)
 
     # This is required because python3 shell scripts use a hard
     # coded shebang
-    update_shebang(workspace_staging_path)
+    for path in copied_files:
+        update_file_shebang(path)
 
-    recursive_tar_gz_in_path(Path(overlay_path), Path(workspace_staging_path))
+    return recursive_tar_overlay_in_path(Path(overlay_path), staging_path,
+                                         compression=compression,
+                                         workers=compression_workers,
+                                         file_index=file_index,
+                                         reproducible=reproducible)
 
 
-def create_dependencies_overlay(staging_path: str, overlay_path: str):
+def create_dependencies_overlay(staging_path: str, overlay_path: str,
+                                *, compression_workers: int = 1,
+                                compression: str = DEFAULT_OVERLAY_CODEC,
+                                file_index: bool = False,
+                                reproducible: bool = False):
     """
     Create the dependencies overlay from staging_path.
 
@@ -67,6 +187,14 @@ def create_dependencies_overlay(staging_path: str, overlay_path: str):
     have been installed/extracted to
     :param str overlay_path: Path of overlay output file
     (.tar.gz)
+    :param int compression_workers: Number of threads used to compress
+    the overlay
+    :param str compression: Name of the overlay codec to compress with
+    :param bool file_index: Whether to index the files of the overlay
+    :param bool reproducible: Whether to normalize the archive so the same
+    dependencies always give the same overlay, see reproducible_filter
+    :return: the sha256 and size of the overlay, see
+    recursive_tar_overlay_in_path
     """
     dep_staging_path = Path(staging_path)
     dep_tar_gz_path = Path(overlay_path)
@@ -92,10 +220,21 @@ def create_dependencies_overlay(staging_path: str, overlay_path: str):
 
     if dep_tar_gz_path.exists():
         dep_tar_gz_path.unlink()
-    recursive_tar_gz_in_path(dep_tar_gz_path, dep_staging_path)
+    overlay_info = recursive_tar_overlay_in_path(
+        dep_tar_gz_path, dep_staging_path,
+        compression=compression, workers=compression_workers,
+        file_index=file_index, reproducible=reproducible)
+    # The dependencies overlay is reused by later bundles, keep its
+    # checksum so it does not need to be read again
+    write_overlay_info(
+        str(dep_tar_gz_path), overlay_info,
+        options=overlay_options(file_index=file_index,
+                                reproducible=reproducible))
+    return overlay_info
 
 
-def recursive_tar_gz_in_path(output_path: Path, tar_path: Path):
+def recursive_tar_gz_in_path(output_path: Path, tar_path: Path,
+                             *, workers: int = 1, reproducible: bool = False):
     """
     Create a tar.gz archive of all files inside a directory.
 
@@ -104,12 +243,362 @@ def recursive_tar_gz_in_path(output_path: Path, tar_path: Path):
     :param output_path: Name of archive file to create
     :param tar_path: path to recursively collect all files and include in
     tar.gz. These will be included with path as the root of the archive.
+    :param workers: number of threads used to compress the archive, with
+    more than one worker the gzip stream is deflated in parallel blocks
+    :param reproducible: whether to normalize the archive, see
+    reproducible_filter
+    :return: the sha256 and size of the archive, see
+    recursive_tar_overlay_in_path
     """
-    with tarfile.open(str(output_path), mode='w:gz', compresslevel=5) as tar:
+    return recursive_tar_overlay_in_path(output_path, tar_path,
+                                         compression='gzip', workers=workers,
+                                         reproducible=reproducible)
+
+
+def recursive_tar_overlay_in_path(output_path: Path, tar_path: Path,
+                                  *, compression: str = DEFAULT_OVERLAY_CODEC,
+                                  workers: int = 1, file_index: bool = False,
+                                  reproducible: bool = False):
+    """
+    Create an overlay archive of all files inside a directory.
+
+    This function includes all sub-folders of path in the root of the tarfile
+
+    :param output_path: Name of archive file to create
+    :param tar_path: path to recursively collect all files and include in
+    the archive. These will be included with path as the root of the archive.
+    :param compression: name of the overlay codec used to compress the tar
+    :param workers: number of threads used to compress the archive
+    :param file_index: whether to record the location of each file in the
+    uncompressed archive
+    :param reproducible: whether to normalize the members and the
+    compressed stream so the same directory always gives the same archive,
+    see reproducible_filter
+    :return: dictionary with the 'sha256' hex digest and the 'size' in bytes
+    of the archive, computed while it was written, and the 'index' of its
+    files as returned by OverlayIndex.to_dict if requested
+    """
+    def add_members(writer):
         logger.info(
             'Creating tar of {path}'.format(path=tar_path))
-        for child in tar_path.iterdir():
-            tar.add(str(child), arcname=str(child.name))
+        for child in sorted(tar_path.iterdir()):
+            writer.add_path(str(child), child.name)
+    return _write_overlay(output_path, add_members,
+                          compression=compression, workers=workers,
+                          file_index=file_index, reproducible=reproducible)
+
+
+def _stream_install_overlay(install_path, output_path, template_name,
+                            context_vars, *, exclude=None, compression,
+                            workers, file_index, reproducible):
+    """
+    Create an overlay of an install prefix without staging it on disk.
+
+    The install prefix is added as opt/built_workspace, the shebangs of its
+    scripts are rewritten while they are added, and setup.sh and setup.bash
+    are rendered from template_name in memory.
+
+    :param install_path: Path of the install prefix
+    :param output_path: Name of archive file to create
+    :param template_name: Name of the setup script template
+    :param context_vars: dictionary of values used for the variables in the
+    template in addition to the shell
+    :param exclude: names of the entries of install_path to skip
+    :return: the sha256, size and optional index of the archive, see
+    recursive_tar_overlay_in_path
+    """
+    def add_members(writer):
+        logger.info(
+            'Creating tar of {path}'.format(path=install_path))
+        writer.add_directory('opt')
+        writer.add_path(install_path, 'opt/built_workspace',
+                        rewrite_shebangs=True, exclude=exclude,
+                        dereference=True)
+        for shell_vars in (_CONTEXT_VAR_BASH, _CONTEXT_VAR_SH):
+            script = _render_template_string(
+                template_name, dict(context_vars, **shell_vars))
+            writer.add_bytes('setup.' + shell_vars['shell'], script.encode(),
+                             mode=0o755)
+    return _write_overlay(output_path, add_members,
+                          compression=compression, workers=workers,
+                          file_index=file_index, reproducible=reproducible)
+
+
+def _remove_staging(staging_path):
+    # The staging directory of a previous bundle is not needed anymore
+    shutil.rmtree(staging_path, ignore_errors=True)
+    manifest_path = _staging_manifest_path(staging_path)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def _write_overlay(output_path, add_members, *, compression, workers,
+                   file_index, reproducible):
+    """
+    Create an overlay archive from the members added by a callback.
+
+    :param output_path: Name of archive file to create
+    :param add_members: function called with an _OverlayWriter to add the
+    members of the archive
+    :return: the sha256, size and optional index of the archive, see
+    recursive_tar_overlay_in_path
+    """
+    codec = get_overlay_codec(compression)
+    index = OverlayIndex() if file_index else None
+    tarinfo_filter = None
+    if reproducible:
+        tarinfo_filter = reproducible_filter(get_source_date_epoch())
+    with output_path.open('wb') as f:
+        writer = HashingWriter(f)
+        with codec.open_tar_writer(
+                writer, workers=workers, index=index,
+                reproducible=reproducible) as tar:
+            add_members(_OverlayWriter(tar, index, tarinfo_filter))
+    overlay_info = {'sha256': writer.hexdigest(), 'size': writer.size}
+    if index is not None:
+        overlay_info['index'] = index.to_dict()
+    return overlay_info
+
+
+class _OverlayWriter:
+    """Adds members to an overlay archive and records them in its index."""
+
+    def __init__(self, tar, index, tarinfo_filter):
+        """
+        Wrap an open tarfile.
+
+        :param tar: tarfile.TarFile opened for writing
+        :param index: OverlayIndex recording the location of each regular
+        file or None
+        :param tarinfo_filter: function modifying the TarInfo of each member
+        before it is added, like the filter argument of tarfile.TarFile.add
+        """
+        self._tar = tar
+        self._index = index
+        self._filter = tarinfo_filter
+
+    def add_path(self, path, arcname, *, rewrite_shebangs=False,
+                 exclude=None, dereference=False):
+        """
+        Add path recursively like tarfile.TarFile.add.
+
+        Directory entries are added in sorted order.
+
+        :param path: path of the file or directory to add
+        :param arcname: name of the member in the archive
+        :param rewrite_shebangs: whether to replace the shebangs of scripts
+        with /usr/bin/env while they are added, see rewrite_shebang
+        :param exclude: names of the entries of path to skip if path is a
+        directory
+        :param dereference: whether to add the targets of symlinks instead
+        of the links, like shutil.copytree does when staging
+        """
+        self._tar.dereference = dereference
+        info = self._tar.gettarinfo(path, arcname=arcname)
+        if info is None:
+            # Sockets and other unsupported file types are skipped
+            return
+        if info.isreg():
+            data = None
+            if rewrite_shebangs:
+                data = _read_rewritten_script(path)
+            if data is not None:
+                info.size = len(data)
+                self._add_file(info, io.BytesIO(data))
+                return
+            with open(path, 'rb') as f:
+                self._add_file(info, f)
+        elif info.isdir():
+            self._add_info(info)
+            for name in sorted(os.listdir(path)):
+                if exclude and name in exclude:
+                    continue
+                self.add_path(
+                    os.path.join(path, name), arcname + '/' + name,
+                    rewrite_shebangs=rewrite_shebangs,
+                    dereference=dereference)
+        else:
+            self._add_info(info)
+            if self._index is not None and info.islnk():
+                self._index.add_link(arcname, info.linkname, info.mode)
+
+    def add_bytes(self, arcname, data, *, mode=0o644):
+        """
+        Add a regular file with the given content.
+
+        :param arcname: name of the member in the archive
+        :param bytes data: content of the file
+        :param mode: permission bits of the file
+        """
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = time.time()
+        self._add_file(info, io.BytesIO(data))
+
+    def add_directory(self, arcname, *, mode=0o755):
+        """
+        Add an empty directory.
+
+        :param arcname: name of the member in the archive
+        :param mode: permission bits of the directory
+        """
+        info = tarfile.TarInfo(arcname)
+        info.type = tarfile.DIRTYPE
+        info.mode = mode
+        info.mtime = time.time()
+        self._add_info(info)
+
+    def _add_info(self, info):
+        if self._filter is not None:
+            info = self._filter(info)
+        self._tar.addfile(info)
+
+    def _add_file(self, info, fileobj):
+        if self._filter is not None:
+            info = self._filter(info)
+        if self._index is None:
+            self._tar.addfile(info, fileobj)
+            return
+        reader = HashingReader(fileobj)
+        self._tar.addfile(info, reader)
+        # addfile advanced the offset past the padded member data
+        blocks = -(-info.size // tarfile.BLOCKSIZE)
+        self._index.add_file(
+            info.name, self._tar.offset - blocks * tarfile.BLOCKSIZE,
+            info.size, info.mode, reader.hexdigest())
+
+
+def _read_rewritten_script(path):
+    """
+    Read a script with its shebang replaced, see rewrite_shebang.
+
+    :return: the modified content or None if the file is not modified
+    """
+    with open(path, 'rb') as f:
+        # Only scripts need to be read completely
+        if f.read(2) != b'#!':
+            return None
+        f.seek(0)
+        return rewrite_shebang(path, f.read())
+
+
+def get_source_date_epoch():
+    """
+    Get the timestamp reproducible archives are clamped to.
+
+    :return: the value of the SOURCE_DATE_EPOCH environment variable or 0 if
+    it is not set
+    """
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        raise RuntimeError(
+            'SOURCE_DATE_EPOCH must be an integer: {}'.format(value))
+
+
+def reproducible_filter(source_date_epoch: int):
+    """
+    Create a tarfile filter normalizing the metadata of members.
+
+    Modification times are clamped to source_date_epoch and the ownership
+    is set to root, so the archive only depends on the content, names and
+    permissions of the files.
+
+    :param source_date_epoch: latest modification time of any member
+    :return: function modifying and returning a tarfile.TarInfo
+    """
+    def normalize(info):
+        info.mtime = min(int(info.mtime), source_date_epoch)
+        info.uid = 0
+        info.gid = 0
+        info.uname = ''
+        info.gname = ''
+        return info
+    return normalize
+
+
+def overlay_options(*, file_index: bool = False, reproducible: bool = False,
+                    fingerprint: str = None):
+    """
+    Get the options an overlay was created with which change its content.
+
+    An overlay stored with write_overlay_info is only reused if it was
+    created with the same options.
+
+    :param file_index: whether the files of the overlay are indexed
+    :param reproducible: whether the overlay is reproducible
+    :param fingerprint: fingerprint of the files the overlay was created
+    from, see directory_fingerprint
+    :return: json serializable dictionary
+    """
+    options = {
+        'file_index': file_index,
+        'source_date_epoch':
+            get_source_date_epoch() if reproducible else None,
+    }
+    if fingerprint is not None:
+        options['fingerprint'] = fingerprint
+    return options
+
+
+def write_overlay_info(overlay_path: str, overlay_info: dict,
+                       *, options: dict = None):
+    """
+    Store the checksum of an overlay next to it.
+
+    :param overlay_path: path of the overlay archive
+    :param overlay_info: the sha256, size and optional index of the archive
+    as returned by recursive_tar_overlay_in_path
+    :param options: options the overlay was created with, see
+    overlay_options
+    """
+    info = dict(overlay_info)
+    info['mtime_ns'] = os.stat(overlay_path).st_mtime_ns
+    if options is not None:
+        info['options'] = options
+    with open(_overlay_info_path(overlay_path), 'w') as f:
+        json.dump(info, f)
+
+
+def read_overlay_info(overlay_path: str, *, options: dict = None):
+    """
+    Load the checksum of an overlay stored by write_overlay_info.
+
+    :param overlay_path: path of the overlay archive
+    :param options: if not None the info is only returned if the overlay
+    was created with the same options
+    :return: dictionary with the 'sha256' and 'size' of the archive, and
+    its 'index' if one was recorded, or None if it is unknown, the archive
+    has been modified since or was created with other options
+    """
+    info_path = _overlay_info_path(overlay_path)
+    if not os.path.exists(info_path) or not os.path.exists(overlay_path):
+        return None
+    with open(info_path, 'r') as f:
+        info = json.load(f)
+    stat_result = os.stat(overlay_path)
+    if info.get('size') != stat_result.st_size or \
+            info.get('mtime_ns') != stat_result.st_mtime_ns:
+        return None
+    if options is not None and info.get('options') != options:
+        return None
+    overlay_info = {'sha256': info['sha256'], 'size': info['size']}
+    if 'index' in info:
+        overlay_info['index'] = info['index']
+    return overlay_info
+
+
+def _overlay_info_path(overlay_path: str):
+    return overlay_path + '.info.json'
+
+
+def _staging_manifest_path(staging_path: str):
+    # Kept next to the staging directory so it is not added to the overlay
+    return os.path.normpath(staging_path) + '.manifest.json'
 
 
 def _render_template(template_name: Path,
@@ -125,6 +614,20 @@ def _render_template(template_name: Path,
     :param context_vars: dictionary of values to be used for the variables in
     the template
     """
+    with script_dest.open('w') as file:
+        file.write(_render_template_string(template_name, context_vars))
+    script_dest.chmod(script_dest.stat().st_mode | stat.S_IEXEC)
+
+
+def _render_template_string(template_name: Path, context_vars: dict):
+    """
+    Render a template from the assets folder.
+
+    :param template_name: Name of the template to be used
+    :param context_vars: dictionary of values to be used for the variables in
+    the template
+    :return: the rendered template
+    """
     src = Path(__file__).parent.absolute() / 'assets' / template_name
     env = Environment(
         autoescape=select_autoescape(['html', 'xml']),
@@ -132,7 +635,4 @@ def _render_template(template_name: Path,
         keep_trailing_newline=True,
     )
     template = env.get_template(str(src.name))
-
-    with script_dest.open('w') as file:
-        file.write(template.render(context_vars))
-    script_dest.chmod(script_dest.stat().st_mode | stat.S_IEXEC)
+    return template.render(context_vars)
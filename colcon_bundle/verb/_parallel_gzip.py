@@ -0,0 +1,181 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import struct
+import time
+import zlib
+
+# Size in bytes of the uncompressed blocks handed to the workers
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Size in bytes of the deflate window, the tail of each block is used to
+# prime the compressor of the next block
+_DICTIONARY_SIZE = 32 * 1024
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_GZIP_DEFLATE = 8
+_GZIP_OS_UNKNOWN = 255
+
+
+def _deflate_block(data, level, dictionary, last):
+    """
+    Deflate a single block of a gzip member.
+
+    Every block except the last one ends with a sync flush so that its
+    output is byte aligned and can be concatenated with the next block.
+
+    :param data: uncompressed bytes of the block
+    :param level: compression level
+    :param dictionary: bytes preceding this block in the stream or None
+    :param last: True if this block terminates the deflate stream
+    :return: the raw deflate bytes of the block
+    """
+    if dictionary:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    output = compressor.compress(data)
+    output += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return output
+
+
+class ParallelGzipWriter:
+    """
+    File-like object writing a single gzip member compressed by threads.
+
+    The uncompressed stream is split into fixed size blocks which are
+    deflated concurrently. Each block is primed with the last 32KiB of the
+    previous block so the compression ratio stays close to a single
+    threaded compressor. The blocks are written in order, so the output is
+    a regular gzip file which can be read by `gzip` or `tarfile`.
+
+    If a checkpoint interval is given, a block is compressed without
+    dictionary whenever at least that many uncompressed bytes were written
+    since the last checkpoint. Decompression can start at such a block, the
+    pairs of uncompressed and compressed offsets of the checkpoints are
+    available in `checkpoints`.
+    """
+
+    def __init__(self, fileobj, *, compresslevel=5, workers=1,
+                 block_size=DEFAULT_BLOCK_SIZE, mtime=None,
+                 checkpoint_interval=None):
+        """
+        Start a gzip member on fileobj.
+
+        :param fileobj: binary file object to write the compressed data to,
+        it is not closed when this object is closed
+        :param compresslevel: compression level between 1 and 9
+        :param workers: number of threads used to compress blocks
+        :param block_size: size in bytes of the blocks compressed by a
+        single thread
+        :param mtime: modification time written in the gzip header, the
+        current time is used if None
+        :param checkpoint_interval: minimum distance in uncompressed bytes
+        between two checkpoints, no checkpoints are recorded if None
+        """
+        self._fileobj = fileobj
+        self._level = compresslevel
+        self._block_size = block_size
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        # Bound the number of in-flight blocks to limit memory usage
+        self._max_pending = 2 * max(1, workers)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._dictionary = None
+        self._crc = 0
+        self._size = 0
+        self._checkpoint_interval = checkpoint_interval
+        # Uncompressed offset of the next block and of the last checkpoint
+        self._block_offset = 0
+        self._checkpoint_offset = None
+        # Number of compressed bytes written, including the header
+        self._compressed_size = 0
+        self.checkpoints = []
+        self.closed = False
+        self._write_header(mtime)
+
+    def _write_header(self, mtime):
+        if mtime is None:
+            mtime = time.time()
+        if self._level == 9:
+            extra_flags = 2
+        elif self._level == 1:
+            extra_flags = 4
+        else:
+            extra_flags = 0
+        header = _GZIP_MAGIC + struct.pack(
+            '<BBIBB', _GZIP_DEFLATE, 0, int(mtime) & 0xffffffff,
+            extra_flags, _GZIP_OS_UNKNOWN)
+        self._fileobj.write(header)
+        self._compressed_size += len(header)
+
+    def write(self, data):
+        """
+        Compress and write data.
+
+        :param data: bytes-like object to add to the stream
+        :return: the number of uncompressed bytes consumed
+        """
+        if self.closed:
+            raise ValueError('write to closed file')
+        data = memoryview(data).cast('B')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def tell(self):
+        """:return: the number of uncompressed bytes written so far."""
+        return self._size
+
+    def _submit(self, block, *, last):
+        if len(self._pending) >= self._max_pending:
+            self._write_pending()
+        dictionary = self._dictionary
+        checkpoint = None
+        if self._checkpoint_interval is not None and (
+                self._checkpoint_offset is None or
+                self._block_offset - self._checkpoint_offset >=
+                self._checkpoint_interval):
+            dictionary = None
+            checkpoint = self._block_offset
+            self._checkpoint_offset = checkpoint
+        self._pending.append((checkpoint, self._executor.submit(
+            _deflate_block, block, self._level, dictionary, last)))
+        self._dictionary = block[-_DICTIONARY_SIZE:]
+        self._block_offset += len(block)
+
+    def _write_pending(self):
+        checkpoint, future = self._pending.popleft()
+        if checkpoint is not None:
+            self.checkpoints.append((checkpoint, self._compressed_size))
+        output = future.result()
+        self._fileobj.write(output)
+        self._compressed_size += len(output)
+
+    def close(self):
+        """Flush all pending blocks and write the gzip trailer."""
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._write_pending()
+            self._fileobj.write(struct.pack(
+                '<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            self.closed = True
+
+    def __enter__(self):  # noqa: D105
+        return self
+
+    def __exit__(self, t, value, traceback):  # noqa: D105
+        self.close()
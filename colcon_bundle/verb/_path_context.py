@@ -21,7 +21,8 @@ class PathContext:
     def __init__(self,
                  install_base: str,
                  bundle_base: str,
-                 bundle_version: int):
+                 bundle_version: int,
+                 *, overlay_extension: str = '.tar.gz'):
         """
         Set up the bundle directory for use with the bundle version.
 
@@ -29,6 +30,8 @@ class PathContext:
         :param bundle_base: Directory to place the output of the bundle
         :param bundle_version: Bundle version that should be created (passed
         from user arguments)
+        :param overlay_extension: File extension of the overlay archives,
+        depends on the overlay compression
         """
         previously_bundled = False
         if Path(bundle_base).is_dir():
@@ -55,6 +58,7 @@ class PathContext:
                 shutil.rmtree(self._bundle_cache)
             os.makedirs(self._bundle_cache, exist_ok=True)
         self._install_base = install_base
+        self._overlay_extension = overlay_extension
 
     def _create_path(self, path):
         path = Path(os.path.abspath(path))
@@ -79,7 +83,8 @@ class PathContext:
 
     def dependencies_overlay_path(self):  # noqa: D400
         """:return: File path for dependencies tarball"""
-        return os.path.join(self._bundle_cache, 'dependencies.tar.gz')
+        return os.path.join(self._bundle_cache,
+                            'dependencies' + self._overlay_extension)
 
     def installer_metadata_path(self):  # noqa: D400
         """:return: File path for installer metadata"""
@@ -109,7 +114,23 @@ class PathContext:
 
     def workspace_overlay_path(self):  # noqa: D400
         """:return: File path for workspace tarball"""
-        return os.path.join(self._bundle_cache, 'workspace.tar.gz')
+        return os.path.join(self._bundle_cache,
+                            'workspace' + self._overlay_extension)
+
+    def workspace_package_staging_path(self, package_name):  # noqa: D400
+        """:return: Directory where the files of a workspace package locate."""
+        return os.path.join(self._bundle_cache, 'workspace_packages_staging',
+                            package_name)
+
+    def workspace_package_overlays_path(self):  # noqa: D400
+        """:return: Directory with the tarballs of the workspace packages."""
+        return os.path.join(self._bundle_cache, 'workspace_packages')
+
+    def workspace_package_overlay_path(self, package_name):  # noqa: D400
+        """:return: File path for the tarball of a workspace package."""
+        return os.path.join(self.workspace_package_overlays_path(),
+                            'workspace-' + package_name +
+                            self._overlay_extension)
 
     def dependency_hash_path(self):  # noqa: D400
         """:return: File path for direct dependency hash"""
@@ -128,10 +149,18 @@ class PathContext:
         """:return: File path for final output of the bundle for archive v2"""
         return os.path.join(self._bundle_base, 'output.tar')
 
+    def bundle_lock_path(self):  # noqa: D400
+        """:return: File path for the packages pinned by the installers."""
+        return os.path.join(self._bundle_base, 'bundle.lock')
+
     def sources_tar_gz_path(self):  # noqa: D400
         """:return: File path for sources files tarball"""
         return os.path.join(self._bundle_base, 'sources.tar.gz')
 
+    def bundle_fingerprint_path(self):  # noqa: D400
+        """:return: File path for the fingerprint of the last bundle inputs."""
+        return os.path.join(self._bundle_cache, 'bundle_fingerprint.json')
+
     def cache_valid_path(self):  # noqa: D400
         """:return: File path for cache valid file."""
         return os.path.join(self._bundle_cache, '.valid')
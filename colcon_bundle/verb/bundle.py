@@ -9,9 +9,15 @@ from colcon_bundle.installer import add_installer_arguments, \
     BundleInstallerExtensionPoint
 from colcon_bundle.verb._archive_generators import generate_archive_v1, \
     generate_archive_v2
+from colcon_bundle.verb._bundle_fingerprint import bundle_fingerprint, \
+    bundle_up_to_date, record_bundle_fingerprint
+from colcon_bundle.verb._bundle_lock import bundle_lock_key, \
+    read_bundle_lock, write_bundle_lock
 from colcon_bundle.verb._dependency_utilities import \
     package_dependencies_changed
 from colcon_bundle.verb._installer_manager import InstallerManager
+from colcon_bundle.verb._overlay_codecs import DEFAULT_OVERLAY_CODEC, \
+    get_overlay_codec, OVERLAY_CODECS
 from colcon_bundle.verb._path_context import PathContext
 from colcon_core.argument_parser.destination_collector import \
     DestinationCollectorDecorator
@@ -75,6 +81,7 @@ class BundleVerb(VerbExtensionPoint):
         satisfies_version(VerbExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
         self._path_contex = None
         self._installer_manager = None
+        self._package_names = None
 
     def add_arguments(self, *, parser):  # noqa: D102
         parser.add_argument('--build-base', default='build',
@@ -96,11 +103,56 @@ class BundleVerb(VerbExtensionPoint):
         parser.add_argument(
             '--bundle-version', default=2, type=int,
             help='Version of bundle to generate')
+        parser.add_argument(
+            '--bundle-compression-workers', default=1, type=int,
+            help='Number of threads used to compress the overlay archives of '
+                 'the bundle (default: 1)')
+        parser.add_argument(
+            '--overlay-compression', default=DEFAULT_OVERLAY_CODEC,
+            choices=list(OVERLAY_CODECS.keys()),
+            help='Compression used for the overlay archives of a version 2 '
+                 'bundle (default: {})'.format(DEFAULT_OVERLAY_CODEC))
+        parser.add_argument(
+            '--bundle-file-index', action='store_true',
+            help='Add an index of the files in the overlays to the metadata '
+                 'of a version 2 bundle, so single files can be read without '
+                 'decompressing a whole overlay')
+        parser.add_argument(
+            '--bundle-package-overlays', action='store_true',
+            help='Put each workspace package into its own overlay of a '
+                 'version 2 bundle, only the overlays of changed packages are '
+                 'recreated. Requires an isolated install directory')
+        parser.add_argument(
+            '--bundle-stream-workspace', action='store_true',
+            help='Add the install directory to the bundle while it is read '
+                 'instead of copying it to a staging directory first, '
+                 'shebangs are rewritten in memory')
+        parser.add_argument(
+            '--bundle-reproducible', action='store_true',
+            help='Create byte identical overlays for identical inputs by '
+                 'sorting the files, clamping modification times to '
+                 'SOURCE_DATE_EPOCH (0 if unset) and omitting ownership and '
+                 'compression timestamps')
+        parser.add_argument(
+            '--bundle-shared-cache', default=None, metavar='DIR',
+            help='Directory of a package store shared with other bundles. '
+                 'Downloaded packages and built wheels are stored once by '
+                 'their content and linked into the cache of each bundle')
+        parser.add_argument(
+            '--bundle-shared-cache-size', default=10240, type=int,
+            metavar='MB',
+            help='Size the shared package store is reduced to by removing '
+                 'the least recently used packages (default: 10240)')
         parser.add_argument(
             '-U', '--upgrade', action='store_true',
             help='Upgrade all dependencies in the bundle to their latest '
                  'versions'
         )
+        parser.add_argument(
+            '--locked', action='store_true',
+            help='Install exactly the packages pinned in bundle.lock in the '
+                 'bundle base instead of resolving the dependencies. Every '
+                 'run without this option updates bundle.lock')
 
         add_executor_arguments(parser)
         add_event_handler_arguments(parser)
@@ -109,7 +161,10 @@ class BundleVerb(VerbExtensionPoint):
         decorated_parser = DestinationCollectorDecorator(parser)
         add_task_arguments(decorated_parser, 'colcon_bundle.task.bundle', )
         self.task_argument_destinations = decorated_parser.get_destinations()
-        add_installer_arguments(decorated_parser)
+        # Only the installer arguments changing the resolved packages are
+        # part of the key of bundle.lock
+        self.lock_argument_destinations = add_installer_arguments(
+            decorated_parser)
 
     def main(self, *, context: CommandContext):  # noqa: D102
         print('Bundling workspace...')
@@ -127,28 +182,75 @@ class BundleVerb(VerbExtensionPoint):
             install_base,
             merge_install=merge_install)
 
-        self._path_contex = PathContext(install_base,
-                                        bundle_base,
-                                        bundle_version)
+        if context.args.locked and upgrade_deps_graph:
+            raise RuntimeError(
+                'The locked packages can not be upgraded, use --upgrade '
+                'without --locked to update bundle.lock.')
+
+        if context.args.bundle_package_overlays and merge_install:
+            raise RuntimeError(
+                'Package overlays require an isolated install directory, '
+                'they can not be used with --merge-install.')
+
+        overlay_codec = get_overlay_codec(context.args.overlay_compression)
+        overlay_codec.check_available()
+
+        self._path_contex = PathContext(
+            install_base,
+            bundle_base,
+            bundle_version,
+            overlay_extension=overlay_codec.EXTENSION)
         self._installer_manager = InstallerManager(self._path_contex)
 
+        decorators = self._get_decorators(context)
+        if bundle_version == 2:
+            output_path = self._path_contex.bundle_v2_output_path()
+        else:
+            output_path = self._path_contex.bundle_v1_output_path()
+
+        # Nothing is imported or fetched by the installers if the inputs of
+        # the previous bundle did not change
+        fingerprint_files = []
+        if context.args.locked:
+            fingerprint_files.append(self._path_contex.bundle_lock_path())
+        fingerprint = bundle_fingerprint(
+            context.args, decorators, install_base, files=fingerprint_files)
+        if not upgrade_deps_graph and bundle_up_to_date(
+                self._path_contex, fingerprint, output_path):
+            print('Workspace and dependencies not changed, the bundle is '
+                  'up to date')
+            logger.info('Workspace and dependencies not changed, skipping '
+                        'bundle...')
+            return 0
+
         dependencies_changed = self._manage_dependencies(
             context,
             self._path_contex,
+            decorators,
             upgrade_deps_graph)
 
         if context.args.bundle_version == 2:
-            generate_archive_v2(self._path_contex,
-                                [self._path_contex.installer_metadata_path()],
-                                dependencies_changed)
+            generate_archive_v2(
+                self._path_contex,
+                [self._path_contex.installer_metadata_path()],
+                dependencies_changed,
+                compression_workers=context.args.bundle_compression_workers,
+                compression=overlay_codec.NAME,
+                file_index=context.args.bundle_file_index,
+                reproducible=context.args.bundle_reproducible,
+                package_names=self._package_names
+                if context.args.bundle_package_overlays else None,
+                stream_workspace=context.args.bundle_stream_workspace)
         else:
-            generate_archive_v1(self._path_contex)
+            generate_archive_v1(
+                self._path_contex,
+                reproducible=context.args.bundle_reproducible,
+                stream_workspace=context.args.bundle_stream_workspace)
 
+        record_bundle_fingerprint(self._path_contex, fingerprint, output_path)
         return 0
 
-    def _manage_dependencies(self, context,
-                             path_context,
-                             upgrade_deps_graph):
+    def _get_decorators(self, context):
         destinations = self.task_argument_destinations
         decorators = get_packages(context.args,
                                   additional_argument_names=destinations,
@@ -164,8 +266,21 @@ class BundleVerb(VerbExtensionPoint):
                    'issues: https://github.com/colcon/colcon-bundle/issues '\
                    'and we will be happy to help.'
             raise RuntimeError(estr)
+        # The decorators are in topological order
+        self._package_names = [
+            decorator.descriptor.name for decorator in decorators]
+        return decorators
 
-        self._installer_manager.setup_installers(context)
+    def _manage_dependencies(self, context,
+                             path_context,
+                             decorators,
+                             upgrade_deps_graph):
+        lock_key = bundle_lock_key(
+            context.args, self.lock_argument_destinations, decorators)
+        lock = None
+        if context.args.locked:
+            lock = read_bundle_lock(path_context, lock_key)
+        self._installer_manager.setup_installers(context, lock=lock)
 
         print('Checking if dependency tarball exists...')
         logger.info('Checking if dependency tarball exists...')
@@ -183,16 +298,14 @@ class BundleVerb(VerbExtensionPoint):
             self._installer_manager.cache_invalid()
 
         if not os.path.exists(path_context.dependencies_overlay_path()):
-            self._installer_manager.run_installers(
-                include_sources=context.args.include_sources)
+            self._run_installers(context, lock_key)
             return True
         elif upgrade_deps_graph:
             print('Checking if dependency graph has changed since last '
                   'bundle...')
             logger.info('Checking if dependency graph has changed since last'
                         ' bundle...')
-            if self._installer_manager.run_installers(
-                    include_sources=context.args.include_sources):
+            if self._run_installers(context, lock_key):
                 print('All dependencies in dependency graph not changed, '
                       'skipping dependencies update...')
                 logger.info('All dependencies in dependency graph not changed,'
@@ -204,18 +317,26 @@ class BundleVerb(VerbExtensionPoint):
             logger.info(
                 'Checking if local dependencies have changed since last'
                 ' bundle...')
+            # The locked packages may differ from the installed ones
             if not direct_dependencies_changed and \
-                    not installer_parameters_changed:
+                    not installer_parameters_changed and \
+                    not context.args.locked:
                 print('Local dependencies not changed, skipping dependencies'
                       ' update...')
                 logger.info(
                     'Local dependencies not changed, skipping dependencies'
                     ' update...')
                 return False
-            self._installer_manager.run_installers(
-                include_sources=context.args.include_sources)
+            self._run_installers(context, lock_key)
         return True
 
+    def _run_installers(self, context, lock_key):
+        dependency_match = self._installer_manager.run_installers(
+            include_sources=context.args.include_sources)
+        write_bundle_lock(
+            self._path_contex, lock_key, self._installer_manager.get_lock())
+        return dependency_match
+
     def _get_jobs(self, args, installers, decorators):
         jobs = OrderedDict()
         workspace_package_names = [decorator.descriptor.name for decorator in
@@ -1,11 +1,20 @@
+from collections import OrderedDict
+import errno
+import gzip
+import hashlib
+import io
 import json
 import math
+import mmap
 import os
 import tarfile
 import tempfile
 
 from colcon_core.logging import colcon_logger
 
+from ._overlay_codecs import get_overlay_codec, get_overlay_codec_for_path, \
+    GzipOverlayCodec
+from ._overlay_index import read_overlay_range
 from .utilities import filechecksum
 
 logger = colcon_logger.getChild(__name__)
@@ -16,25 +25,63 @@ MAX_METADATA_SIZE = 4 * 1024 * 1024
 # tarfile format used in bundlefiles
 TARFILE_FORMAT = tarfile.GNU_FORMAT
 
+# Format version of bundles whose overlays are all gzip compressed
+BUNDLE_FORMAT_VERSION = '2'
+
+# Format version of bundles with overlays using any other compression,
+# these record the compression of each overlay in overlays.json
+BUNDLE_FORMAT_VERSION_COMPRESSION = '2.1'
+
+# Name of the optional index of the files in all overlays
+FILES_INDEX_NAME = 'files.json'
+
+# Name of the bundle member holding the files index if it does not fit
+# into the metadata archive
+FILES_INDEX_ARCHIVE_NAME = 'files.json.gz'
+
+# errno values signaling a copy method is not supported for the file pair
+_COPY_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.ENOTSUP, errno.EBADF, errno.ETXTBSY}
+
 
 class Bundle:
     """Provides an interface to application bundle files."""
 
     def __init__(self, *, name=None, mode='w'):
         """
-        Open a bundle archive for writing.
+        Open a bundle archive for writing or reading.
 
         mode:
         'w' open for writing
+        'r' open for reading, overlays are accessed through the offsets
+        recorded in overlays.json without reading the rest of the bundle
 
         :param name: path to the bundle archive
         :param mode: mode to open file as
         """
-        self.tarfile = tarfile.open(name, mode, format=TARFILE_FORMAT)
-        self.overlays = []
+        self.tarfile = None
+        self.overlay_archives = []
+        self.overlay_compression = {}
+        self.overlay_checksums = {}
+        self.overlay_indexes = {}
         self.metadata = []
         self.mode = mode
         self.closed = False
+        self.version = None
+        self._file = None
+        self._metadata_files = {}
+        self._overlays = OrderedDict()
+        self._files = None
+        if mode == 'r':
+            self._file = open(name, 'rb')
+            try:
+                self._read_metadata()
+            except Exception:  # noqa: B902
+                self._file.close()
+                raise
+        else:
+            self.tarfile = tarfile.open(name, mode, format=TARFILE_FORMAT)
 
     def add_metadata(self, path):
         """
@@ -45,15 +92,35 @@ class Bundle:
         self._check('w')
         self.metadata.append(path)
 
-    def add_overlay_archive(self, path):
+    def add_overlay_archive(self, path, *, compression=None,
+                            sha256=None, size=None, index=None):
         """
         Add the archive at path to the bundle as an overlay.
 
         This does not write immediately, once the object is closed all
         writes will occur.
+
+        :param path: path to the overlay archive
+        :param compression: name of the overlay codec the archive is
+        compressed with, if None it is derived from the file extension
+        :param sha256: hex digest of the archive if it is already known,
+        otherwise the archive is read to compute it
+        :param size: size in bytes of the archive the sha256 was computed for
+        :param index: location of the files in the archive as returned by
+        OverlayIndex.to_dict, if given for any overlay a files.json index
+        is added to the metadata
         """
         self._check('w')
-        self.overlays.append(path)
+        if compression is None:
+            codec = get_overlay_codec_for_path(path)
+            if codec is not None:
+                compression = codec.NAME
+        self.overlay_archives.append(path)
+        self.overlay_compression[path] = compression
+        if sha256 is not None:
+            self.overlay_checksums[path] = (sha256, size)
+        if index is not None:
+            self.overlay_indexes[path] = index
 
     def _close(self):
         if 'w' in self.mode:
@@ -63,38 +130,55 @@ class Bundle:
             version_path = os.path.join(tempdir, 'version')
 
             with open(version_path, 'w') as v:
-                v.write('2')
+                v.write(self._format_version())
             self.tarfile.add(version_path, arcname='version')
             logger.debug('Start: metadata')
             offset = MAX_METADATA_SIZE
             overlay_metadata = []
-            for overlay in self.overlays:
+            for overlay in self.overlay_archives:
                 name = os.path.basename(overlay)
-                checksum = filechecksum(overlay)
                 info = self.tarfile.gettarinfo(overlay, arcname=name)
                 header_size = len(info.tobuf(TARFILE_FORMAT))
-                file_size = os.stat(overlay).st_size
-                overlay_metadata.append({
+                file_size = info.size
+                checksum = self._overlay_checksum(overlay, file_size)
+                entry = {
                     'name': name,
                     'sha256': checksum,
                     'offset': offset + header_size,
                     'size': file_size
-                })
+                }
+                compression = self.overlay_compression[overlay]
+                if compression is not None:
+                    entry['compression'] = compression
+                overlay_metadata.append(entry)
                 num_blocks = math.ceil(file_size / tarfile.BLOCKSIZE)
                 offset = offset + header_size + num_blocks * tarfile.BLOCKSIZE
 
-            metadata_path = os.path.join(tempdir, 'overlays.json')
-            with open(metadata_path, 'w') as md:
-                metadata = {
-                    'overlays': overlay_metadata
+            files_index = self._files_index()
+            metadata_archive_path = self._write_metadata_archive(
+                tempdir, overlay_metadata, files_index)
+            files_index_path = None
+            # The version, the metadata archive and the header of the pad
+            # all have to fit in front of the first overlay
+            available_size = MAX_METADATA_SIZE - 5 * tarfile.BLOCKSIZE
+            if files_index is not None and \
+                    os.stat(metadata_archive_path).st_size > available_size:
+                # Store the index after the overlays instead
+                files_index_path = os.path.join(
+                    tempdir, FILES_INDEX_ARCHIVE_NAME)
+                with gzip.open(files_index_path, 'wt') as f:
+                    json.dump(files_index, f)
+                info = self.tarfile.gettarinfo(
+                    files_index_path, arcname=FILES_INDEX_ARCHIVE_NAME)
+                files_index_entry = {
+                    'name': FILES_INDEX_ARCHIVE_NAME,
+                    'sha256': filechecksum(files_index_path),
+                    'offset': offset + len(info.tobuf(TARFILE_FORMAT)),
+                    'size': info.size
                 }
-                json.dump(metadata, md)
-
-            metadata_archive_path = os.path.join(tempdir, 'metadata.tar.gz')
-            with tarfile.open(metadata_archive_path, 'w:gz') as md:
-                md.add(metadata_path, arcname=os.path.basename(metadata_path))
-                for item in self.metadata:
-                    md.add(item, arcname=os.path.basename(item))
+                metadata_archive_path = self._write_metadata_archive(
+                    tempdir, overlay_metadata, None,
+                    files_index_entry=files_index_entry)
             self.tarfile.add(metadata_archive_path,
                              arcname=os.path.basename(metadata_archive_path))
             logger.debug('End: metadata')
@@ -109,17 +193,259 @@ class Bundle:
                 f.write(data)
             self.tarfile.add(pad_path, arcname='pad')
             logger.debug('End: pad')
-            for overlay in self.overlays:
+            for overlay in self.overlay_archives:
                 logger.info('Start tar overlay file: %s', overlay)
                 name = os.path.basename(overlay)
-                self.tarfile.add(overlay, arcname=name)
+                _append_file(self.tarfile, overlay, name)
                 logger.info('End tar overlay file: %s', overlay)
+            if files_index_path is not None:
+                self.tarfile.add(
+                    files_index_path, arcname=FILES_INDEX_ARCHIVE_NAME)
             self.tarfile.close()
             logger.debug('End: Bundle')
             self.closed = True
 
+    def _write_metadata_archive(self, tempdir, overlay_metadata,
+                                files_index, *, files_index_entry=None):
+        metadata_path = os.path.join(tempdir, 'overlays.json')
+        with open(metadata_path, 'w') as md:
+            metadata = {
+                'overlays': overlay_metadata
+            }
+            if files_index_entry is not None:
+                metadata['files_index'] = files_index_entry
+            json.dump(metadata, md)
+
+        metadata_archive_path = os.path.join(tempdir, 'metadata.tar.gz')
+        with tarfile.open(metadata_archive_path, 'w:gz') as md:
+            md.add(metadata_path, arcname=os.path.basename(metadata_path))
+            if files_index is not None:
+                files_index_path = os.path.join(tempdir, FILES_INDEX_NAME)
+                with open(files_index_path, 'w') as f:
+                    json.dump(files_index, f)
+                md.add(files_index_path, arcname=FILES_INDEX_NAME)
+            for item in self.metadata:
+                md.add(item, arcname=os.path.basename(item))
+        return metadata_archive_path
+
+    def _files_index(self):
+        if not self.overlay_indexes:
+            return None
+        files = []
+        checkpoints = {}
+        for overlay in self.overlay_archives:
+            if overlay not in self.overlay_indexes:
+                continue
+            name = os.path.basename(overlay)
+            index = self.overlay_indexes[overlay]
+            for entry in index.get('files', []):
+                entry = dict(entry)
+                entry['overlay'] = name
+                files.append(entry)
+            if index.get('checkpoints'):
+                checkpoints[name] = index['checkpoints']
+        return {'files': files, 'checkpoints': checkpoints}
+
+    def _read_metadata(self):
+        # version and metadata.tar.gz are always within the first
+        # MAX_METADATA_SIZE bytes, only that region is parsed
+        size = os.fstat(self._file.fileno()).st_size
+        with _MappedRegion(self._file, 0, min(size, MAX_METADATA_SIZE)) as f:
+            with tarfile.open(fileobj=f, mode='r|') as tar:
+                for member in tar:
+                    if member.name == 'version':
+                        self.version = \
+                            tar.extractfile(member).read().decode().strip()
+                    elif member.name == 'metadata.tar.gz':
+                        metadata_archive = tar.extractfile(member).read()
+                        break
+                else:
+                    raise RuntimeError('Bundle does not contain metadata')
+
+        with tarfile.open(fileobj=io.BytesIO(metadata_archive),
+                          mode='r:gz') as md:
+            for member in md.getmembers():
+                if not member.isfile():
+                    continue
+                self._metadata_files[member.name] = json.loads(
+                    md.extractfile(member).read().decode())
+        for overlay in self._metadata_files['overlays.json']['overlays']:
+            self._overlays[overlay['name']] = overlay
+
+    def get_metadata(self, name):
+        """
+        Get the content of a file from the metadata archive.
+
+        :param name: name of the json file, e.g. installers.json
+        :return: the parsed json content
+        """
+        self._check('r')
+        return self._metadata_files[name]
+
+    def overlays(self):
+        """
+        Get the overlays of the bundle in the order they should be applied.
+
+        :return: list of the overlay entries from overlays.json
+        """
+        self._check('r')
+        return [dict(overlay) for overlay in self._overlays.values()]
+
+    def open_overlay(self, name):
+        """
+        Open an overlay archive of the bundle.
+
+        The data is read straight from the offset recorded in overlays.json,
+        without walking the members of the bundle.
+
+        :param name: name of the overlay as listed by overlays()
+        :return: a tarfile.TarFile which has to be read sequentially, closing
+        it releases the mapping of the overlay data
+        """
+        overlay = self._get_overlay(name)
+        codec = get_overlay_codec(
+            overlay.get('compression', GzipOverlayCodec.NAME))
+        reader = io.BufferedReader(
+            _MappedRegion(self._file, overlay['offset'], overlay['size']))
+        try:
+            stream = codec.open_stream_reader(reader)
+            tar = _OverlayTarFile.open(fileobj=stream, mode='r|')
+        except Exception:  # noqa: B902
+            reader.close()
+            raise
+        tar.overlay_streams = [stream, reader]
+        return tar
+
+    def extract_overlay(self, name, dest):
+        """
+        Extract an overlay archive of the bundle.
+
+        :param name: name of the overlay as listed by overlays()
+        :param dest: directory to extract the overlay to
+        """
+        kwargs = {}
+        # Keep the behavior of extracting with tar, but refuse members
+        # outside of dest
+        if hasattr(tarfile, 'tar_filter'):
+            kwargs['filter'] = 'tar'
+        with self.open_overlay(name) as tar:
+            tar.extractall(dest, **kwargs)
+
+    def verify_overlay(self, name):
+        """
+        Check the sha256 recorded for an overlay.
+
+        :param name: name of the overlay as listed by overlays()
+        :return: True if the overlay data matches its checksum
+        """
+        overlay = self._get_overlay(name)
+        hasher = hashlib.sha256()
+        with _MappedRegion(
+                self._file, overlay['offset'], overlay['size']) as region:
+            for chunk in iter(lambda: region.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest() == overlay['sha256']
+
+    def files(self):
+        """
+        Get the index of the files in the overlays of the bundle.
+
+        :return: list of the file entries with the 'path', 'overlay',
+        'offset', 'size', 'mode' and 'sha256' of each file, or None if the
+        bundle was created without a files index
+        """
+        index = self._get_files_index()
+        if index is None:
+            return None
+        return [dict(entry) for entry in index['files']]
+
+    def read_file(self, path, *, overlay=None):
+        """
+        Read a single file from the overlays of the bundle.
+
+        Only the part of the overlay holding the file is decompressed if
+        the overlay has checkpoints, see files().
+
+        :param path: path of the file inside the overlay
+        :param overlay: name of the overlay to read from, if None the file
+        of the last overlay containing path is returned
+        :return: the content of the file
+        :raises KeyError: if the bundle has no file index or does not
+        contain the file
+        :raises RuntimeError: if the content does not match its checksum
+        """
+        index = self._get_files_index()
+        if index is None:
+            raise KeyError('Bundle has no files index')
+        entry = None
+        for candidate in index['files']:
+            if candidate['path'] == path and \
+                    overlay in (None, candidate['overlay']):
+                entry = candidate
+        if entry is None:
+            raise KeyError('Bundle has no file named {}'.format(path))
+        overlay_entry = self._get_overlay(entry['overlay'])
+        with _MappedRegion(self._file, overlay_entry['offset'],
+                           overlay_entry['size']) as region:
+            data = read_overlay_range(
+                io.BufferedReader(region),
+                overlay_entry.get('compression', GzipOverlayCodec.NAME),
+                index['checkpoints'].get(entry['overlay']),
+                entry['offset'], entry['size'])
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise RuntimeError(
+                'Checksum mismatch for {} in {}'.format(
+                    path, entry['overlay']))
+        return data
+
+    def _get_files_index(self):
+        self._check('r')
+        if self._files is not None:
+            return self._files
+        if FILES_INDEX_NAME in self._metadata_files:
+            self._files = self._metadata_files[FILES_INDEX_NAME]
+            return self._files
+        entry = self._metadata_files['overlays.json'].get('files_index')
+        if entry is None:
+            return None
+        with _MappedRegion(
+                self._file, entry['offset'], entry['size']) as region:
+            data = region.read()
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise RuntimeError('Checksum mismatch for the files index')
+        self._files = json.loads(gzip.decompress(data).decode())
+        return self._files
+
+    def _get_overlay(self, name):
+        self._check('r')
+        try:
+            return self._overlays[name]
+        except KeyError:
+            raise KeyError('Bundle has no overlay named {}'.format(name))
+
+    def _overlay_checksum(self, overlay, file_size):
+        if overlay not in self.overlay_checksums:
+            return filechecksum(overlay)
+        checksum, size = self.overlay_checksums[overlay]
+        if size is not None and size != file_size:
+            raise RuntimeError(
+                'Overlay {} was modified after its checksum was '
+                'computed'.format(overlay))
+        return checksum
+
+    def _format_version(self):
+        for compression in self.overlay_compression.values():
+            if compression not in (None, GzipOverlayCodec.NAME):
+                return BUNDLE_FORMAT_VERSION_COMPRESSION
+        return BUNDLE_FORMAT_VERSION
+
     def close(self):  # noqa: N806
         """Close the archive."""
+        if self.mode == 'r':
+            if not self.closed:
+                self._file.close()
+                self.closed = True
+            return
         self._close()
 
     def _check(self, mode=None):
@@ -134,3 +460,159 @@ class Bundle:
 
     def __exit__(self, t, value, traceback):  # noqa: D105
         self.close()
+
+
+class _OverlayTarFile(tarfile.TarFile):
+    """TarFile which closes the streams of the overlay it reads."""
+
+    overlay_streams = ()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for stream in self.overlay_streams:
+                stream.close()
+            self.overlay_streams = ()
+
+
+class _MappedRegion(io.RawIOBase):
+    """
+    Read-only file object over a byte range of a file.
+
+    The range is memory mapped, if it can not be mapped (e.g. a large region
+    on a 32 bit system) it is read with positional reads instead.
+    """
+
+    def __init__(self, f, offset, size):
+        super().__init__()
+        self._fd = f.fileno()
+        self._offset = offset
+        self._size = size
+        self._position = 0
+        self._map = None
+        # mmap offsets have to be a multiple of the allocation granularity
+        self._delta = offset % mmap.ALLOCATIONGRANULARITY
+        if size > 0:
+            try:
+                self._map = mmap.mmap(
+                    self._fd, self._delta + size, access=mmap.ACCESS_READ,
+                    offset=offset - self._delta)
+            except (OSError, OverflowError, ValueError):
+                self._map = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, min(offset, self._size))
+        return self._position
+
+    def readinto(self, b):
+        count = min(len(b), self._size - self._position)
+        if count <= 0:
+            return 0
+        if self._map is not None:
+            start = self._delta + self._position
+            b[:count] = self._map[start:start + count]
+        else:
+            data = os.pread(self._fd, count, self._offset + self._position)
+            count = len(data)
+            b[:count] = data
+        self._position += count
+        return count
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        super().close()
+
+
+def _append_file(tar, path, arcname):
+    """
+    Append the file at path to tar without copying it through Python.
+
+    This writes the same bytes as tarfile.TarFile.add, but the file content
+    is copied by the kernel.
+
+    :param tar: tarfile.TarFile opened for writing to a regular file
+    :param path: path of the regular file to append
+    :param arcname: name of the member in the archive
+    """
+    info = tar.gettarinfo(path, arcname=arcname)
+    buf = info.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+    tar.fileobj.flush()
+
+    with open(path, 'rb') as f:
+        _copy_file_data(f.fileno(), tar.fileobj.fileno(),
+                        tar.offset, info.size)
+    tar.fileobj.seek(tar.offset + info.size)
+
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+    tar.members.append(info)
+
+
+def _copy_file_data(src_fd, dst_fd, dst_offset, size):
+    """
+    Copy size bytes from the start of src_fd into dst_fd at dst_offset.
+
+    Try, in this order, copy_file_range and sendfile before falling back to
+    a regular read/write loop.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        copied = _copy_with(
+            lambda offset, count: os.copy_file_range(
+                src_fd, dst_fd, count, offset, dst_offset + offset),
+            copied, size)
+    if copied < size and hasattr(os, 'sendfile'):
+        def sendfile(offset, count):
+            os.lseek(dst_fd, dst_offset + offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        copied = _copy_with(sendfile, copied, size)
+    while copied < size:
+        os.lseek(src_fd, copied, os.SEEK_SET)
+        os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+        data = os.read(src_fd, min(size - copied, 1024 * 1024))
+        if not data:
+            raise RuntimeError('Unexpected end of file while copying')
+        written = 0
+        while written < len(data):
+            written += os.write(dst_fd, data[written:])
+        copied += len(data)
+
+
+def _copy_with(copy_range, copied, size):
+    """
+    Copy with copy_range(offset, count) until size bytes are copied.
+
+    :return: the number of bytes copied, less than size if the copy method
+    is not supported for these files
+    """
+    try:
+        while copied < size:
+            count = copy_range(copied, size - copied)
+            if count == 0:
+                break
+            copied += count
+    except OSError as e:
+        if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+            raise
+    return copied
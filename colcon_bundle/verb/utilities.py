@@ -2,10 +2,12 @@
 # SPDX-License-Identifier: Apache-2.0
 import hashlib
 import itertools
+import json
 import os
 from pathlib import Path
 import re
 import shutil
+import stat
 import subprocess
 import sys
 
@@ -48,6 +50,15 @@ def get_ubuntu_distribution_version():
         raise ValueError('Unsupported distribution', distribution)
 
 
+# Parse the shebang
+_SHEBANG_REGEX = re.compile(r'^#!\s*\S*.')
+# Shebangs in templates are a special case we need to handle.
+# Example: #!@PYTHON_EXECUTABLE@
+_TEMPLATE_SHEBANG_REGEX = re.compile(r'^#!\s*@\S*.@')
+# Parse the command to execute in the shebang
+_CMD_REGEX = re.compile(r'([^\/]*)\/*$')
+
+
 def update_shebang(path):
     """
     Search and replace shebangs in path and all sub-paths with /usr/bin/env.
@@ -58,56 +69,186 @@ def update_shebang(path):
 
     :param path: Path to directory with files to replace shebang in.
     """
-    # Parse the shebang
-    shebang_regex = re.compile(r'^#!\s*\S*.')
-    # Shebangs in templates are a special case we need to handle.
-    # Example: #!@PYTHON_EXECUTABLE@
-    template_shebang_regex = re.compile(r'^#!\s*@\S*.@')
-    # Parse the command to execute in the shebang
-    cmd_regex = re.compile(r'([^\/]*)\/*$')
     logger.info('Starting shebang update...')
     for (root, dirs, files) in os.walk(path):
         for file in files:
-            file_path = os.path.join(root, file)
-            if not os.path.islink(file_path) and \
-                    '.so' not in os.path.basename(file_path) and \
-                    'README' not in os.path.basename(file_path):
-                with open(file_path, 'rb+') as file_handle:
-                    contents = file_handle.read()
-                    try:
-                        str_contents = contents.decode()
-                    except UnicodeError:
-                        continue
-                    template_shebang_match = template_shebang_regex.match(
-                        str_contents)
-                    if template_shebang_match:
-                        logger.debug('Skipping templated shebang')
-                        continue
-                    shebang_match = shebang_regex.match(str_contents)
-                    if shebang_match:
-                        shebang_str = shebang_match.group(0)
-                        logger.info('Found shebang in {}'.format(file_path))
-                        shebang_command = cmd_regex.search(shebang_str)
-                        if not shebang_command:
-                            logger.warning(
-                              'Unable to find shebang command in {}.'
-                              'It may be malformed.'.format(file_path))
-                            continue
-                        shebang_command = shebang_command.group(0)
-                        if shebang_command.strip() == ENV_COMMAND:
-                            logger.debug('Valid shebang for {}.'
-                                         'Skipping.'.format(file_path))
-                            continue
-                        logger.info('Modifying shebang for {}'.format(
-                            file_path))
-                        result, _ = shebang_regex.subn(
-                          '#!/usr/bin/env {}'.format(shebang_command),
-                          str_contents,
-                          count=1
-                        )
-                        file_handle.seek(0)
-                        file_handle.truncate()
-                        file_handle.write(result.encode())
+            update_file_shebang(os.path.join(root, file))
+
+
+def update_file_shebang(file_path):
+    """
+    Replace the shebang of a single file with /usr/bin/env.
+
+    Symlinks are skipped, see rewrite_shebang for the other files which are
+    not modified.
+
+    :param file_path: Path to the file to replace the shebang in.
+    """
+    if os.path.islink(file_path):
+        return
+    with open(file_path, 'rb+') as file_handle:
+        result = rewrite_shebang(file_path, file_handle.read())
+        if result is not None:
+            file_handle.seek(0)
+            file_handle.truncate()
+            file_handle.write(result)
+
+
+def rewrite_shebang(file_path, contents):
+    """
+    Replace the shebang in the contents of a file with /usr/bin/env.
+
+    Shared libraries, READMEs, files which are not valid unicode and
+    templated shebangs are not modified.
+
+    :param file_path: Path of the file the contents belong to
+    :param bytes contents: The contents of the file
+    :return: the modified contents or None if they are not modified
+    """
+    if '.so' in os.path.basename(file_path) or \
+            'README' in os.path.basename(file_path):
+        return None
+    try:
+        str_contents = contents.decode()
+    except UnicodeError:
+        return None
+    template_shebang_match = _TEMPLATE_SHEBANG_REGEX.match(str_contents)
+    if template_shebang_match:
+        logger.debug('Skipping templated shebang')
+        return None
+    shebang_match = _SHEBANG_REGEX.match(str_contents)
+    if not shebang_match:
+        return None
+    shebang_str = shebang_match.group(0)
+    logger.info('Found shebang in {}'.format(file_path))
+    shebang_command = _CMD_REGEX.search(shebang_str)
+    if not shebang_command:
+        logger.warning(
+          'Unable to find shebang command in {}.'
+          'It may be malformed.'.format(file_path))
+        return None
+    shebang_command = shebang_command.group(0)
+    if shebang_command.strip() == ENV_COMMAND:
+        logger.debug('Valid shebang for {}.'
+                     'Skipping.'.format(file_path))
+        return None
+    logger.info('Modifying shebang for {}'.format(
+        file_path))
+    result, _ = _SHEBANG_REGEX.subn(
+      '#!/usr/bin/env {}'.format(shebang_command),
+      str_contents,
+      count=1
+    )
+    return result.encode()
+
+
+def sync_directory(src, dst, manifest_path, *, ignore=None):
+    """
+    Incrementally update dst to be a copy of the directory src.
+
+    Like shutil.copytree symlinks are followed, the targets are copied and
+    their mode, size, modification time and inode are recorded in a
+    manifest. On the next sync only entries whose record
+    changed are copied and entries which were removed from src are deleted
+    from dst. If there is no manifest dst is recreated from scratch.
+
+    Files in dst may be modified after the sync, they are only replaced
+    once the corresponding file in src changes.
+
+    :param src: directory to copy
+    :param dst: destination directory
+    :param manifest_path: path of the json file recording the state of src
+    at the last sync, it must not be inside of dst
+    :param ignore: callable like the ignore argument of shutil.copytree
+    :return: list of the paths of the files in dst which were copied
+    """
+    manifest = None
+    if os.path.isdir(dst) and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            manifest = None
+    if manifest is None:
+        logger.info('No manifest for {}, copying all files'.format(dst))
+        shutil.rmtree(dst, ignore_errors=True)
+        manifest = {}
+    os.makedirs(dst, exist_ok=True)
+
+    entries = {}
+    copied = []
+    changed_dirs = []
+    for root, dirs, files in os.walk(src, followlinks=True):
+        rel_root = os.path.relpath(root, src)
+        if ignore is not None:
+            ignored = set(ignore(root, dirs + files))
+            dirs[:] = [name for name in dirs if name not in ignored]
+            files = [name for name in files if name not in ignored]
+        dirs.sort()
+        for name in sorted(dirs + files):
+            src_path = os.path.join(root, name)
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            dst_path = os.path.join(dst, rel_path)
+            stat_result = os.stat(src_path)
+            entry = [stat_result.st_mode, stat_result.st_size,
+                     stat_result.st_mtime_ns, stat_result.st_ino]
+            entries[rel_path] = entry
+            if manifest.get(rel_path) == entry and \
+                    os.path.lexists(dst_path):
+                continue
+            if stat.S_ISDIR(stat_result.st_mode):
+                if os.path.islink(dst_path) or (
+                        os.path.lexists(dst_path) and
+                        not os.path.isdir(dst_path)):
+                    os.remove(dst_path)
+                os.makedirs(dst_path, exist_ok=True)
+                changed_dirs.append((src_path, dst_path))
+                continue
+            # Replace instead of overwriting, the file might be read-only
+            if os.path.lexists(dst_path):
+                _remove_path(dst_path)
+            shutil.copy2(src_path, dst_path)
+            copied.append(dst_path)
+
+    for rel_path in sorted(set(manifest) - set(entries), reverse=True):
+        dst_path = os.path.join(dst, rel_path)
+        if os.path.lexists(dst_path):
+            _remove_path(dst_path)
+
+    # Copy the directory metadata after their content has been updated
+    for src_path, dst_path in reversed(changed_dirs):
+        shutil.copystat(src_path, dst_path)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(entries, f)
+    logger.info('Synced {} files from {} to {}'.format(
+        len(copied), src, dst))
+    return copied
+
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def remove_empty_parents(root, path):
+    """
+    Remove path and its parent directories as long as they are empty.
+
+    :param root: directory which is never removed
+    :param path: directory below root
+    """
+    root = os.path.abspath(root)
+    path = os.path.abspath(path)
+    while path != root and path.startswith(root + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            # The directory is not empty
+            return
+        path = os.path.dirname(path)
 
 
 def update_symlinks(base_path):
@@ -254,3 +395,112 @@ def filechecksum(filename, algorithm='sha256', printing=False):
         return checksum
     except Exception as e:
         raise RuntimeError(e)
+
+
+def directory_fingerprint(path, algorithm='sha256'):
+    """
+    Generate a hash of the state of all files inside a directory.
+
+    The relative path, mode, size, modification time and inode of every
+    entry and the target of every symlink are hashed, so the content of the
+    files is not read. Symlinks are followed like when the directory is
+    copied, so any file that is added, removed or rewritten changes the
+    hash, even if it is only linked from the directory.
+
+    :param path: directory to fingerprint
+    :param algorithm: name of a hashlib algorithm
+    :return: the hex digest
+    :rtype: str
+    """
+    hasher = hashlib.new(algorithm)
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            entry_path = os.path.join(root, name)
+            try:
+                stat_result = os.stat(entry_path)
+            except FileNotFoundError:
+                # Dangling symlink
+                stat_result = os.lstat(entry_path)
+            entry = [os.path.relpath(entry_path, path), stat_result.st_mode,
+                     stat_result.st_size, stat_result.st_mtime_ns,
+                     stat_result.st_ino]
+            if os.path.islink(entry_path):
+                entry.append(os.readlink(entry_path))
+            hasher.update(json.dumps(entry).encode() + b'\n')
+    return hasher.hexdigest()
+
+
+class HashingWriter:
+    """
+    Binary file wrapper which hashes all data while it is written.
+
+    This allows computing the checksum of a file while it is produced
+    instead of reading it back from disk afterwards.
+    """
+
+    def __init__(self, fileobj, algorithm='sha256'):
+        """
+        Wrap fileobj.
+
+        :param fileobj: binary file object to write to
+        :param algorithm: name of a hashlib algorithm
+        """
+        self._fileobj = fileobj
+        self._hasher = hashlib.new(algorithm)
+        self.name = getattr(fileobj, 'name', None)
+        self.size = 0
+
+    def write(self, data):
+        """
+        Write data to the wrapped file object and hash it.
+
+        :param data: bytes-like object
+        :return: the number of bytes written
+        """
+        self._hasher.update(data)
+        self.size += len(data)
+        return self._fileobj.write(data)
+
+    def tell(self):
+        """:return: the number of bytes written so far."""
+        return self.size
+
+    def flush(self):
+        """Flush the wrapped file object."""
+        self._fileobj.flush()
+
+    def hexdigest(self):
+        """:return: the hex digest of all data written so far."""
+        return self._hasher.hexdigest()
+
+
+class HashingReader:
+    """Binary file wrapper which hashes all data while it is read."""
+
+    def __init__(self, fileobj, algorithm='sha256'):
+        """
+        Wrap fileobj.
+
+        :param fileobj: binary file object to read from
+        :param algorithm: name of a hashlib algorithm
+        """
+        self._fileobj = fileobj
+        self._hasher = hashlib.new(algorithm)
+        self.size = 0
+
+    def read(self, size=-1):
+        """
+        Read from the wrapped file object and hash the data.
+
+        :param size: maximum number of bytes to read, -1 reads all
+        :return: the bytes read
+        """
+        data = self._fileobj.read(size)
+        self._hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        """:return: the hex digest of all data read so far."""
+        return self._hasher.hexdigest()
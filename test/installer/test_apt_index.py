@@ -0,0 +1,288 @@
+import gzip
+import os
+import shutil
+from tempfile import mkdtemp
+
+from colcon_bundle.installer._apt_index import compare_versions, \
+    IndexCache, parse_relationships, version_satisfies
+import pytest
+
+PACKAGES = """\
+Package: app
+Version: 1.0-1
+Architecture: amd64
+Filename: pool/main/a/app/app_1.0-1_amd64.deb
+Size: 100
+SHA256: aaaa
+Pre-Depends: libc6 (>= 2.27)
+Depends: libfoo (>= 2.0) | libfoo-legacy, mail-transport-agent,
+ python3:any, base-files
+
+Package: libc6
+Version: 2.27-3
+Architecture: amd64
+Filename: pool/main/g/glibc/libc6_2.27-3_amd64.deb
+Size: 100
+SHA256: cccc
+Source: glibc
+Depends: libgcc1
+
+Package: libgcc1
+Version: 1:8-1
+Architecture: amd64
+Filename: pool/main/g/gcc/libgcc1_8-1_amd64.deb
+Size: 100
+SHA256: gggg
+Source: gcc (8-1)
+Description: multiline descriptions
+ are skipped
+
+Package: libfoo
+Version: 1.5
+Architecture: amd64
+Filename: pool/main/libf/libfoo/libfoo_1.5_amd64.deb
+Size: 100
+SHA256: f150
+
+Package: libfoo
+Version: 2.1~rc1
+Architecture: amd64
+Filename: pool/main/libf/libfoo/libfoo_2.1~rc1_amd64.deb
+Size: 100
+SHA256: f210
+
+Package: libfoo
+Version: 3.0
+Architecture: armhf
+Filename: pool/main/libf/libfoo/libfoo_3.0_armhf.deb
+Size: 100
+SHA256: f300
+
+Package: postfix
+Version: 3.3
+Architecture: amd64
+Filename: pool/main/p/postfix/postfix_3.3_amd64.deb
+Size: 100
+SHA256: pppp
+Provides: mail-transport-agent
+Depends: base-files
+
+Package: python3
+Version: 3.6
+Architecture: all
+Filename: pool/main/p/python3/python3_3.6_all.deb
+Size: 100
+SHA256: 3333
+
+Package: broken
+Version: 1
+Architecture: all
+Filename: pool/main/b/broken/broken_1_all.deb
+Size: 100
+SHA256: 0000
+Depends: libfoo (>= 4)
+
+Package: base-files
+Version: 10
+Architecture: amd64
+Filename: pool/main/b/base-files/base-files_10_amd64.deb
+Size: 100
+SHA256: bbbb
+
+Package: legacy
+Version: 1
+Architecture: all
+Filename: pool/main/l/legacy/legacy_1_all.deb
+Size: 100
+SHA256: 1111
+Depends: libfoo (<< 2.0)
+
+Package: mailer
+Version: 2
+Architecture: all
+Filename: pool/main/m/mailer/mailer_2_all.deb
+Size: 100
+SHA256: m200
+Provides: libmail (= 2)
+
+Package: mailer
+Version: 1
+Architecture: all
+Filename: pool/main/m/mailer/mailer_1_all.deb
+Size: 100
+SHA256: m100
+Provides: libmail (= 1)
+
+Package: old-mail-client
+Version: 1
+Architecture: all
+Filename: pool/main/o/old-mail-client/old-mail-client_1_all.deb
+Size: 100
+SHA256: o100
+Depends: libmail (<< 2)
+
+Package: mail-client
+Version: 1
+Architecture: all
+Filename: pool/main/m/mail-client/mail-client_1_all.deb
+Size: 100
+SHA256: c100
+Depends: libmail (>= 2)
+"""
+
+
+@pytest.mark.parametrize('a,b,expected', [
+    ('1.0', '1.0', 0),
+    ('1.0', '1.1', -1),
+    ('1.10', '1.9', 1),
+    ('1.0~rc1', '1.0', -1),
+    ('1.0~rc1', '1.0~rc2', -1),
+    ('1.0', '1.0+b1', -1),
+    ('1:0.1', '2.0', 1),
+    ('2.0-1', '2.0-2', -1),
+    ('2.0-10', '2.0-9', 1),
+    ('1.0a', '1.0', 1),
+    ('1.001', '1.1', 0),
+])
+def test_compare_versions(a, b, expected):
+    result = compare_versions(a, b)
+    assert (result > 0) - (result < 0) == expected
+    result = compare_versions(b, a)
+    assert (result > 0) - (result < 0) == -expected
+
+
+def test_version_satisfies():
+    assert version_satisfies('1.0', None, None)
+    assert version_satisfies('1.0', '>=', '1.0')
+    assert not version_satisfies('1.0', '>>', '1.0')
+    assert version_satisfies('1.0', '<<', '1.1')
+    assert version_satisfies('1.0', '=', '1.0')
+    assert not version_satisfies('1.0', '=', '1.0-1')
+
+
+def test_parse_relationships():
+    assert parse_relationships(None) == []
+    assert parse_relationships(
+        'libc6 (>= 2.27), python3:any, libfoo (<< 2) | libbar,\n base') == [
+        [('libc6', '>=', '2.27')],
+        [('python3', None, None)],
+        [('libfoo', '<<', '2'), ('libbar', None, None)],
+        [('base', None, None)],
+    ]
+
+
+class TestIndexCache:
+
+    def setup_method(self):
+        self.rootdir = mkdtemp()
+        lists_path = os.path.join(self.rootdir, 'var', 'lib', 'apt', 'lists')
+        os.makedirs(lists_path)
+        os.makedirs(os.path.join(self.rootdir, 'var', 'cache', 'apt'))
+        with gzip.open(os.path.join(
+                lists_path, 'archive_dists_main_binary-amd64_Packages.gz'),
+                'wt') as f:
+            f.write(PACKAGES)
+        self.cache = IndexCache(self.rootdir, ['apt-get'], ['amd64', 'all'])
+        self.cache.open()
+
+    def teardown_method(self):
+        self.cache.close()
+        shutil.rmtree(self.rootdir)
+
+    def _marked(self):
+        return {package.name: package.candidate.version
+                for package in self.cache}
+
+    def test_unknown_package(self):
+        with pytest.raises(KeyError):
+            self.cache['missing']
+
+    def test_versions(self):
+        package = self.cache['libfoo']
+        # Packages of other architectures are not indexed
+        assert [v.version for v in package.versions] == ['2.1~rc1', '1.5']
+        assert package.candidate.version == '2.1~rc1'
+        assert self.cache['libgcc1'].candidate.source_name == 'gcc'
+        assert self.cache['libgcc1'].candidate.source_version == '8-1'
+        assert self.cache['libc6'].candidate.source_version == '2.27-3'
+
+    def test_closure(self):
+        with self.cache.actiongroup():
+            self.cache['app'].mark_install(auto_fix=False, from_user=False)
+            # The closure is computed once the action group ends
+            assert self._marked() == {}
+        assert self._marked() == {
+            'app': '1.0-1',
+            'libc6': '2.27-3',
+            'libgcc1': '1:8-1',
+            'libfoo': '2.1~rc1',
+            'postfix': '3.3',
+            'python3': '3.6',
+            'base-files': '10',
+        }
+
+    def test_closure_excludes_blacklist(self):
+        self.cache.exclude(['base-files', 'libc6'])
+        self.cache['app'].mark_install()
+        assert self._marked() == {
+            'app': '1.0-1',
+            'libfoo': '2.1~rc1',
+            'postfix': '3.3',
+            'python3': '3.6',
+        }
+
+    def test_requested_version(self):
+        package = self.cache['libfoo']
+        package.candidate = package.versions.get('1.5')
+        with self.cache.actiongroup():
+            package.mark_install()
+            self.cache['legacy'].mark_install()
+        assert self._marked() == {'libfoo': '1.5', 'legacy': '1'}
+
+    def test_requested_version_conflict(self):
+        package = self.cache['libfoo']
+        package.candidate = package.versions.get('1.5')
+        with pytest.raises(RuntimeError, match='conflicts'):
+            with self.cache.actiongroup():
+                package.mark_install()
+                # The requested version does not satisfy app
+                self.cache['app'].mark_install()
+
+    def test_conflicting_dependencies(self):
+        # app selects the newest libfoo, which legacy does not accept
+        with pytest.raises(RuntimeError, match='conflicts'):
+            with self.cache.actiongroup():
+                self.cache['app'].mark_install()
+                self.cache['legacy'].mark_install()
+
+    def test_versioned_provides(self):
+        self.cache['old-mail-client'].mark_install()
+        # Only the older version of the provider satisfies the dependency
+        assert self._marked() == {'old-mail-client': '1', 'mailer': '1'}
+
+    def test_versioned_provides_of_selected_version(self):
+        package = self.cache['mailer']
+        package.candidate = package.versions.get('1')
+        with pytest.raises(RuntimeError, match='Unable to satisfy'):
+            with self.cache.actiongroup():
+                package.mark_install()
+                # The selected version does not provide libmail 2
+                self.cache['mail-client'].mark_install()
+
+    def test_locked_packages_without_dependencies(self):
+        self.cache['app'].mark_install(auto_inst=False)
+        assert self._marked() == {'app': '1.0-1'}
+        self.cache['app'].mark_delete()
+        assert self._marked() == {}
+
+    def test_unsatisfiable(self):
+        with pytest.raises(RuntimeError):
+            self.cache['broken'].mark_install()
+
+    def test_index_is_reused(self):
+        self.cache.close()
+        self.cache.open()
+        assert not self.cache._index.update(
+            [os.path.join(self.cache.lists_path, name)
+             for name in os.listdir(self.cache.lists_path)],
+            ['amd64', 'all'])
@@ -1,14 +1,20 @@
+import json
 import os
 import shutil
+import subprocess
 import sys
 from tempfile import mkdtemp, mkstemp
+import time
 from unittest import mock
 
 import unittest
 from unittest.mock import patch, Mock
 
-from colcon_bundle.installer.apt import AptBundleInstallerExtension
+from colcon_bundle.installer.apt import _extract_debs_concurrently, \
+    _fetch_source, _link_sources, _package_lists_fresh, \
+    AptBundleInstallerExtension
 from colcon_bundle.installer import BundleInstallerContext
+from colcon_bundle.verb.utilities import update_shebang
 
 
 class AptInstallerTests(unittest.TestCase):
@@ -24,12 +30,22 @@ class AptInstallerTests(unittest.TestCase):
             apt = AptBundleInstallerExtension()
             assert apt.should_load() == True
 
+    @patch('colcon_bundle.installer.apt.shutil.which', return_value=None)
     @patch('colcon_bundle.installer.apt.get_ubuntu_distribution_version')
-    def test_should_load_on_ubuntu_no_python3_apt(self, _):
+    def test_should_load_on_ubuntu_no_python3_apt(self, *_):
         with patch.dict("sys.modules", apt=None):
             apt = AptBundleInstallerExtension()
             with self.assertRaises(RuntimeError): apt.should_load()
 
+    @patch('colcon_bundle.installer.apt.shutil.which',
+           return_value='/usr/bin/apt-get')
+    @patch('colcon_bundle.installer.apt.get_ubuntu_distribution_version')
+    def test_should_load_on_ubuntu_apt_get_only(self, *_):
+        # The index resolver does not need python3-apt
+        with patch.dict('sys.modules', apt=None):
+            apt = AptBundleInstallerExtension()
+            assert apt.should_load() is True
+
     def _run_add_to_install_list_test(self, package_name, package_version):
         # We import apt inside the method it is used so we can't @patch it like
         # a normal import
@@ -41,6 +57,9 @@ class AptInstallerTests(unittest.TestCase):
             try:
                 context_args = Mock()
                 context_args.apt_sources_list = sources_list
+                context_args.apt_update_ttl = 0
+                context_args.apt_resolver = 'python-apt'
+                context_args.upgrade = False
                 context = BundleInstallerContext(args=context_args, cache_path=cache_dir, prefix_path=prefix)
                 installer = AptBundleInstallerExtension()
 
@@ -53,6 +72,7 @@ class AptInstallerTests(unittest.TestCase):
                 package_mock.versions.get.return_value = candidate_mock
 
                 installer.add_to_install_list(package_name + "=" + package_version)
+                installer._mark_requested_packages()
 
                 apt.Cache().__getitem__.assert_called_with(package_name)
                 package_mock.versions.get.assert_called_with(package_version, default_candidate)
@@ -75,3 +95,290 @@ class AptInstallerTests(unittest.TestCase):
         self._run_add_to_install_list_test(package_name, '')
 
 
+class AptUpdateStampTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.stamp_path = os.path.join(self.tmpdir, 'update_stamp.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_stamp(self, key, age):
+        with open(self.stamp_path, 'w') as f:
+            f.write(json.dumps({'key': key, 'time': time.time() - age}))
+
+    def test_no_stamp(self):
+        self.assertFalse(_package_lists_fresh(self.stamp_path, 'key', 60))
+
+    def test_fresh(self):
+        self._write_stamp('key', 10)
+        self.assertTrue(_package_lists_fresh(self.stamp_path, 'key', 60))
+
+    def test_expired(self):
+        self._write_stamp('key', 120)
+        self.assertFalse(_package_lists_fresh(self.stamp_path, 'key', 60))
+
+    def test_sources_changed(self):
+        self._write_stamp('key', 10)
+        self.assertFalse(
+            _package_lists_fresh(self.stamp_path, 'other', 60))
+
+    def test_ttl_disabled(self):
+        self._write_stamp('key', 0)
+        self.assertFalse(_package_lists_fresh(self.stamp_path, 'key', 0))
+
+
+def _fake_extract_deb(deb_path, destination, **kwargs):
+    # Each fake package contains a shared file and a file of its own
+    name = os.path.basename(deb_path)
+    os.makedirs(os.path.join(destination, 'usr', 'share', name))
+    with open(os.path.join(destination, 'usr', 'shared'), 'w') as f:
+        f.write(name)
+    with open(os.path.join(destination, 'usr', 'share', name, 'file'),
+              'w') as f:
+        f.write(name)
+
+
+class AptExtractTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('colcon_bundle.installer.apt._extract_deb',
+           side_effect=_fake_extract_deb)
+    def test_extract_debs_concurrently(self, _):
+        prefix = os.path.join(self.tmpdir, 'prefix')
+        debs = ['a.deb', 'b.deb', 'c.deb']
+
+        contributed = _extract_debs_concurrently(debs, prefix, 3)
+
+        with open(os.path.join(prefix, 'usr', 'shared')) as f:
+            # The last package wins like in a serial extraction
+            self.assertEqual('c.deb', f.read())
+        for deb in debs:
+            self.assertTrue(os.path.isfile(
+                os.path.join(prefix, 'usr', 'share', deb, 'file')))
+            self.assertIn(os.path.join('usr', 'shared'), contributed[deb])
+        # The temporary extraction directories are removed
+        self.assertEqual(['prefix'], os.listdir(self.tmpdir))
+
+
+def _fake_package(name, version, files):
+    package = Mock()
+    package.name = name
+    package.shortname = name
+    package.marked_install = True
+    package.candidate.version = version
+    package.candidate.architecture = 'amd64'
+    package.files = files
+    return package
+
+
+class AptManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.prefix = os.path.join(self.tmpdir, 'prefix')
+        self.archives = os.path.join(
+            self.cache_dir, 'var', 'cache', 'apt', 'archives')
+        os.makedirs(self.archives)
+        os.makedirs(self.prefix)
+        blacklist = os.path.join(self.tmpdir, 'blacklist')
+        open(blacklist, 'w').close()
+        context_args = Mock()
+        context_args.apt_package_blacklist = blacklist
+        context_args.apt_extract_workers = 1
+        context = BundleInstallerContext(
+            args=context_args, cache_path=self.cache_dir,
+            prefix_path=self.prefix)
+        self.installer = AptBundleInstallerExtension()
+        self.installer.context = context
+        self.installer._cache_dir = self.cache_dir
+        self.installer._fetch_packages = Mock()
+        self.packages = {}
+
+    def tearDown(self):
+        self.installer._cache = None
+        shutil.rmtree(self.tmpdir)
+
+    def _extract_deb(self, deb_path, destination, **kwargs):
+        package = self.packages[os.path.basename(deb_path)]
+        for rel_path in package.files:
+            os.makedirs(os.path.join(destination, os.path.dirname(rel_path)),
+                        exist_ok=True)
+            with open(os.path.join(destination, rel_path), 'w') as f:
+                if isinstance(package.files, dict):
+                    f.write(package.files[rel_path])
+                else:
+                    f.write(package.candidate.version)
+        return list(package.files)
+
+    def _install(self, *packages):
+        self.packages = {}
+        for package in packages:
+            deb_name = '{}_{}_amd64.deb'.format(
+                package.name, package.candidate.version)
+            open(os.path.join(self.archives, deb_name), 'w').close()
+            self.packages[deb_name] = package
+        self.installer._cache = list(packages)
+        with patch('colcon_bundle.installer.apt._extract_deb',
+                   side_effect=self._extract_deb) as extract_deb:
+            result = self.installer.install()
+        return result, extract_deb
+
+    def test_install_delta(self):
+        _, extract_deb = self._install(
+            _fake_package('a', '1.0', ['usr/lib/a.so.1', 'usr/share/x']),
+            _fake_package('b', '1.0', ['usr/lib/b/b.so', 'usr/share/x']))
+        self.assertEqual(2, extract_deb.call_count)
+
+        result, extract_deb = self._install(
+            _fake_package('a', '1.0', ['usr/lib/a.so.1', 'usr/share/x']),
+            _fake_package('b', '1.0', ['usr/lib/b/b.so', 'usr/share/x']))
+        self.assertFalse(result)
+        extract_deb.assert_not_called()
+
+        _, extract_deb = self._install(
+            _fake_package('a', '2.0', ['usr/lib/a.so.2', 'usr/share/x']))
+        # Only the upgraded package is extracted
+        self.assertEqual(1, extract_deb.call_count)
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.prefix, 'usr/lib/a.so.2')))
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.prefix, 'usr/share/x')))
+        # Files of the old version and of the removed package are deleted
+        self.assertFalse(
+            os.path.exists(os.path.join(self.prefix, 'usr/lib/a.so.1')))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.prefix, 'usr/lib/b')))
+
+    def test_keep_modified_files(self):
+        self._install(_fake_package('a', '1.0', ['usr/lib/a.so']))
+        with open(os.path.join(self.prefix, 'usr/lib/a.so'), 'w') as f:
+            f.write('modified')
+
+        self._install()
+
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.prefix, 'usr/lib/a.so')))
+
+    def test_remove_rewritten_files(self):
+        self._install(_fake_package(
+            'a', '1.0', {'usr/bin/script': '#!/usr/bin/python3\n'}))
+        # The files rewritten by the bundle do not count as modified
+        update_shebang(self.prefix)
+        self.installer.finalize()
+
+        self._install()
+
+        self.assertFalse(
+            os.path.exists(os.path.join(self.prefix, 'usr/bin/script')))
+
+
+class AptSourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('colcon_bundle.installer.apt.subprocess.check_call')
+    def test_fetch_source_once(self, check_call):
+        def apt_get(args, cwd):
+            with open(os.path.join(cwd, 'foo_1.0.dsc'), 'w') as f:
+                f.write('dsc')
+        check_call.side_effect = apt_get
+        destination = os.path.join(self.tmpdir, 'cache', 'foo_1.0')
+        apt_get_args = ['apt-get', '-q']
+        self.assertTrue(_fetch_source(apt_get_args, 'foo=1.0', destination))
+        self.assertTrue(_fetch_source(apt_get_args, 'foo=1.0', destination))
+        check_call.assert_called_once_with(
+            ['apt-get', '-q', 'source', '--download-only', 'foo=1.0'],
+            cwd=destination + '.partial')
+        self.assertEqual(['foo_1.0.dsc'], os.listdir(destination))
+
+    @patch('colcon_bundle.installer.apt.subprocess.check_call')
+    def test_fetch_source_failure(self, check_call):
+        check_call.side_effect = subprocess.CalledProcessError(100, 'apt-get')
+        destination = os.path.join(self.tmpdir, 'cache', 'foo_1.0')
+        self.assertFalse(_fetch_source(['apt-get'], 'foo=1.0', destination))
+        self.assertFalse(os.path.exists(destination))
+
+    def test_link_sources(self):
+        cache = os.path.join(self.tmpdir, 'cache')
+        for key in ('foo_1.0', 'foo_2.0'):
+            os.makedirs(os.path.join(cache, key))
+            with open(os.path.join(cache, key, key + '.dsc'), 'w') as f:
+                f.write(key)
+        sources = os.path.join(self.tmpdir, 'sources')
+        os.makedirs(sources)
+        open(os.path.join(sources, 'stale.dsc'), 'w').close()
+
+        _link_sources(cache, ['foo_2.0'], sources)
+
+        # Only the sources of the installed versions are kept
+        self.assertEqual(['foo_2.0.dsc'], os.listdir(sources))
+
+
+class AptBatchMarkingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.installer = AptBundleInstallerExtension()
+        self.installer.context = BundleInstallerContext(
+            args=Mock(), cache_path=None, prefix_path=None)
+        self.packages = {}
+
+        def get_package(name):
+            package = self.packages.setdefault(name, mock.MagicMock())
+            package.name = name
+            return package
+        self.installer._cache = mock.MagicMock()
+        self.installer._cache.__getitem__.side_effect = get_package
+        self.installer._cache.broken_count = 0
+
+    def tearDown(self):
+        self.installer._cache = None
+
+    def test_requests_are_marked_once(self):
+        for _ in range(3):
+            self.installer.add_to_install_list('libpython3-dev')
+            self.installer.add_to_install_list('python3-pip')
+        self.installer.add_to_install_list('libfoo=1.0')
+        self.installer.add_to_install_list('libfoo')
+        self.installer.add_to_install_list('python3-pip=2.0')
+        for package in self.packages.values():
+            package.mark_install.assert_not_called()
+
+        apt = mock.MagicMock()
+        with patch.dict('sys.modules', apt=apt):
+            self.installer._mark_requested_packages()
+
+        self.installer._cache.actiongroup.assert_called_once_with()
+        for package in self.packages.values():
+            package.mark_install.assert_called_once_with(
+                auto_fix=False, from_user=False)
+        self.packages['libfoo'].versions.get.assert_called_once_with(
+            '1.0', mock.ANY)
+        self.packages['python3-pip'].versions.get.assert_called_once_with(
+            '2.0', mock.ANY)
+        # Without conflicts the problem resolver is not needed
+        apt.cache.ProblemResolver.assert_not_called()
+
+    def test_resolve_conflicts_once(self):
+        self.installer.add_to_install_list('libfoo')
+        self.installer.add_to_install_list('libbar')
+        self.installer._cache.broken_count = 1
+
+        apt = mock.MagicMock()
+        with patch.dict('sys.modules', apt=apt):
+            self.installer._mark_requested_packages()
+
+        resolver = apt.cache.ProblemResolver.return_value
+        self.assertEqual(2, resolver.protect.call_count)
+        resolver.resolve.assert_called_once_with()
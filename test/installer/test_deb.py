@@ -0,0 +1,189 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+from tempfile import mkdtemp
+
+from colcon_bundle.installer._deb import extract_deb
+import pytest
+
+
+def _ar_member(name, data):
+    header = '{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}'.format(
+        name, 0, 0, 0, '100644', len(data)).encode() + b'`\n'
+    padding = b'\n' if len(data) % 2 else b''
+    return header + data + padding
+
+
+def _tar(mode, members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        for info, data in members:
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+    return buffer.getvalue()
+
+
+def _data_members():
+    members = []
+    for name in ('.', './usr', './usr/bin'):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        members.append((info, None))
+    info = tarfile.TarInfo('./usr/bin/tool')
+    info.mode = 0o755
+    info.size = 5
+    members.append((info, b'tool\n'))
+    info = tarfile.TarInfo('./usr/bin/alias')
+    info.type = tarfile.SYMTYPE
+    info.linkname = 'tool'
+    members.append((info, None))
+    return members
+
+
+def _write_deb(path, data_name, data_mode, members=None):
+    control = _tar('w:gz', [])
+    data = _tar(
+        data_mode, members if members is not None else _data_members())
+    with open(path, 'wb') as f:
+        f.write(b'!<arch>\n')
+        f.write(_ar_member('debian-binary', b'2.0\n'))
+        f.write(_ar_member('control.tar.gz', control))
+        f.write(_ar_member(data_name, data))
+
+
+def _write_zstd_deb(path):
+    zstandard = pytest.importorskip('zstandard')
+    data = zstandard.ZstdCompressor().compress(
+        _tar('w', _data_members()))
+    with open(path, 'wb') as f:
+        f.write(b'!<arch>\n')
+        f.write(_ar_member('debian-binary', b'2.0\n'))
+        f.write(_ar_member('control.tar.gz', _tar('w:gz', [])))
+        f.write(_ar_member('data.tar.zst', data))
+
+
+@pytest.mark.parametrize('data_name,data_mode', [
+    ('data.tar', 'w'),
+    ('data.tar.gz', 'w:gz'),
+    ('data.tar.xz', 'w:xz'),
+    ('data.tar.zst', None),
+])
+def test_extract_deb(data_name, data_mode):
+    tmpdir = mkdtemp()
+    try:
+        deb_path = os.path.join(tmpdir, 'package.deb')
+        if data_mode is None:
+            _write_zstd_deb(deb_path)
+        else:
+            _write_deb(deb_path, data_name, data_mode)
+        destination = os.path.join(tmpdir, 'prefix')
+
+        files = extract_deb(deb_path, destination)
+
+        assert sorted(files) == ['usr/bin/alias', 'usr/bin/tool']
+        tool_path = os.path.join(destination, 'usr', 'bin', 'tool')
+        with open(tool_path, 'rb') as f:
+            assert f.read() == b'tool\n'
+        assert os.stat(tool_path).st_mode & 0o777 == 0o755
+        assert os.readlink(
+            os.path.join(destination, 'usr', 'bin', 'alias')) == 'tool'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.skipif(shutil.which('dpkg-deb') is None,
+                    reason='requires dpkg-deb')
+def test_extract_deb_matches_dpkg_deb():
+    tmpdir = mkdtemp()
+    try:
+        deb_path = os.path.join(tmpdir, 'package.deb')
+        _write_deb(deb_path, 'data.tar.xz', 'w:xz')
+        native_path = os.path.join(tmpdir, 'native')
+        dpkg_path = os.path.join(tmpdir, 'dpkg')
+
+        extract_deb(deb_path, native_path)
+        subprocess.check_call(
+            ['dpkg-deb', '--extract', deb_path, dpkg_path])
+
+        def listing(path):
+            return sorted(
+                os.path.relpath(os.path.join(root, name), path)
+                for root, dirs, files in os.walk(path)
+                for name in dirs + files)
+        assert listing(native_path) == listing(dpkg_path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_extract_deb_keeps_modes():
+    tmpdir = mkdtemp()
+    try:
+        members = _data_members()
+        info = tarfile.TarInfo('./usr/share')
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o2775
+        members.append((info, None))
+        info = tarfile.TarInfo('./usr/bin/sudo')
+        info.mode = 0o4755
+        info.size = 5
+        members.append((info, b'sudo\n'))
+        deb_path = os.path.join(tmpdir, 'package.deb')
+        _write_deb(deb_path, 'data.tar.gz', 'w:gz', members)
+        destination = os.path.join(tmpdir, 'prefix')
+
+        extract_deb(deb_path, destination)
+
+        mode = os.stat(os.path.join(destination, 'usr', 'share')).st_mode
+        assert mode & 0o7777 == 0o2775
+        mode = os.stat(
+            os.path.join(destination, 'usr', 'bin', 'sudo')).st_mode
+        assert mode & 0o7777 == 0o4755
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize('name,link_type,linkname', [
+    ('../escape', tarfile.REGTYPE, ''),
+    ('/absolute', tarfile.REGTYPE, ''),
+    ('./usr/bin/link', tarfile.LNKTYPE, '../../outside'),
+    ('./usr/lib/escape', tarfile.REGTYPE, ''),
+])
+def test_extract_deb_refuses_paths_outside(name, link_type, linkname):
+    tmpdir = mkdtemp()
+    try:
+        members = _data_members()
+        # Extracting through a symlink must not leave the destination
+        info = tarfile.TarInfo('./usr/lib')
+        info.type = tarfile.SYMTYPE
+        info.linkname = tmpdir
+        members.append((info, None))
+        info = tarfile.TarInfo(name)
+        info.type = link_type
+        info.linkname = linkname
+        data = None
+        if link_type == tarfile.REGTYPE:
+            data = b'data\n'
+            info.size = len(data)
+        members.append((info, data))
+        deb_path = os.path.join(tmpdir, 'package.deb')
+        _write_deb(deb_path, 'data.tar', 'w', members)
+
+        with pytest.raises(RuntimeError):
+            extract_deb(deb_path, os.path.join(tmpdir, 'prefix'))
+        assert not os.path.exists(os.path.join(tmpdir, 'escape'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_extract_not_a_deb():
+    tmpdir = mkdtemp()
+    try:
+        deb_path = os.path.join(tmpdir, 'package.deb')
+        with open(deb_path, 'wb') as f:
+            f.write(b'not a package')
+        with pytest.raises(RuntimeError):
+            extract_deb(deb_path, os.path.join(tmpdir, 'prefix'))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,64 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from colcon_bundle.installer._dist_metadata import collect_distributions, \
+    EXCLUDED_DISTRIBUTIONS, site_packages_paths
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class TestCollectDistributions:
+
+    def setup_method(self):
+        self.prefix = mkdtemp()
+        self.local = os.path.join(
+            self.prefix, 'usr', 'local', 'lib', 'python3.6', 'dist-packages')
+        self.system = os.path.join(
+            self.prefix, 'usr', 'lib', 'python3', 'dist-packages')
+
+    def teardown_method(self):
+        shutil.rmtree(self.prefix)
+
+    def test_site_packages_paths(self):
+        os.makedirs(self.local)
+        os.makedirs(self.system)
+        assert site_packages_paths(self.prefix, 'python3.6') == [
+            self.local, self.system]
+
+    def test_collect(self):
+        _write(os.path.join(self.local, 'Foo_Bar-1.0.dist-info', 'METADATA'),
+               'Metadata-Version: 2.1\nName: Foo-Bar\nVersion: 1.0\n\n'
+               'Version: not a header\n')
+        _write(os.path.join(self.local, 'Foo_Bar-1.0.dist-info', 'INSTALLER'),
+               'pip\n')
+        _write(os.path.join(self.local, 'Foo_Bar-1.0.dist-info', 'RECORD'),
+               'foo_bar/__init__.py,sha256=abc,10\n'
+               'foo_bar/core.py,sha256=def,32\n'
+               'Foo_Bar-1.0.dist-info/RECORD,,\n')
+        _write(os.path.join(self.local, 'pip-20.0.dist-info', 'METADATA'),
+               'Name: pip\nVersion: 20.0\n')
+        _write(os.path.join(self.local, 'devel.egg-link'), '/src/devel\n.')
+        # Older versions of the same distribution are shadowed
+        _write(os.path.join(self.system, 'foo_bar-0.1.egg-info'),
+               'Name: foo-bar\nVersion: 0.1\n')
+        _write(os.path.join(self.system, 'six-1.11.0.egg-info', 'PKG-INFO'),
+               'Name: six\nVersion: 1.11.0\n')
+        _write(os.path.join(
+            self.system, 'six-1.11.0.egg-info', 'installed-files.txt'),
+            'six.py\n')
+
+        distributions = collect_distributions(
+            site_packages_paths(self.prefix, 'python3.6'), stats=True,
+            exclude=EXCLUDED_DISTRIBUTIONS)
+
+        assert distributions == [
+            {'name': 'devel'},
+            {'name': 'Foo-Bar', 'version': '1.0', 'installer': 'pip',
+             'files': 3, 'size': 42},
+            {'name': 'six', 'version': '1.11.0', 'files': 1},
+        ]
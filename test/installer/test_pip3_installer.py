@@ -7,12 +7,33 @@ from colcon_bundle.installer import BundleInstallerContext
 from colcon_bundle.installer.pip3 import Pip3BundleInstallerExtensionPoint
 
 
+def _install_distributions(prefix, freeze_output):
+    """Create the dist-info directories of pip freeze style packages."""
+    bin_path = os.path.join(prefix, 'usr', 'bin')
+    os.makedirs(bin_path, exist_ok=True)
+    os.symlink('python3.6', os.path.join(bin_path, 'python3'))
+    site_packages = os.path.join(
+        prefix, 'usr', 'local', 'lib', 'python3.6', 'dist-packages')
+    for line in filter(None, freeze_output.split('\n')):
+        name, version = line.split('==')
+        dist_info = os.path.join(
+            site_packages, '{}-{}.dist-info'.format(name, version))
+        os.makedirs(dist_info)
+        with open(os.path.join(dist_info, 'METADATA'), 'w') as f:
+            f.write('Name: {}\nVersion: {}\n'.format(name, version))
+        with open(os.path.join(dist_info, 'INSTALLER'), 'w') as f:
+            f.write('pip\n')
+        with open(os.path.join(dist_info, 'RECORD'), 'w') as f:
+            f.write('{}/__init__.py,sha256=x,10\n'.format(name))
+
+
 def test_install_nothing():
     installer = Pip3BundleInstallerExtensionPoint()
     cache_dir = mkdtemp()
     prefix = mkdtemp()
     context_args = Mock()
     context_args.pip3_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
     installer.initialize(context)
@@ -30,10 +51,11 @@ def test_install(check_output, check_call):
     context_args = Mock()
     context_args.pip3_args = []
     context_args.pip3_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\n'
     try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2>=3.1.2')
@@ -45,11 +67,17 @@ def test_install(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
@@ -68,10 +96,11 @@ def test_install_with_additional_arguments(check_output, check_call):
     context_args = Mock()
     context_args.pip3_args = [' --test-arg-1', '--test-arg-2']
     context_args.pip3_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\n'
     try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2>=3.1.2')
@@ -83,11 +112,17 @@ def test_install_with_additional_arguments(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
@@ -107,10 +142,11 @@ def test_install_not_required(check_output, check_call):
     context_args = Mock()
     context_args.pip3_args = []
     context_args.pip3_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\n'
     try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2>=3.1.2')
@@ -122,21 +158,28 @@ def test_install_not_required(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
 
         result_2 = installer.install()
         assert result == result_2
-        # Verify we haven't called pip
-        assert check_call.call_count == 4
-        # Verify we haven't called pip freeze
-        assert check_output.call_count == 1
+        # Verify we haven't called pip, the first install bootstrapped,
+        # resolved, installed and downloaded the sources
+        assert check_call.call_count == 5
+        # Verify we haven't run the interpreter for the metadata
+        check_output.assert_not_called()
     finally:
         shutil.rmtree(cache_dir)
         shutil.rmtree(prefix)
@@ -145,7 +188,9 @@ def test_install_not_required(check_output, check_call):
 @patch('subprocess.check_call')
 @patch('subprocess.check_output')
 @patch('builtins.open', mock_open(read_data='rpkg==1.2.3'))
-def test_install_additional_requirements(check_output, check_call):
+@patch('colcon_bundle.installer.base_pip_installer.collect_distributions')
+def test_install_additional_requirements(collect_distributions, check_output,
+                                         check_call):
     """
     This test should be mocking the read and write to the file
     and then reading the requirements file. Instead I am just
@@ -161,8 +206,13 @@ def test_install_additional_requirements(check_output, check_call):
     context_args.pip3_requirements = 'requirements.txt'
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\nrpkg==1.2.3\n'
     try:
+        # The metadata can not be read while open is mocked
+        collect_distributions.return_value = [
+            {'name': name, 'version': version, 'installer': 'pip',
+             'files': 1, 'size': 10}
+            for name, version in (
+                ('pkg1', '3.4.5'), ('pkg2', '3.1.2'), ('rpkg', '1.2.3'))]
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2==3.1.2')
@@ -176,18 +226,67 @@ def test_install_additional_requirements(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'rpkg',
-                    'version': '1.2.3'
+                    'version': '1.2.3',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
     finally:
         shutil.rmtree(cache_dir)
         shutil.rmtree(prefix)
+
+
+@patch('subprocess.check_call')
+@patch('subprocess.check_output')
+def test_bootstrap_once(check_output, check_call):
+    installer = Pip3BundleInstallerExtensionPoint()
+    cache_dir = mkdtemp()
+    prefix = mkdtemp()
+    context_args = Mock()
+    context_args.pip3_args = []
+    context_args.pip3_requirements = None
+    context_args.upgrade = False
+    context_args.include_sources = False
+    context = BundleInstallerContext(
+        args=context_args, cache_path=cache_dir, prefix_path=prefix)
+    check_output.return_value = 'pkg1==3.4.5\n'
+
+    def bootstrap_calls():
+        return [c for c in check_call.call_args_list
+                if c[0][0][4:5] == ['-U']]
+    try:
+        installer.initialize(context)
+        installer.add_to_install_list('pkg1==3.4.5')
+        installer.install()
+        assert len(bootstrap_calls()) == 2
+
+        installer.add_to_install_list('pkg2')
+        installer.install()
+        assert len(bootstrap_calls()) == 2
+
+        # apt extracted python3-pip again
+        os.makedirs(os.path.join(
+            prefix, 'usr', 'lib', 'python3', 'dist-packages',
+            'pip-9.0.1.egg-info'))
+        installer.add_to_install_list('pkg3')
+        installer.install()
+        assert len(bootstrap_calls()) == 4
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(prefix)
@@ -2,17 +2,40 @@ from unittest.mock import patch, Mock, mock_open
 from tempfile import mkdtemp
 import shutil
 import os
+import subprocess
 
 from colcon_bundle.installer import BundleInstallerContext
+from colcon_bundle.installer._shared_cache import SharedCache
 from colcon_bundle.installer.pip import PipBundleInstallerExtensionPoint
 
 
+def _install_distributions(prefix, freeze_output):
+    """Create the dist-info directories of pip freeze style packages."""
+    bin_path = os.path.join(prefix, 'usr', 'bin')
+    os.makedirs(bin_path, exist_ok=True)
+    os.symlink('python2.7', os.path.join(bin_path, 'python2'))
+    site_packages = os.path.join(
+        prefix, 'usr', 'local', 'lib', 'python2.7', 'dist-packages')
+    for line in filter(None, freeze_output.split('\n')):
+        name, version = line.split('==')
+        dist_info = os.path.join(
+            site_packages, '{}-{}.dist-info'.format(name, version))
+        os.makedirs(dist_info)
+        with open(os.path.join(dist_info, 'METADATA'), 'w') as f:
+            f.write('Name: {}\nVersion: {}\n'.format(name, version))
+        with open(os.path.join(dist_info, 'INSTALLER'), 'w') as f:
+            f.write('pip\n')
+        with open(os.path.join(dist_info, 'RECORD'), 'w') as f:
+            f.write('{}/__init__.py,sha256=x,10\n'.format(name))
+
+
 def test_install_nothing():
     installer = PipBundleInstallerExtensionPoint()
     cache_dir = mkdtemp()
     prefix = mkdtemp()
     context_args = Mock()
     context_args.pip_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
     installer.initialize(context)
@@ -30,10 +53,11 @@ def test_install(check_output, check_call):
     context_args = Mock()
     context_args.pip_args = []
     context_args.pip_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\n'
     try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2>=3.1.2')
@@ -45,11 +69,17 @@ def test_install(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
@@ -68,10 +98,11 @@ def test_install_with_additional_arguments(check_output, check_call):
     context_args = Mock()
     context_args.pip_args = [' --test-arg-1', '--test-arg-2']
     context_args.pip_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\n'
     try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2>=3.1.2')
@@ -83,11 +114,17 @@ def test_install_with_additional_arguments(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
@@ -106,10 +143,11 @@ def test_install_not_required(check_output, check_call):
     context_args = Mock()
     context_args.pip_args = []
     context_args.pip_requirements = None
+    context_args.upgrade = False
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\n'
     try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2>=3.1.2')
@@ -121,21 +159,28 @@ def test_install_not_required(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
 
         result_2 = installer.install()
         assert result == result_2
-        # Verify we haven't called pip
-        assert check_call.call_count == 4
-        # Verify we haven't called pip freeze
-        assert check_output.call_count == 1
+        # Verify we haven't called pip, the first install bootstrapped,
+        # resolved, installed and downloaded the sources
+        assert check_call.call_count == 5
+        # Verify we haven't run the interpreter for the metadata
+        check_output.assert_not_called()
     finally:
         shutil.rmtree(cache_dir)
         shutil.rmtree(prefix)
@@ -144,7 +189,9 @@ def test_install_not_required(check_output, check_call):
 @patch('subprocess.check_call')
 @patch('subprocess.check_output')
 @patch('builtins.open', mock_open(read_data='rpkg==1.2.3'))
-def test_install_addtional_requirements(check_output, check_call):
+@patch('colcon_bundle.installer.base_pip_installer.collect_distributions')
+def test_install_addtional_requirements(collect_distributions, check_output,
+                                        check_call):
     """
     This test should be mocking the read and write to the file
     and then reading the requirements file. Instead I am just
@@ -160,8 +207,13 @@ def test_install_addtional_requirements(check_output, check_call):
     context_args.pip_requirements = 'requirements.txt'
     context = BundleInstallerContext(
         args=context_args, cache_path=cache_dir, prefix_path=prefix)
-    check_output.return_value = 'pkg1==3.4.5\npkg2==3.1.2\nrpkg==1.2.3\n'
     try:
+        # The metadata can not be read while open is mocked
+        collect_distributions.return_value = [
+            {'name': name, 'version': version, 'installer': 'pip',
+             'files': 1, 'size': 10}
+            for name, version in (
+                ('pkg1', '3.4.5'), ('pkg2', '3.1.2'), ('rpkg', '1.2.3'))]
         installer.initialize(context)
         installer.add_to_install_list('pkg1==3.4.5')
         installer.add_to_install_list('pkg2==3.1.2')
@@ -175,18 +227,189 @@ def test_install_addtional_requirements(check_output, check_call):
             'installed_packages': [
                 {
                     'name': 'pkg1',
-                    'version': '3.4.5'
+                    'version': '3.4.5',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'pkg2',
-                    'version': '3.1.2'
+                    'version': '3.1.2',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 },
                 {
                     'name': 'rpkg',
-                    'version': '1.2.3'
+                    'version': '1.2.3',
+                    'installer': 'pip',
+                    'files': 1,
+                    'size': 10
                 }
             ]
         }
     finally:
         shutil.rmtree(cache_dir)
         shutil.rmtree(prefix)
+
+
+@patch('subprocess.check_call')
+@patch('subprocess.check_output')
+def test_install_locked(check_output, check_call):
+    installer = PipBundleInstallerExtensionPoint()
+    cache_dir = mkdtemp()
+    prefix = mkdtemp()
+    context_args = Mock()
+    context_args.pip_args = []
+    context_args.pip_requirements = 'requirements.txt'
+    context_args.include_sources = False
+    context = BundleInstallerContext(
+        args=context_args, cache_path=cache_dir, prefix_path=prefix,
+        locked_packages=['pkg1==3.4.5', 'pkg2==3.1.2'])
+    try:
+        _install_distributions(prefix, 'pkg1==3.4.5\npkg2==3.1.2\n')
+        installer.initialize(context)
+        installer.add_to_install_list('pkg1>=3')
+        installer.install()
+
+        # The locked packages are installed without resolving dependencies
+        assert installer._packages == ['pkg1==3.4.5', 'pkg2==3.1.2']
+        pip_args = check_call.call_args[0][0]
+        assert '--no-deps' in pip_args
+        assert '--ignore-installed' not in pip_args
+        assert installer.get_locked_packages() == [
+            'pkg1==3.4.5', 'pkg2==3.1.2']
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(prefix)
+
+
+@patch('subprocess.check_call')
+@patch('subprocess.check_output')
+def test_install_builds_missing_wheels(check_output, check_call):
+    installer = PipBundleInstallerExtensionPoint()
+    cache_dir = mkdtemp()
+    prefix = mkdtemp()
+    context_args = Mock()
+    context_args.pip_args = []
+    context_args.pip_requirements = None
+    context_args.upgrade = False
+    context_args.include_sources = False
+    context = BundleInstallerContext(
+        args=context_args, cache_path=cache_dir, prefix_path=prefix)
+    check_output.return_value = 'pkg1==3.4.5\n'
+
+    def pip(args):
+        # The wheelhouse is empty, so the offline resolution fails
+        if '--no-index' in args and check_call.call_count == 3:
+            raise subprocess.CalledProcessError(1, args)
+    check_call.side_effect = pip
+    try:
+        installer.initialize(context)
+        installer.add_to_install_list('pkg1==3.4.5')
+        installer.install()
+
+        calls = [c[0][0] for c in check_call.call_args_list[2:]]
+        # The requirements are resolved and built before installing
+        assert [c[3] for c in calls] == ['wheel', 'wheel', 'wheel', 'install']
+        wheelhouse = calls[1][calls[1].index('--find-links') + 1]
+        assert wheelhouse.startswith(os.path.join(cache_dir, 'wheelhouse'))
+        # pip never writes into the wheelhouse
+        assert calls[1][calls[1].index('--wheel-dir') + 1] != wheelhouse
+        for call in (calls[2], calls[3]):
+            assert call[call.index('--find-links') + 1] == wheelhouse
+            assert '--no-index' in call
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(prefix)
+
+
+@patch('subprocess.check_call')
+@patch('subprocess.check_output')
+def test_install_shares_wheels(check_output, check_call):
+    tmpdir = mkdtemp()
+    shared_cache = SharedCache(os.path.join(tmpdir, 'store'))
+    check_output.return_value = 'pkg1==3.4.5\n'
+
+    def pip(args):
+        wheelhouse = args[args.index('--find-links') + 1] \
+            if '--find-links' in args else None
+        wheels = os.listdir(wheelhouse) if wheelhouse else []
+        if '--no-index' in args and not wheels:
+            raise subprocess.CalledProcessError(1, args)
+        if 'wheel' in args:
+            wheel_dir = args[args.index('--wheel-dir') + 1]
+            os.makedirs(wheel_dir, exist_ok=True)
+            wheel_path = os.path.join(
+                wheel_dir, 'pkg1-3.4.5-py2-none-any.whl')
+            with open(wheel_path, 'wb') as f:
+                f.write(b'wheel')
+    check_call.side_effect = pip
+    try:
+        wheelhouses = []
+        for name in ('first', 'second'):
+            cache_dir = os.path.join(tmpdir, name, 'cache')
+            prefix = os.path.join(tmpdir, name, 'prefix')
+            os.makedirs(cache_dir)
+            _install_distributions(prefix, '')
+            with open(os.path.join(prefix, 'usr', 'bin', 'python2.7'),
+                      'wb') as f:
+                f.write(b'python')
+            context_args = Mock()
+            context_args.pip_args = []
+            context_args.pip_requirements = None
+            context_args.upgrade = False
+            context_args.include_sources = False
+            context = BundleInstallerContext(
+                args=context_args, cache_path=cache_dir, prefix_path=prefix,
+                shared_cache=shared_cache)
+            installer = PipBundleInstallerExtensionPoint()
+            installer.initialize(context)
+            installer.add_to_install_list('pkg1==3.4.5')
+            check_call.reset_mock()
+            installer.install()
+            commands = [c[0][0][3] for c in check_call.call_args_list[2:]]
+            wheelhouses.append(installer._wheelhouse_path())
+            if name == 'first':
+                assert commands == ['wheel', 'wheel', 'wheel', 'install']
+            else:
+                # The wheel built for the first bundle is reused
+                assert commands == ['wheel', 'install']
+
+        first, second = (
+            os.path.join(path, 'pkg1-3.4.5-py2-none-any.whl')
+            for path in wheelhouses)
+        assert os.path.samefile(first, second)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@patch('subprocess.check_call')
+@patch('subprocess.check_output')
+def test_install_upgrade_skips_wheelhouse(check_output, check_call):
+    installer = PipBundleInstallerExtensionPoint()
+    cache_dir = mkdtemp()
+    prefix = mkdtemp()
+    context_args = Mock()
+    context_args.pip_args = []
+    context_args.pip_requirements = None
+    context_args.upgrade = True
+    context_args.include_sources = False
+    context = BundleInstallerContext(
+        args=context_args, cache_path=cache_dir, prefix_path=prefix)
+    check_output.return_value = 'pkg1==3.4.5\n'
+    try:
+        installer.initialize(context)
+        installer.add_to_install_list('pkg1')
+        installer.install()
+
+        calls = [c[0][0] for c in check_call.call_args_list[2:]]
+        # The newest versions are built before installing from the
+        # wheelhouse
+        assert [c[3] for c in calls] == ['wheel', 'wheel', 'install']
+        assert '--find-links' not in calls[0]
+        assert '--no-index' in calls[1]
+        assert '--no-index' in calls[2]
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(prefix)
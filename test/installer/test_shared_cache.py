@@ -0,0 +1,101 @@
+import os
+import shutil
+from tempfile import mkdtemp
+import time
+from unittest.mock import patch
+
+from colcon_bundle.installer._shared_cache import SharedCache
+from colcon_bundle.verb.utilities import filechecksum
+
+
+class TestSharedCache:
+
+    def setup_method(self, method):
+        self.tmpdir = mkdtemp()
+        self.store_path = os.path.join(self.tmpdir, 'store')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_add_and_link(self):
+        cache = SharedCache(self.store_path)
+        path = self._write('a.deb', b'package a')
+        sha256 = cache.add(path)
+        assert sha256 == filechecksum(path)
+
+        destination = os.path.join(self.tmpdir, 'linked.deb')
+        assert cache.link(sha256, destination)
+        assert os.path.samefile(path, destination)
+        assert not cache.link('0' * 64, destination + '.missing')
+        assert not os.path.exists(destination + '.missing')
+
+    def test_add_duplicate_content(self):
+        cache = SharedCache(self.store_path)
+        first = self._write('first.deb', b'same content')
+        second = self._write('second.deb', b'same content')
+        cache.add(first)
+        cache.add(second)
+        # The second copy is replaced by a link to the stored object
+        assert os.path.samefile(first, second)
+
+    def test_collect_garbage(self):
+        cache = SharedCache(self.store_path, max_size=16)
+        old = self._write('old.deb', b'o' * 8)
+        linked = self._write('linked.deb', b'l' * 8)
+        new = self._write('new.deb', b'n' * 8)
+        old_sha256 = cache.add(old)
+        linked_sha256 = cache.add(linked)
+        new_sha256 = cache.add(new)
+        os.remove(old)
+        os.remove(new)
+        now = time.time()
+        os.utime(cache._object_path(old_sha256), (now - 200, now - 200))
+        os.utime(cache._object_path(linked_sha256), (now - 100, now - 100))
+
+        assert cache.collect_garbage() == 1
+        assert not os.path.exists(cache._object_path(old_sha256))
+        assert os.path.exists(cache._object_path(linked_sha256))
+        assert os.path.exists(cache._object_path(new_sha256))
+
+        # Objects still linked from a bundle cache count towards the limit
+        cache.max_size = 8
+        assert cache.collect_garbage() == 1
+        assert not os.path.exists(cache._object_path(linked_sha256))
+        assert os.path.exists(cache._object_path(new_sha256))
+        # The bundle keeps its link
+        with open(linked, 'rb') as f:
+            assert f.read() == b'l' * 8
+
+    def test_without_flock(self):
+        with patch.dict('sys.modules', {'fcntl': None}):
+            cache = SharedCache(self.store_path)
+            path = self._write('a.deb', b'package a')
+            sha256 = cache.add(path)
+            assert cache.link(sha256, path + '.linked')
+
+    def test_named_files(self):
+        cache = SharedCache(self.store_path, max_size=0)
+        path = self._write('pkg-1.0-py3-none-any.whl', b'wheel')
+        cache.add_named('wheels', path)
+        destination = os.path.join(self.tmpdir, 'wheelhouse')
+        os.makedirs(destination)
+
+        assert cache.link_named('wheels', destination) == [
+            'pkg-1.0-py3-none-any.whl']
+        linked = os.path.join(destination, 'pkg-1.0-py3-none-any.whl')
+        assert os.path.samefile(path, linked)
+        # Existing files are kept
+        assert cache.link_named('wheels', destination) == []
+        assert cache.link_named('other', destination) == []
+
+        # The names of removed objects are removed as well
+        os.remove(linked)
+        assert cache.collect_garbage() == 1
+        assert cache.link_named('wheels', destination) == []
+        assert not os.listdir(os.path.join(self.store_path, 'names', 'wheels'))
@@ -0,0 +1,116 @@
+import csv
+import os
+import shutil
+from tempfile import mkdtemp
+import zipfile
+
+from colcon_bundle.installer._wheel_installer import get_install_scheme, \
+    install_wheels
+import pytest
+
+
+def _write_wheel(directory, name, version, files, *, entry_points=None):
+    dist_info = '{}-{}.dist-info'.format(name, version)
+    path = os.path.join(
+        directory, '{}-{}-py3-none-any.whl'.format(name, version))
+    with zipfile.ZipFile(path, 'w') as wheel:
+        for file_name, content in files.items():
+            wheel.writestr(file_name, content)
+        wheel.writestr(dist_info + '/METADATA', 'Name: {}\n'.format(name))
+        wheel.writestr(dist_info + '/WHEEL', 'Root-Is-Purelib: true\n')
+        if entry_points is not None:
+            wheel.writestr(dist_info + '/entry_points.txt', entry_points)
+        wheel.writestr(dist_info + '/RECORD', '')
+    return path
+
+
+class TestWheelInstaller:
+
+    def setup_method(self):
+        self.tmpdir = mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, 'prefix')
+        self.scheme = get_install_scheme(self.prefix, 'python3.6')
+        self.site_packages = os.path.join(
+            self.prefix, 'usr', 'local', 'lib', 'python3.6', 'dist-packages')
+
+    def teardown_method(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_install(self):
+        wheels = [
+            _write_wheel(self.tmpdir, 'foo', '1.0', {
+                'foo/__init__.py': 'VERSION = 1\n',
+                'foo-1.0.data/scripts/foo-tool': '#!python\nprint(1)\n',
+                'foo-1.0.data/data/share/foo/data.txt': 'data',
+            }, entry_points='[console_scripts]\nfoo = foo.cli:main\n'),
+            _write_wheel(self.tmpdir, 'bar_baz', '2.0', {
+                'bar_baz.py': 'pass\n',
+            }),
+        ]
+
+        installed = install_wheels(
+            wheels, self.scheme, interpreter='python3', workers=2)
+
+        assert sorted(installed) == sorted(wheels)
+        bin_path = os.path.join(self.prefix, 'usr', 'local', 'bin')
+        with open(os.path.join(bin_path, 'foo-tool')) as f:
+            assert f.read() == '#!/usr/bin/env python3\nprint(1)\n'
+        with open(os.path.join(bin_path, 'foo')) as f:
+            script = f.read()
+        assert script.startswith('#!/usr/bin/env python3\n')
+        assert 'from foo.cli import main' in script
+        assert os.access(os.path.join(bin_path, 'foo'), os.X_OK)
+        assert os.path.isfile(os.path.join(
+            self.prefix, 'usr', 'local', 'share', 'foo', 'data.txt'))
+
+        dist_info = os.path.join(self.site_packages, 'foo-1.0.dist-info')
+        with open(os.path.join(dist_info, 'INSTALLER')) as f:
+            assert f.read() == 'colcon-bundle\n'
+        with open(os.path.join(dist_info, 'RECORD'), newline='') as f:
+            records = {row[0]: row[1:] for row in csv.reader(f)}
+        assert records['foo/__init__.py'][0].startswith('sha256=')
+        assert records['foo/__init__.py'][1] == '12'
+        assert '../../../bin/foo' in records
+        assert records['foo-1.0.dist-info/RECORD'] == ['', '']
+
+    def test_upgrade_removes_old_files(self):
+        old = _write_wheel(self.tmpdir, 'foo', '1.0', {
+            'foo/__init__.py': '', 'foo/old.py': ''})
+        install_wheels([old], self.scheme, interpreter='python3')
+        new_directory = os.path.join(self.tmpdir, 'new')
+        os.makedirs(new_directory)
+        new = _write_wheel(new_directory, 'Foo', '2.0', {
+            'foo/__init__.py': ''})
+
+        install_wheels([new], self.scheme, interpreter='python3')
+
+        assert not os.path.exists(
+            os.path.join(self.site_packages, 'foo', 'old.py'))
+        assert sorted(os.listdir(self.site_packages)) == [
+            'Foo-2.0.dist-info', 'foo']
+
+    def test_invalid_path(self):
+        wheel = _write_wheel(self.tmpdir, 'foo', '1.0', {'../evil.py': ''})
+        with pytest.raises(RuntimeError):
+            install_wheels([wheel], self.scheme, interpreter='python3')
+
+    def test_overlapping_wheels(self):
+        wheels = [
+            _write_wheel(self.tmpdir, name, '1.0', {
+                'shared/__init__.py': name,
+                name + '.py': '',
+            }, entry_points='[console_scripts]\ntool = {}:main\n'.format(
+                name))
+            for name in ('zeta', 'alpha', 'beta')]
+
+        installed = install_wheels(
+            wheels, self.scheme, interpreter='python3', workers=3)
+
+        # The wheels are installed in the given order
+        assert list(installed) == wheels
+        with open(os.path.join(
+                self.site_packages, 'shared', '__init__.py')) as f:
+            assert f.read() == 'beta'
+        bin_path = os.path.join(self.prefix, 'usr', 'local', 'bin')
+        with open(os.path.join(bin_path, 'tool')) as f:
+            assert 'from beta import main' in f.read()
@@ -1,13 +1,19 @@
+import errno
 import json
 import os
 import shutil
 import tarfile
 import tempfile
 from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 
-from colcon_bundle.verb.bundlefile import Bundle
+from colcon_bundle.verb._overlay_utilities import \
+    recursive_tar_overlay_in_path
+from colcon_bundle.verb.bundlefile import _append_file, _MappedRegion, \
+    Bundle
 
 json_data = {'test': 1, 'test_2': 2,
              'test_3': ['foo'], 'test_4': {'test_5': 1.3283}}
@@ -122,3 +128,223 @@ class TestBundlefile:
                 bundle.add_metadata(large_file_path)
                 bundle.add_overlay_archive(archive)
                 bundle.add_overlay_archive(other)
+
+    def test_bundlefile_overlay_compression(self):
+        bundle_path = os.path.join(self.tmpdir, 'test.mba')
+        file_path = os.path.join(self.tmpdir, 'file')
+        with open(file_path, 'wb') as f:
+            f.write(bytearray(10000))
+
+        gzip_archive = os.path.join(self.tmpdir, 'dependencies.tar.gz')
+        with tarfile.open(gzip_archive, 'w:gz') as a:
+            a.add(file_path, arcname='file')
+
+        plain_archive = os.path.join(self.tmpdir, 'workspace.tar')
+        with tarfile.open(plain_archive, 'w') as a:
+            a.add(file_path, arcname='file')
+
+        with Bundle(name=bundle_path, mode='w') as bundle:
+            bundle.add_overlay_archive(gzip_archive)
+            bundle.add_overlay_archive(plain_archive)
+
+        with tarfile.open(bundle_path, 'r:') as bundle:
+            version = bundle.extractfile('version').read().decode()
+            assert '2.1' == version
+            bundle.extract('metadata.tar.gz', self.tmpdir)
+
+        metadata_path = os.path.join(self.tmpdir, 'metadata.tar.gz')
+        with tarfile.open(metadata_path) as metadata_tar:
+            contents = metadata_tar.extractfile('overlays.json')
+            overlays = json.loads(contents.read().decode())['overlays']
+            assert 'gzip' == overlays[0]['compression']
+            assert 'none' == overlays[1]['compression']
+
+    def test_bundlefile_known_checksum(self):
+        bundle_path = os.path.join(self.tmpdir, 'test.mba')
+        archive = os.path.join(self.tmpdir, 'dependencies.tar.gz')
+        with open(archive, 'wb') as f:
+            f.write(bytearray(1000))
+
+        with Bundle(name=bundle_path, mode='w') as bundle:
+            bundle.add_overlay_archive(archive, sha256='a' * 64, size=1000)
+
+        with tarfile.open(bundle_path, 'r:') as bundle:
+            bundle.extract('metadata.tar.gz', self.tmpdir)
+        metadata_path = os.path.join(self.tmpdir, 'metadata.tar.gz')
+        with tarfile.open(metadata_path) as metadata_tar:
+            contents = metadata_tar.extractfile('overlays.json')
+            overlays = json.loads(contents.read().decode())['overlays']
+            assert 'a' * 64 == overlays[0]['sha256']
+
+        with pytest.raises(RuntimeError):
+            with Bundle(name=bundle_path, mode='w') as bundle:
+                bundle.add_overlay_archive(
+                    archive, sha256='a' * 64, size=999)
+
+    def _assert_append_matches_tarfile_add(self):
+        overlay = os.path.join(self.tmpdir, 'overlay.tar.gz')
+        with open(overlay, 'wb') as f:
+            f.write(os.urandom(3 * tarfile.BLOCKSIZE + 17))
+        expected = os.path.join(self.tmpdir, 'expected.tar')
+        actual = os.path.join(self.tmpdir, 'actual.tar')
+        for path in (expected, actual):
+            with tarfile.open(path, 'w', format=tarfile.GNU_FORMAT) as tar:
+                tar.add(overlay, arcname='first')
+                if path == expected:
+                    tar.add(overlay, arcname='overlay.tar.gz')
+                else:
+                    _append_file(tar, overlay, 'overlay.tar.gz')
+                tar.add(overlay, arcname='last')
+        with open(expected, 'rb') as e, open(actual, 'rb') as a:
+            assert e.read() == a.read()
+
+    def test_append_file_matches_tarfile_add(self):
+        self._assert_append_matches_tarfile_add()
+
+    def test_append_file_without_copy_file_range(self):
+        error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with patch('os.copy_file_range', side_effect=error, create=True):
+            self._assert_append_matches_tarfile_add()
+
+    def test_append_file_without_kernel_copy(self):
+        error = OSError(errno.ENOSYS, 'Function not implemented')
+        with patch('os.copy_file_range', side_effect=error, create=True), \
+                patch('os.sendfile', side_effect=error, create=True):
+            self._assert_append_matches_tarfile_add()
+
+    def _write_bundle_for_reading(self):
+        bundle_path = os.path.join(self.tmpdir, 'test.mba')
+        installers_path = os.path.join(self.tmpdir, 'installers.json')
+        with open(installers_path, 'w') as f:
+            f.write(json.dumps(json_data))
+        json_file = os.path.join(self.tmpdir, 'file')
+        with open(json_file, 'w') as f:
+            f.write(json.dumps(json_data))
+
+        dep_archive = os.path.join(self.tmpdir, 'dependencies.tar.gz')
+        with tarfile.open(dep_archive, 'w:gz') as a:
+            a.add(json_file, arcname='file')
+        workspace_archive = os.path.join(self.tmpdir, 'workspace.tar')
+        with tarfile.open(workspace_archive, 'w') as a:
+            a.add(json_file, arcname='file2')
+
+        with Bundle(name=bundle_path, mode='w') as bundle:
+            bundle.add_metadata(installers_path)
+            bundle.add_overlay_archive(dep_archive)
+            bundle.add_overlay_archive(workspace_archive)
+        return bundle_path
+
+    def test_bundle_reader(self):
+        bundle_path = self._write_bundle_for_reading()
+        extract_path = os.path.join(self.tmpdir, 'extracted')
+
+        with Bundle(name=bundle_path, mode='r') as bundle:
+            assert '2.1' == bundle.version
+            assert json_data == bundle.get_metadata('installers.json')
+            names = [overlay['name'] for overlay in bundle.overlays()]
+            assert ['dependencies.tar.gz', 'workspace.tar'] == names
+            assert bundle.verify_overlay('dependencies.tar.gz')
+
+            bundle.extract_overlay('dependencies.tar.gz', extract_path)
+            with bundle.open_overlay('workspace.tar') as tar:
+                member = tar.next()
+                assert 'file2' == member.name
+                data = json.loads(tar.extractfile(member).read().decode())
+                assert json_data == data
+
+            with pytest.raises(KeyError):
+                bundle.open_overlay('missing.tar.gz')
+            with pytest.raises(OSError):
+                bundle.add_overlay_archive('other.tar.gz')
+
+        with open(os.path.join(extract_path, 'file')) as f:
+            assert json_data == json.loads(f.read())
+
+    def test_bundle_open_overlay_closes_region(self):
+        bundle_path = self._write_bundle_for_reading()
+        with Bundle(name=bundle_path, mode='r') as bundle:
+            for name in ('dependencies.tar.gz', 'workspace.tar'):
+                with patch('colcon_bundle.verb.bundlefile._MappedRegion.close',
+                           autospec=True,
+                           side_effect=_MappedRegion.close) as close:
+                    with bundle.open_overlay(name) as tar:
+                        assert tar.next() is not None
+                        assert not close.called
+                    assert close.called
+
+    def test_bundle_reader_without_mmap(self):
+        bundle_path = self._write_bundle_for_reading()
+        with patch('mmap.mmap', side_effect=OSError(errno.ENOMEM, 'ENOMEM')):
+            with Bundle(name=bundle_path, mode='r') as bundle:
+                assert bundle.verify_overlay('dependencies.tar.gz')
+                assert bundle.verify_overlay('workspace.tar')
+
+    def _write_indexed_bundle(self, compression):
+        source = Path(self.tmpdir) / 'source'
+        (source / 'lib').mkdir(parents=True)
+        (source / 'first').write_bytes(os.urandom(5 * 1024 * 1024))
+        (source / 'lib' / 'second').write_bytes(b'second' * 1000)
+        os.link(str(source / 'lib' / 'second'), str(source / 'link'))
+        extension = {'gzip': '.tar.gz', 'none': '.tar', 'zstd': '.tar.zst'}
+        overlay = Path(self.tmpdir) / ('overlay' + extension[compression])
+        info = recursive_tar_overlay_in_path(
+            overlay, source, compression=compression, file_index=True)
+        bundle_path = os.path.join(self.tmpdir, 'test.tar')
+        with Bundle(name=bundle_path) as bundle:
+            bundle.add_overlay_archive(str(overlay), **info)
+        return bundle_path, source
+
+    @pytest.mark.parametrize('compression', ['gzip', 'none', 'zstd'])
+    def test_bundle_read_file(self, compression):
+        if compression == 'zstd':
+            pytest.importorskip('zstandard')
+        bundle_path, source = self._write_indexed_bundle(compression)
+
+        with Bundle(name=bundle_path, mode='r') as bundle:
+            paths = sorted(entry['path'] for entry in bundle.files())
+            assert ['first', 'lib/second', 'link'] == paths
+            for path in paths:
+                assert (source / path).read_bytes() == bundle.read_file(path)
+            with pytest.raises(KeyError):
+                bundle.read_file('missing')
+
+    def test_bundle_read_file_gzip_checkpoints(self):
+        bundle_path, source = self._write_indexed_bundle('gzip')
+
+        with Bundle(name=bundle_path, mode='r') as bundle:
+            checkpoints = bundle.get_metadata('files.json')['checkpoints']
+            # The 5MiB file spans more than one checkpoint interval
+            assert len(checkpoints['overlay.tar.gz']) > 1
+            assert (source / 'lib' / 'second').read_bytes() == \
+                bundle.read_file('lib/second')
+
+    def test_bundle_without_files_index(self):
+        bundle_path = self._write_bundle_for_reading()
+        with Bundle(name=bundle_path, mode='r') as bundle:
+            assert bundle.files() is None
+            with pytest.raises(KeyError):
+                bundle.read_file('file')
+
+    def test_bundle_files_index_spill(self):
+        overlay = Path(self.tmpdir) / 'overlay.tar'
+        source = Path(self.tmpdir) / 'source'
+        source.mkdir()
+        (source / 'file').write_bytes(b'content')
+        info = recursive_tar_overlay_in_path(
+            overlay, source, compression='none', file_index=True)
+        # Random paths do not compress, so the index exceeds the metadata
+        for number in range(5000):
+            info['index']['files'].append({
+                'path': os.urandom(1024).hex(), 'offset': 0, 'size': 0,
+                'mode': 0o644, 'sha256': ''})
+        bundle_path = os.path.join(self.tmpdir, 'test.tar')
+        with Bundle(name=bundle_path) as bundle:
+            bundle.add_overlay_archive(str(overlay), **info)
+
+        with Bundle(name=bundle_path, mode='r') as bundle:
+            with pytest.raises(KeyError):
+                bundle.get_metadata('files.json')
+            assert 5001 == len(bundle.files())
+            assert b'content' == bundle.read_file('file')
+        with tarfile.open(bundle_path) as tar:
+            assert 'files.json.gz' == tar.getnames()[-1]
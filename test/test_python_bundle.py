@@ -37,7 +37,8 @@ async def test_bundle():
     pip_installer.add_to_install_list.assert_has_calls([call('pkg1==1.3.2'), call('pkg2<1.2')])
 
     apt_calls = apt_installer.add_to_install_list.call_args_list
-    assert len(apt_calls) == 4
+    # The apt packages are requested once for all dependencies
+    assert len(apt_calls) == 2
     assert apt_calls[0][0][0] == 'libpython3-dev'
     assert apt_calls[1][0][0] == 'python3-pip'
     logging.disable(logging.CRITICAL)
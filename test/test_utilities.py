@@ -6,7 +6,8 @@ import os
 import shutil
 import tempfile
 
-from colcon_bundle.verb.utilities import update_shebang
+from colcon_bundle.verb.utilities import directory_fingerprint, \
+    sync_directory, update_shebang
 
 
 class TestUtilities:
@@ -47,3 +48,87 @@ class TestUtilities:
 
     def test_replaces_shebang_with_arguments(self):
         pass
+
+    def test_directory_fingerprint(self):
+        os.mkdir(os.path.join(self.tmpdir, 'sub'))
+        file_path = os.path.join(self.tmpdir, 'sub', 'file')
+        with open(file_path, 'w') as f:
+            f.write('content')
+        fingerprint = directory_fingerprint(self.tmpdir)
+        assert fingerprint == directory_fingerprint(self.tmpdir)
+
+        os.symlink('sub/file', os.path.join(self.tmpdir, 'link'))
+        assert fingerprint != directory_fingerprint(self.tmpdir)
+        fingerprint = directory_fingerprint(self.tmpdir)
+
+        with open(file_path, 'a') as f:
+            f.write('more content')
+        assert fingerprint != directory_fingerprint(self.tmpdir)
+
+    def test_directory_fingerprint_follows_symlinks(self):
+        directory = os.path.join(self.tmpdir, 'directory')
+        target = os.path.join(self.tmpdir, 'target')
+        os.makedirs(os.path.join(target, 'sub'))
+        os.mkdir(directory)
+        with open(os.path.join(target, 'file'), 'w') as f:
+            f.write('content')
+        os.symlink(os.path.join(target, 'file'),
+                   os.path.join(directory, 'file'))
+        os.symlink(os.path.join(target, 'sub'),
+                   os.path.join(directory, 'sub'))
+        fingerprint = directory_fingerprint(directory)
+
+        with open(os.path.join(target, 'file'), 'a') as f:
+            f.write('more content')
+        assert fingerprint != directory_fingerprint(directory)
+        fingerprint = directory_fingerprint(directory)
+
+        with open(os.path.join(target, 'sub', 'added'), 'w') as f:
+            f.write('content')
+        assert fingerprint != directory_fingerprint(directory)
+
+    def test_sync_directory(self):
+        src = os.path.join(self.tmpdir, 'src')
+        dst = os.path.join(self.tmpdir, 'dst')
+        manifest = os.path.join(self.tmpdir, 'manifest.json')
+        os.makedirs(os.path.join(src, 'sub'))
+        for name in ('kept', 'changed', 'removed', os.path.join('sub', 'a')):
+            with open(os.path.join(src, name), 'w') as f:
+                f.write(name)
+        os.symlink('kept', os.path.join(src, 'link'))
+
+        copied = sync_directory(src, dst, manifest)
+        assert 5 == len(copied)
+        # Symlinks are replaced by a copy of their target
+        assert not os.path.islink(os.path.join(dst, 'link'))
+        assert not filecmp.dircmp(src, dst).diff_files
+
+        # Modifications of dst are kept until src changes
+        with open(os.path.join(dst, 'kept'), 'w') as f:
+            f.write('modified')
+        with open(os.path.join(src, 'changed'), 'w') as f:
+            f.write('new content')
+        os.remove(os.path.join(src, 'link'))
+        os.symlink('changed', os.path.join(src, 'link'))
+        os.remove(os.path.join(src, 'removed'))
+        shutil.rmtree(os.path.join(src, 'sub'))
+        with open(os.path.join(src, 'sub'), 'w') as f:
+            f.write('sub is a file now')
+
+        copied = sync_directory(src, dst, manifest)
+        assert sorted(copied) == [
+            os.path.join(dst, 'changed'), os.path.join(dst, 'link'),
+            os.path.join(dst, 'sub')]
+        with open(os.path.join(dst, 'link')) as f:
+            assert f.read() == 'new content'
+        assert not os.path.exists(os.path.join(dst, 'removed'))
+        with open(os.path.join(dst, 'kept')) as f:
+            assert f.read() == 'modified'
+        with open(os.path.join(dst, 'sub')) as f:
+            assert f.read() == 'sub is a file now'
+
+        # Without a manifest everything is copied again
+        os.remove(manifest)
+        assert 4 == len(sync_directory(src, dst, manifest))
+        with open(os.path.join(dst, 'kept')) as f:
+            assert f.read() == 'kept'
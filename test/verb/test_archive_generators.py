@@ -0,0 +1,171 @@
+import json
+import os
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+from unittest.mock import patch
+
+from colcon_bundle.verb._archive_generators import generate_archive_v2, \
+    recursive_tar_in_path
+from colcon_bundle.verb._overlay_utilities import create_workspace_overlay
+from colcon_bundle.verb._path_context import PathContext
+from colcon_bundle.verb.bundlefile import Bundle
+
+
+class TestPackageOverlays:
+
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.install_base = os.path.join(self.tmpdir, 'install')
+        for package_name in ('pkg_a', 'pkg_b'):
+            share = Path(self.install_base) / package_name / 'share' / \
+                package_name
+            share.mkdir(parents=True)
+            (share / 'package.sh').write_text(package_name)
+        (Path(self.install_base) / 'setup.sh').write_text('workspace')
+
+        with patch('colcon_bundle.verb._path_context.'
+                   'check_and_mark_bundle_version'), \
+                patch('colcon_bundle.verb._path_context.'
+                      'check_and_mark_bundle_tool'), \
+                patch('colcon_bundle.verb._path_context.'
+                      'get_and_mark_bundle_cache_version',
+                      return_value=2):
+            self.path_context = PathContext(
+                self.install_base, os.path.join(self.tmpdir, 'bundle'), 2)
+        os.makedirs(self.path_context.dependencies_staging_path())
+        with open(self.path_context.installer_metadata_path(), 'w') as f:
+            json.dump({}, f)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def _generate(self):
+        generate_archive_v2(
+            self.path_context, [self.path_context.installer_metadata_path()],
+            False, package_names=['pkg_b', 'pkg_a', 'pkg_missing'])
+        with Bundle(name=self.path_context.bundle_v2_output_path(),
+                    mode='r') as bundle:
+            return [overlay['name'] for overlay in bundle.overlays()]
+
+    def test_package_overlays(self):
+        names = self._generate()
+        assert ['dependencies.tar.gz', 'workspace.tar.gz',
+                'workspace-pkg_b.tar.gz', 'workspace-pkg_a.tar.gz'] == names
+
+        with Bundle(name=self.path_context.bundle_v2_output_path(),
+                    mode='r') as bundle:
+            with bundle.open_overlay('workspace.tar.gz') as tar:
+                assert 'opt/built_workspace/pkg_a' not in tar.getnames()
+            with bundle.open_overlay('workspace-pkg_a.tar.gz') as tar:
+                names = tar.getnames()
+                assert 'opt/built_workspace/share/pkg_a/package.sh' in names
+                assert 'setup.sh' in names
+
+        pkg_a_overlay = self.path_context.workspace_package_overlay_path(
+            'pkg_a')
+        pkg_b_overlay = self.path_context.workspace_package_overlay_path(
+            'pkg_b')
+        pkg_a_mtime = os.stat(pkg_a_overlay).st_mtime_ns
+        pkg_b_mtime = os.stat(pkg_b_overlay).st_mtime_ns
+
+        Path(self.install_base, 'pkg_b', 'lib').mkdir()
+        self._generate()
+        assert pkg_a_mtime == os.stat(pkg_a_overlay).st_mtime_ns
+        assert pkg_b_mtime != os.stat(pkg_b_overlay).st_mtime_ns
+
+    def test_package_overlay_follows_symlinks(self):
+        # Like the files of a package built with --symlink-install
+        source = Path(self.tmpdir, 'src', 'script.py')
+        source.parent.mkdir()
+        source.write_text('old')
+        os.symlink(
+            str(source), os.path.join(
+                self.install_base, 'pkg_a', 'share', 'pkg_a', 'script.py'))
+        self._generate()
+        pkg_a_overlay = self.path_context.workspace_package_overlay_path(
+            'pkg_a')
+        pkg_a_mtime = os.stat(pkg_a_overlay).st_mtime_ns
+
+        source.write_text('new content')
+        self._generate()
+        assert pkg_a_mtime != os.stat(pkg_a_overlay).st_mtime_ns
+        with tarfile.open(pkg_a_overlay) as tar:
+            assert b'new content' == tar.extractfile(
+                'opt/built_workspace/share/pkg_a/script.py').read()
+
+    def test_removed_package_overlay(self):
+        self._generate()
+        shutil.rmtree(os.path.join(self.install_base, 'pkg_a'))
+        names = self._generate()
+        assert 'workspace-pkg_a.tar.gz' not in names
+        assert not os.path.exists(
+            self.path_context.workspace_package_overlay_path('pkg_a'))
+
+
+def _read_overlay(path):
+    with tarfile.open(path) as tar:
+        return {
+            member.name: tar.extractfile(member).read()
+            if member.isfile() else None
+            for member in tar}
+
+
+def test_stream_workspace_overlay():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        install_base = os.path.join(tmpdir, 'install')
+        os.makedirs(os.path.join(install_base, 'pkg', 'bin'))
+        with open(os.path.join(install_base, 'pkg', 'bin', 'script'),
+                  'w') as f:
+            f.write('#!/usr/bin/python3\nprint("hello")\n')
+        with open(os.path.join(install_base, 'setup.sh'), 'w') as f:
+            f.write('workspace')
+        # Symlinks are replaced by their targets like in the staging copy
+        os.symlink('script', os.path.join(install_base, 'pkg', 'bin', 'link'))
+        os.symlink('bin', os.path.join(install_base, 'pkg', 'scripts'))
+
+        overlays = []
+        for stream in (False, True):
+            overlay = os.path.join(tmpdir, '{}.tar.gz'.format(stream))
+            create_workspace_overlay(
+                install_base, os.path.join(tmpdir, 'staging'), overlay,
+                stream=stream)
+            overlays.append(_read_overlay(overlay))
+        assert overlays[0] == overlays[1]
+        assert b'#!/usr/bin/env python3\nprint("hello")\n' == \
+            overlays[1]['opt/built_workspace/pkg/bin/script']
+        assert b'#!/usr/bin/env python3\nprint("hello")\n' == \
+            overlays[1]['opt/built_workspace/pkg/scripts/link']
+        assert b'workspace' == overlays[1]['opt/built_workspace/setup.sh']
+        assert 'setup.bash' in overlays[1]
+        # The staging directory of the previous bundle is removed
+        assert not os.path.exists(os.path.join(tmpdir, 'staging'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_recursive_tar_in_path_dereferences_additional_paths():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        staging = os.path.join(tmpdir, 'staging')
+        install_base = os.path.join(tmpdir, 'install')
+        os.makedirs(staging)
+        os.makedirs(install_base)
+        with open(os.path.join(install_base, 'setup.sh'), 'w') as f:
+            f.write('workspace')
+        os.symlink('setup.sh', os.path.join(install_base, 'link'))
+        os.symlink('setup.sh', os.path.join(staging, 'link'))
+
+        tar_path = os.path.join(tmpdir, 'bundle.tar')
+        recursive_tar_in_path(
+            tar_path, staging,
+            additional_paths=[(install_base, 'opt/install')])
+        with tarfile.open(tar_path) as tar:
+            # Symlinks of the staging directory are kept
+            assert tar.getmember('link').issym()
+            assert b'workspace' == tar.extractfile(
+                tar.getmember('opt/install/link')).read()
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,94 @@
+from argparse import Namespace
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+
+from colcon_bundle.verb._bundle_fingerprint import bundle_fingerprint, \
+    bundle_up_to_date, record_bundle_fingerprint
+from colcon_bundle.verb._path_context import PathContext
+
+
+def _decorator(name, run_dependencies):
+    decorator = Mock()
+    decorator.selected = True
+    decorator.descriptor.name = name
+    decorator.descriptor.type = 'ros.catkin'
+    decorator.descriptor.dependencies = {'run': set(run_dependencies)}
+    return decorator
+
+
+class TestBundleFingerprint:
+
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.install_base = os.path.join(self.tmpdir, 'install')
+        os.makedirs(self.install_base)
+        Path(self.install_base, 'setup.sh').write_text('workspace')
+        self.sources_list = os.path.join(self.tmpdir, 'sources.list')
+        Path(self.sources_list).write_text('deb http://archive focal main')
+        self.args = Namespace(
+            bundle_version=2, apt_sources_list=self.sources_list,
+            main=lambda: None)
+        self.decorators = [_decorator('pkg', ['libfoo'])]
+
+        with patch('colcon_bundle.verb._path_context.'
+                   'check_and_mark_bundle_version'), \
+                patch('colcon_bundle.verb._path_context.'
+                      'check_and_mark_bundle_tool'), \
+                patch('colcon_bundle.verb._path_context.'
+                      'get_and_mark_bundle_cache_version',
+                      return_value=2):
+            self.path_context = PathContext(
+                self.install_base, os.path.join(self.tmpdir, 'bundle'), 2)
+        self.output_path = self.path_context.bundle_v2_output_path()
+        Path(self.output_path).write_text('bundle')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def _fingerprint(self):
+        return bundle_fingerprint(
+            self.args, self.decorators, self.install_base)
+
+    def test_unchanged(self):
+        fingerprint = self._fingerprint()
+        assert not bundle_up_to_date(
+            self.path_context, fingerprint, self.output_path)
+        record_bundle_fingerprint(
+            self.path_context, fingerprint, self.output_path)
+        assert fingerprint == self._fingerprint()
+        assert bundle_up_to_date(
+            self.path_context, fingerprint, self.output_path)
+
+    def test_inputs_changed(self):
+        fingerprint = self._fingerprint()
+
+        self.args.bundle_version = 1
+        assert fingerprint != self._fingerprint()
+        self.args.bundle_version = 2
+
+        Path(self.sources_list).write_text('deb http://archive jammy main')
+        assert fingerprint != self._fingerprint()
+        fingerprint = self._fingerprint()
+
+        self.decorators = [_decorator('pkg', ['libfoo', 'libbar'])]
+        assert fingerprint != self._fingerprint()
+        fingerprint = self._fingerprint()
+
+        Path(self.install_base, 'new_file').write_text('new')
+        assert fingerprint != self._fingerprint()
+
+    def test_output_changed(self):
+        fingerprint = self._fingerprint()
+        record_bundle_fingerprint(
+            self.path_context, fingerprint, self.output_path)
+
+        Path(self.output_path).write_text('modified bundle')
+        assert not bundle_up_to_date(
+            self.path_context, fingerprint, self.output_path)
+
+        os.remove(self.output_path)
+        assert not bundle_up_to_date(
+            self.path_context, fingerprint, self.output_path)
@@ -0,0 +1,107 @@
+from argparse import ArgumentParser, Namespace
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+
+from colcon_bundle.installer import add_installer_arguments
+from colcon_bundle.installer.apt import AptBundleInstallerExtension
+from colcon_bundle.installer.pip3 import Pip3BundleInstallerExtensionPoint
+from colcon_bundle.verb._bundle_lock import bundle_lock_key, \
+    read_bundle_lock, write_bundle_lock
+from colcon_bundle.verb._path_context import PathContext
+from colcon_core.argument_parser.destination_collector import \
+    DestinationCollectorDecorator
+import pytest
+
+
+def _decorator(name, run_dependencies):
+    decorator = Mock()
+    decorator.selected = True
+    decorator.descriptor.name = name
+    decorator.descriptor.type = 'ros.catkin'
+    decorator.descriptor.dependencies = {'run': set(run_dependencies)}
+    return decorator
+
+
+class TestBundleLock:
+
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        install_base = os.path.join(self.tmpdir, 'install')
+        os.makedirs(install_base)
+        with patch('colcon_bundle.verb._path_context.'
+                   'check_and_mark_bundle_version'), \
+                patch('colcon_bundle.verb._path_context.'
+                      'check_and_mark_bundle_tool'), \
+                patch('colcon_bundle.verb._path_context.'
+                      'get_and_mark_bundle_cache_version',
+                      return_value=2):
+            self.path_context = PathContext(
+                install_base, os.path.join(self.tmpdir, 'bundle'), 2)
+        self.args = Namespace(
+            apt_sources_list='focal.sources.list', bundle_base='bundle',
+            locked=False)
+        self.decorators = [_decorator('pkg', ['libfoo'])]
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def _key(self):
+        return bundle_lock_key(
+            self.args, ['apt_sources_list'], self.decorators)
+
+    def test_key(self):
+        key = self._key()
+        # Arguments of the verb do not change the resolved packages
+        self.args.bundle_base = 'other'
+        self.args.locked = True
+        assert key == self._key()
+
+        self.args.apt_sources_list = 'jammy.sources.list'
+        assert key != self._key()
+        key = self._key()
+
+        self.decorators = [_decorator('pkg', ['libbar'])]
+        assert key != self._key()
+
+    def test_read_written_lock(self):
+        installers = {'apt': ['libfoo=1.0'], 'pip3': ['requests==2.0']}
+        write_bundle_lock(self.path_context, self._key(), installers)
+        assert installers == read_bundle_lock(self.path_context, self._key())
+
+    def test_missing_lock(self):
+        with pytest.raises(RuntimeError):
+            read_bundle_lock(self.path_context, self._key())
+
+    def test_outdated_lock(self):
+        write_bundle_lock(self.path_context, self._key(), {'apt': []})
+        self.decorators = [_decorator('pkg', ['libbar'])]
+        with pytest.raises(RuntimeError):
+            read_bundle_lock(self.path_context, self._key())
+
+
+class _CustomInstaller:
+    LOCK_ARGUMENTS = None
+
+    def add_arguments(self, *, parser):
+        parser.add_argument('--custom-arg')
+
+
+def test_lock_arguments():
+    extensions = OrderedDict([
+        ('apt', AptBundleInstallerExtension()),
+        ('custom', _CustomInstaller()),
+        ('pip3', Pip3BundleInstallerExtensionPoint()),
+    ])
+    parser = DestinationCollectorDecorator(ArgumentParser())
+    with patch('colcon_bundle.installer.get_bundle_installer_extensions',
+               return_value=extensions), \
+            patch('colcon_bundle.installer.apt.'
+                  'get_ubuntu_distribution_version', return_value='focal'):
+        lock_arguments = add_installer_arguments(parser)
+    # Options which do not change the resolved packages are left out
+    assert lock_arguments == [
+        'apt_package_blacklist', 'apt_sources_list', 'apt_allow_insecure',
+        'apt_resolver', 'custom_arg', 'pip3_args', 'pip3_requirements']
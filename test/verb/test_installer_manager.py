@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from functools import partial
+import threading
+from unittest.mock import Mock
+
+from colcon_bundle.installer.apt import AptBundleInstallerExtension
+from colcon_bundle.installer.pip import PipBundleInstallerExtensionPoint
+from colcon_bundle.installer.pip3 import Pip3BundleInstallerExtensionPoint
+from colcon_bundle.verb._installer_manager import _PrefixWrites, \
+    _run_installer_graph, get_installer_dependencies
+import pytest
+
+
+class _Installer:
+
+    def __init__(self, metadata, *, depends_on=None, started=None,
+                 wait_for=None, error=None):
+        self.DEPENDS_ON = depends_on
+        self.metadata = metadata
+        self.started = started
+        self.wait_for = wait_for
+        self.error = error
+
+    def install(self):
+        if self.started is not None:
+            self.started.set()
+        if self.wait_for is not None:
+            # Only finishes if the other installer runs concurrently
+            assert self.wait_for.wait(timeout=10)
+        if self.error is not None:
+            raise self.error
+        return self.metadata
+
+
+def test_dependencies():
+    installers = OrderedDict([
+        ('apt', _Installer({}, depends_on=())),
+        ('custom', _Installer({})),
+        ('pip', _Installer({}, depends_on=('apt', 'missing'))),
+        ('pip3', _Installer({}, depends_on=('apt',))),
+    ])
+    assert get_installer_dependencies(installers) == {
+        'apt': set(),
+        # Installers without declared dependencies keep the serial order
+        'custom': {'apt'},
+        'pip': {'apt'},
+        'pip3': {'apt'},
+    }
+
+
+def test_pip_installers_run_concurrently():
+    installers = OrderedDict([
+        ('apt', AptBundleInstallerExtension()),
+        ('pip', PipBundleInstallerExtensionPoint()),
+        ('pip3', Pip3BundleInstallerExtensionPoint()),
+    ])
+    dependencies = get_installer_dependencies(installers)
+    assert dependencies['pip'] == {'apt'}
+    assert dependencies['pip3'] == {'apt'}
+    # Both write scripts to the same directory
+    assert installers['pip3'].PREFIX_WRITE_PHASES == \
+        installers['pip'].PREFIX_WRITE_PHASES
+
+
+class _WritingInstaller:
+
+    PREFIX_WRITE_PHASES = ('bootstrap', 'install')
+
+    def __init__(self, name, writes, *, depends_on=('apt',), skip=(),
+                 started=None, wait_for=None):
+        self.DEPENDS_ON = depends_on
+        self.name = name
+        self.writes = writes
+        self.skip = skip
+        self.started = started
+        self.wait_for = wait_for
+        self.prefix_writes = None
+
+    def install(self):
+        if self.started is not None:
+            self.started.set()
+        if self.wait_for is not None:
+            # Resolving runs concurrently
+            assert self.wait_for.wait(timeout=10)
+        for phase in self.PREFIX_WRITE_PHASES:
+            if phase in self.skip:
+                continue
+            with self.prefix_writes(phase):
+                self.writes.append((phase, self.name))
+        return {}
+
+
+def _run_writing_installers(installers):
+    dependencies = get_installer_dependencies(installers)
+    prefix_writes = _PrefixWrites(installers, dependencies)
+    for name, installer in installers.items():
+        installer.prefix_writes = partial(prefix_writes.write, name)
+    _run_installer_graph(
+        installers, dependencies, prefix_writes=prefix_writes)
+
+
+def test_prefix_writes_are_ordered():
+    writes = []
+    first_started = threading.Event()
+    second_started = threading.Event()
+    installers = OrderedDict([
+        ('apt', _Installer({}, depends_on=())),
+        # The second installer reaches its writes first
+        ('first', _WritingInstaller(
+            'first', writes, started=first_started,
+            wait_for=second_started)),
+        ('second', _WritingInstaller(
+            'second', writes, started=second_started)),
+        ('third', _WritingInstaller('third', writes, skip=('bootstrap',))),
+    ])
+
+    _run_writing_installers(installers)
+
+    assert writes == [
+        ('bootstrap', 'first'), ('bootstrap', 'second'),
+        ('install', 'first'), ('install', 'second'), ('install', 'third')]
+
+
+def test_prefix_writes_of_failed_installers():
+    writes = []
+    installers = OrderedDict([
+        ('apt', _Installer({}, depends_on=())),
+        ('failing', _Installer({}, error=RuntimeError('failing'))),
+        ('pending', _WritingInstaller(
+            'pending', writes, depends_on=('failing',))),
+        ('writing', _WritingInstaller('writing', writes)),
+    ])
+    installers['failing'].PREFIX_WRITE_PHASES = ('install',)
+
+    with pytest.raises(RuntimeError):
+        _run_writing_installers(installers)
+    # Neither the failed nor the never started installer block the writes
+    assert writes == [('bootstrap', 'writing'), ('install', 'writing')]
+
+
+def test_dependency_cycle():
+    installers = OrderedDict([
+        ('a', _Installer({}, depends_on=('b',))),
+        ('b', _Installer({}, depends_on=('a',))),
+    ])
+    with pytest.raises(RuntimeError):
+        get_installer_dependencies(installers)
+
+
+def test_independent_installers_run_concurrently():
+    pip_started = threading.Event()
+    pip3_started = threading.Event()
+    installers = OrderedDict([
+        ('apt', _Installer({'apt': 1}, depends_on=())),
+        ('pip', _Installer({'pip': 2}, depends_on=('apt',),
+                           started=pip_started, wait_for=pip3_started)),
+        ('pip3', _Installer({'pip3': 3}, depends_on=('apt',),
+                            started=pip3_started, wait_for=pip_started)),
+    ])
+
+    metadata = _run_installer_graph(
+        installers, get_installer_dependencies(installers))
+
+    # The metadata is in the order of the installers
+    assert list(metadata.items()) == [
+        ('apt', {'apt': 1}), ('pip', {'pip': 2}), ('pip3', {'pip3': 3})]
+
+
+def test_failed_dependency():
+    dependent = _Installer({}, depends_on=('apt',))
+    installers = OrderedDict([
+        ('apt', _Installer({}, depends_on=(), error=RuntimeError('apt'))),
+        ('pip', dependent),
+    ])
+    dependent.install = Mock()
+
+    with pytest.raises(RuntimeError):
+        _run_installer_graph(
+            installers, get_installer_dependencies(installers))
+    dependent.install.assert_not_called()
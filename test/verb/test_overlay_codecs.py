@@ -0,0 +1,134 @@
+import os
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+from unittest.mock import patch
+
+from colcon_bundle.verb._archive_generators import recursive_tar_in_path
+from colcon_bundle.verb._overlay_codecs import get_overlay_codec, \
+    get_overlay_codec_for_path, OVERLAY_CODECS
+from colcon_bundle.verb._overlay_utilities import overlay_options, \
+    read_overlay_info, recursive_tar_overlay_in_path, write_overlay_info
+from colcon_bundle.verb.utilities import filechecksum
+import pytest
+
+
+@pytest.mark.parametrize('name', list(OVERLAY_CODECS.keys()))
+def test_codec_round_trip(name):
+    if name == 'zstd':
+        pytest.importorskip('zstandard')
+    codec = get_overlay_codec(name)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = Path(tmpdir) / 'source'
+        source.mkdir()
+        (source / 'setup.sh').write_text('echo hello\n')
+        archive = Path(tmpdir) / ('overlay' + codec.EXTENSION)
+
+        info = recursive_tar_overlay_in_path(
+            archive, source, compression=name, workers=2)
+
+        assert info['sha256'] == filechecksum(str(archive))
+        assert info['size'] == archive.stat().st_size
+        assert get_overlay_codec_for_path(archive) is codec
+        with archive.open('rb') as f:
+            with codec.open_tar_reader(f) as tar:
+                member = tar.next()
+                assert member.name == 'setup.sh'
+                assert tar.extractfile(member).read() == b'echo hello\n'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_overlay_codec('lzma')
+    assert get_overlay_codec_for_path('overlay.zip') is None
+
+
+def test_overlay_info():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = Path(tmpdir) / 'source'
+        source.mkdir()
+        (source / 'setup.sh').write_text('echo hello\n')
+        archive = Path(tmpdir) / 'overlay.tar.gz'
+        assert read_overlay_info(str(archive)) is None
+
+        info = recursive_tar_overlay_in_path(archive, source)
+        write_overlay_info(str(archive), info)
+        assert read_overlay_info(str(archive)) == info
+
+        write_overlay_info(str(archive), info, options=overlay_options())
+        assert read_overlay_info(
+            str(archive), options=overlay_options()) == info
+        assert read_overlay_info(
+            str(archive), options=overlay_options(file_index=True)) is None
+
+        with archive.open('ab') as f:
+            f.write(b'modified')
+        assert read_overlay_info(str(archive)) is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _create_tree(path, mtime):
+    (path / 'b' / 'c').mkdir(parents=True)
+    (path / 'a').write_text('a')
+    (path / 'b' / 'c' / 'd').write_text('d')
+    (path / 'b' / 'e').write_text('e')
+    for root, dirs, files in os.walk(str(path)):
+        for name in dirs + files:
+            os.utime(os.path.join(root, name), (mtime, mtime))
+
+
+@pytest.mark.parametrize('name', list(OVERLAY_CODECS.keys()))
+@pytest.mark.parametrize('workers', [1, 2])
+def test_reproducible_overlay(name, workers):
+    if name == 'zstd':
+        pytest.importorskip('zstandard')
+    codec = get_overlay_codec(name)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        checksums = set()
+        for number, mtime in enumerate((1600000000, 1700000000)):
+            source = Path(tmpdir) / 'source{}'.format(number)
+            _create_tree(source, mtime)
+            archive = Path(tmpdir) / (str(number) + codec.EXTENSION)
+            with patch.dict(os.environ, {'SOURCE_DATE_EPOCH': '1550000000'}):
+                info = recursive_tar_overlay_in_path(
+                    archive, source, compression=name, workers=workers,
+                    reproducible=True)
+            checksums.add(info['sha256'])
+        assert len(checksums) == 1
+
+        with archive.open('rb') as f:
+            with codec.open_tar_reader(f) as tar:
+                members = list(tar)
+        assert ['a', 'b', 'b/c', 'b/c/d', 'b/e'] == \
+            [member.name for member in members]
+        for member in members:
+            assert member.mtime == 1550000000
+            assert (member.uid, member.gid) == (0, 0)
+            assert (member.uname, member.gname) == ('', '')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_reproducible_tar():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        checksums = set()
+        for number, mtime in enumerate((1600000000, 1700000000)):
+            source = Path(tmpdir) / 'source{}'.format(number)
+            _create_tree(source, mtime)
+            archive = os.path.join(tmpdir, '{}.tar'.format(number))
+            with patch.dict(os.environ, {'SOURCE_DATE_EPOCH': ''}):
+                recursive_tar_in_path(archive, str(source), reproducible=True)
+            checksums.add(filechecksum(archive))
+            with tarfile.open(archive) as tar:
+                assert {0} == {member.mtime for member in tar}
+        assert len(checksums) == 1
+    finally:
+        shutil.rmtree(tmpdir)
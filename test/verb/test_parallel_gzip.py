@@ -0,0 +1,67 @@
+import gzip
+import io
+import os
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+import zlib
+
+from colcon_bundle.verb._overlay_utilities import recursive_tar_gz_in_path
+from colcon_bundle.verb._parallel_gzip import ParallelGzipWriter
+
+
+def test_parallel_gzip_round_trip():
+    data = os.urandom(100000) + bytes(300000) + b'colcon' * 50000
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, workers=4, block_size=64 * 1024) as gz:
+        gz.write(data[:12345])
+        gz.write(data[12345:])
+        assert gz.tell() == len(data)
+    assert gzip.decompress(output.getvalue()) == data
+
+
+def test_parallel_gzip_empty():
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, workers=2):
+        pass
+    assert gzip.decompress(output.getvalue()) == b''
+
+
+def test_parallel_gzip_checkpoints():
+    data = os.urandom(100000) + b'colcon' * 100000
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, workers=2, block_size=64 * 1024,
+                            checkpoint_interval=200 * 1024) as gz:
+        gz.write(data)
+    compressed = output.getvalue()
+    assert gzip.decompress(compressed) == data
+
+    assert [0, 256 * 1024, 512 * 1024] == \
+        [offset for offset, _ in gz.checkpoints]
+    for offset, compressed_offset in gz.checkpoints:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        # The trailer follows the end of the deflate stream
+        assert decompressor.decompress(compressed[compressed_offset:]) == \
+            data[offset:]
+
+
+def test_recursive_tar_gz_in_path_with_workers():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = Path(tmpdir) / 'source'
+        (source / 'sub').mkdir(parents=True)
+        (source / 'file').write_bytes(os.urandom(3 * 1024 * 1024))
+        (source / 'sub' / 'other').write_text('other')
+        archive = Path(tmpdir) / 'archive.tar.gz'
+
+        recursive_tar_gz_in_path(archive, source, workers=4)
+
+        with tarfile.open(str(archive), 'r:gz') as tar:
+            names = sorted(tar.getnames())
+            assert names == ['file', 'sub', 'sub/other']
+            assert tar.extractfile('file').read() == \
+                (source / 'file').read_bytes()
+            assert tar.extractfile('sub/other').read() == b'other'
+    finally:
+        shutil.rmtree(tmpdir)